@@ -1,6 +1,18 @@
 # Copyright 2021 (c) Erik de Lange
 # Released under MIT license
 
-from .sendfile import sendfile
 from .server import HTTPServer
-from .response import HTTPResponse
\ No newline at end of file
+from .response import HTTPResponse
+
+
+# sendfile is imported from its own module where it is used, e.g. from ahttpserver.sendfile import sendfile, as it
+# shares the module's name, and serving doesn't need it
+
+
+def __getattr__(name):
+    # StaticFiles is imported when it is first used, serving doesn't need it either
+    if name == "StaticFiles":
+        from .static import StaticFiles
+
+        return StaticFiles
+    raise AttributeError(name)
\ No newline at end of file
@@ -0,0 +1,98 @@
+# Buffered reading of HTTP request heads.
+#
+# A request head (the request line plus the header fields, up to and
+# including the empty line) is read into a buffer which is allocated once
+# per connection and reused for every request on it. Reading only records
+# where each line starts and ends, turning lines into objects is left to
+# HTTPRequest (see url.py) and is only done for the parts which are used.
+#
+# The size of the buffer is a hard limit on the size of a request head, so
+# a misbehaving client cannot make the server allocate more memory than that.
+#
+# For MicroPython applications which process HTTP requests.
+#
+# Released under MIT license
+
+from array import array
+
+_CR = 13
+_LF = 10
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class RequestReader:
+
+    def __init__(self, reader, size=1024, max_lines=32):
+        """ Create a reader for the request heads arriving on a connection
+
+        :param StreamReader reader: the stream to read from
+        :param int size: maximum size of a request head in bytes
+        :param int max_lines: maximum number of lines in a request head
+        """
+        self._reader = reader
+        self._readinto = getattr(reader, "readinto", None)  # not all asyncio implementations offer readinto
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.starts = array("H", [0] * max_lines)  # start of each line in buffer
+        self.ends = array("H", [0] * max_lines)  # end of each line in buffer, excluding the line terminator
+        self.count = 0  # number of lines in the current head
+        self._head = 0  # number of bytes in the buffer taken by the current head
+        self._end = 0  # number of bytes in the buffer
+
+    async def read_head(self):
+        """ Read the next request head into the buffer
+
+        Empty lines before the request line are skipped. Bytes which arrive
+        after the head, such as pipelined requests, are kept for the next call.
+        A timeout should be applied by the caller.
+
+        :return int: number of lines in the head, 0 if the client closed the connection
+        :raises RequestTooLarge: if the head does not fit the buffer or has too many lines
+        """
+        buffer = self.buffer
+        if self._head:
+            remaining = self._end - self._head
+            if remaining:
+                buffer[:remaining] = self.view[self._head:self._end]
+            self._end = remaining
+            self._head = 0
+        self.count = 0
+        start = pos = 0
+
+        while True:
+            while pos < self._end:
+                if buffer[pos] == _LF:
+                    end = pos - 1 if pos > start and buffer[pos - 1] == _CR else pos
+                    pos += 1
+                    if end > start:
+                        if self.count == len(self.starts):
+                            raise RequestTooLarge(f"More than {self.count} lines in request")
+                        self.starts[self.count] = start
+                        self.ends[self.count] = end
+                        self.count += 1
+                    elif self.count > 0:  # empty line ends the head
+                        self._head = pos
+                        return self.count
+                    start = pos
+                else:
+                    pos += 1
+
+            if self._end == len(buffer):
+                raise RequestTooLarge(f"Request head larger than {len(buffer)} bytes")
+            n = await self._fill()
+            if n == 0:  # connection closed, discard any partial head
+                return 0
+
+    async def _fill(self):
+        # Read as many bytes as are available and fit into the free part of the buffer
+        if self._readinto is not None:
+            n = await self._readinto(self.view[self._end:])
+        else:
+            data = await self._reader.read(len(self.buffer) - self._end)
+            n = len(data)
+            self.buffer[self._end:self._end + n] = data
+        self._end += n
+        return n
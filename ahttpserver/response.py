@@ -9,39 +9,49 @@
 
 reason = {
     200: "OK",
+    304: "Not Modified",
     400: "Bad Request",
-    404: "Not Found"
+    404: "Not Found",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable"
 }
 
 class HTTPResponse:
 
-    def __init__(self, status, mimetype=None, close=True, header=None):
+    def __init__(self, status, mimetype=None, close=True, header=None, length=None):
         """ Create a response object
 
         :param int status: HTTP status code
         :param str mimetype: HTTP mime type
         :param bool close: if true close connection else keep alive
         :param dict header: key,value pairs for HTTP response header fields
+        :param int length: length of the body in bytes, sent as Content-Length. mandatory
+                           for a response on a connection which is kept alive
         """
         self.status = status
         self.mimetype = mimetype
         self.close = close
+        self.length = length
         if header is None:
             self.header={}
         else:
             self.header=header
 
     async def send(self, writer):
-        """ Send response to stream writer """
-        writer.write(f"HTTP/1.1 {self.status} {reason.get(self.status, 'NA')}\n")
+        """ Send response status line and header fields to stream writer in a single write """
+        lines = [f"HTTP/1.1 {self.status} {reason.get(self.status, 'NA')}"]
         if self.mimetype is not None:
-            writer.write(f"Content-Type: {self.mimetype}\n")
+            lines.append(f"Content-Type: {self.mimetype}")
+        if self.length is not None:
+            lines.append(f"Content-Length: {self.length}")
         if self.close:
-            writer.write("Connection: close\n")
+            lines.append("Connection: close")
         else:
-            writer.write("Connection: keep-alive\n")
+            lines.append("Connection: keep-alive")
         if len(self.header) > 0:
             for key, value in self.header.items():
-                writer.write(f"{key}: {value}\n")
-        writer.write("\n")
+                lines.append(f"{key}: {value}")
+        lines.append("\r\n")
+        writer.write("\r\n".join(lines))
         await writer.drain()
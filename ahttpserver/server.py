@@ -4,7 +4,8 @@
 #
 #   import uasyncio as asyncio
 #
-#   from ahttpserver import HTTPServer, sendfile
+#   from ahttpserver import HTTPServer
+#   from ahttpserver.sendfile import sendfile
 #
 #   app = HTTPServer()
 #
@@ -23,7 +24,34 @@
 # reader and writer and a object with details from the request (see url.py
 # for exact content). The handler must construct and send a correct HTTP
 # response. To avoid typos use response components from response.py.
-# When leaving the handler the connection is closed.
+#
+# Connections are persistent (HTTP/1.1 keep-alive) when the client allows it,
+# which the server records in request.keep_alive. When leaving the handler the
+# connection is closed unless request.keep_alive is still true, in which case
+# the next (possibly already pipelined) request is read from the connection.
+# A handler which keeps the connection alive must send a response with a
+# Content-Length, i.e. HTTPResponse(..., close=not request.keep_alive,
+# length=...). A handler which sends a body of unknown length must set
+# request.keep_alive to False and send its response with close=True.
+#
+# At most max_connections connections are handled at the same time, any
+# connection beyond that immediately receives a 503 response and is closed.
+# A handler which keeps its connection open indefinitely, such as an event
+# stream, calls server.begin_stream(request) first. Its connection then
+# counts against max_streams instead, so streams can't take the connections
+# short requests need; when begin_stream() returns False the handler sends
+# its own 503.
+# The writer passed to handlers applies drain_timeout to every drain(), so a
+# client which stops reading raises asyncio.TimeoutError in the handler
+# instead of blocking it (and the memory it holds) forever.
+#
+# Messages go to the logger passed to the server, any object with debug, info,
+# warning and error methods taking a %-format string and its arguments (e.g.
+# CPython's logging.Logger). By default they are printed to the console.
+# If an observer is passed to the server it is called after every request
+# with the (method, path) of the route that handled it, or None if there was
+# none, and the microseconds the request took from reading its head to the
+# handler returning.
 # Any (method, path) combination which has not been declared using @route
 # will, when received by the server, result in a 404 HTTP error.
 #
@@ -33,7 +61,9 @@
 import errno
 
 import uasyncio as asyncio
+from utime import ticks_diff, ticks_us
 
+from .reader import RequestReader, RequestTooLarge
 from .response import HTTPResponse
 from .url import HTTPRequest, InvalidRequest
 
@@ -42,13 +72,82 @@ class HTTPServerError(Exception):
     pass
 
 
+# Sent as is to connections beyond max_connections, without reading their request
+_BUSY_RESPONSE = b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+class _PrintLogger:
+    """ Default logger, prints every message to the console """
+
+    def _print(self, message, *args):
+        print(message % args if args else message)
+
+    debug = info = warning = error = _print
+
+
+class _TimeoutWriter:
+    """ Stream writer wrapper which limits how long drain() may wait for the client """
+
+    def __init__(self, writer, timeout):
+        self._writer = writer
+        self._timeout = timeout
+
+    def write(self, data):
+        self._writer.write(data)
+
+    async def drain(self):
+        await asyncio.wait_for(self._writer.drain(), self._timeout)
+
+    def close(self):
+        self._writer.close()
+
+    async def wait_closed(self):
+        await self._writer.wait_closed()
+
+    def get_extra_info(self, name):
+        return self._writer.get_extra_info(name)
+
+
 class HTTPServer:
 
-    def __init__(self, host="0.0.0.0", port=80, backlog=5, timeout=30):
+    def __init__(self, host="0.0.0.0", port=80, backlog=5, timeout=30, keepalive_timeout=5, max_requests=100,
+                 max_header_size=1024, max_connections=8, max_streams=8, drain_timeout=5, logger=None,
+                 observer=None):
+        """ Create a server
+
+        :param int timeout: seconds to wait for the first request on a connection, and for each header line
+        :param int keepalive_timeout: seconds a persistent connection may sit idle waiting for its next request
+        :param int max_requests: requests served on a single connection before it is closed
+        :param int max_header_size: maximum size in bytes of a request line plus header fields, the size of the
+                                    buffer allocated for every connection
+        :param int max_connections: connections handled at the same time, any more are refused with a 503.
+                                    Streams don't count, so this many are always left for short requests.
+        :param int max_streams: connections whose handler has called begin_stream() at the same time.  Each
+                                connection holds its max_header_size buffer and a task for as long as it is open,
+                                so max_connections + max_streams of them have to fit in the heap at once.
+        :param int drain_timeout: seconds a handler may wait for a client to accept written data
+        :param logger: receives the server's messages, every request is logged at debug level
+        :param observer: function called with the route and duration in microseconds of every request, except
+                         those whose handler set request.observe to False, such as streams which run for longer
+                         than ticks_us can measure
+        """
         self.host = host
         self.port = port
         self.backlog = backlog
         self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.max_header_size = max_header_size
+        self.max_connections = max_connections
+        self.max_streams = max_streams
+        self.drain_timeout = drain_timeout
+        self._logger = _PrintLogger() if logger is None else logger
+        self._observer = observer
+        self.connections = 0  # connections currently being handled
+        self.peak_connections = 0  # highest value connections has reached
+        self.rejected_connections = 0  # connections refused because max_connections was reached
+        self.streams = 0  # connections currently streaming, see begin_stream()
+        self.rejected_streams = 0  # begin_stream() calls refused because max_streams was reached
         self._server = None
         self._routes = dict()  # stores link between (method, path) and function to execute
 
@@ -63,64 +162,136 @@ class HTTPServer:
 
         return wrapper
 
+    def begin_stream(self, request):
+        """ Called by a handler which keeps its connection open for a long time, such as an event stream, before it
+        starts.  The connection then counts against max_streams instead of max_connections until it closes.
+
+        :return bool: False if max_streams connections are already streaming, the handler should then refuse
+        """
+        if self.streams >= self.max_streams:
+            self.rejected_streams += 1
+            return False
+        self.streams += 1
+        request.stream = True
+        return True
+
     async def _handle_request(self, reader, writer):
-        try:
-            request_line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if self.connections - self.streams >= self.max_connections:
+            self.rejected_connections += 1
+            await self._refuse(writer)
+            return
 
-            if request_line in [b"", b"\r\n"]:
-                print(f"empty request line from {writer.get_extra_info('peername')[0]}")
-                return
+        self.connections += 1
+        if self.connections > self.peak_connections:
+            self.peak_connections = self.connections
+        writer = _TimeoutWriter(writer, self.drain_timeout)
+        try:
+            head = RequestReader(reader, self.max_header_size)
+            served = 0
+            while True:
+                # An idle persistent connection only gets the shorter keep-alive timeout to send its next request
+                timeout = self.timeout if served == 0 else self.keepalive_timeout
+                try:
+                    count = await asyncio.wait_for(head.read_head(), timeout)
+                except RequestTooLarge as e:
+                    body = repr(e).encode("utf-8")
+                    response = HTTPResponse(431, "text/plain", close=True, length=len(body))
+                    await response.send(writer)
+                    writer.write(body)
+                    return
 
-            print(f"request_line {request_line} from {writer.get_extra_info('peername')[0]}")
+                if count == 0:
+                    if served == 0:
+                        self._logger.debug("empty request from %s", writer.get_extra_info("peername")[0])
+                    return
 
-            try:
-                request = HTTPRequest(request_line)
-            except InvalidRequest as e:
-                while True:
-                    # read and discard header fields
-                    if await asyncio.wait_for(reader.readline(), self.timeout) in [b"", b"\r\n"]:
-                        break
-                response = HTTPResponse(400, "text/plain", close=True)
-                await response.send(writer)
-                writer.write(repr(e).encode("utf-8"))
-                return
+                served += 1
+                started = ticks_us()
+                request_line = bytes(head.view[head.starts[0]:head.ends[0]])
+                try:
+                    request = HTTPRequest(request_line, head)
+                except InvalidRequest as e:
+                    body = repr(e).encode("utf-8")
+                    response = HTTPResponse(400, "text/plain", close=True, length=len(body))
+                    await response.send(writer)
+                    writer.write(body)
+                    return
 
-            while True:
-                # read header fields and add name / value to dict 'header'
-                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                self._logger.debug("request %s %s", request.method, request.path)
 
-                if line in [b"", b"\r\n"]:
-                    break
+                # HTTP/1.1 connections persist unless the client asks otherwise, HTTP/1.0 ones only on request.
+                # Handlers don't read request bodies, so an unread body would be mistaken for the next request.
+                connection = request.get_header(b"connection", b"").lower()
+                if request.version == "1.1":
+                    request.keep_alive = connection != b"close"
                 else:
-                    if line.find(b":") != -1:
-                        name, value = line.split(b':', 1)
-                        request.header[name] = value.strip()
-
-            # search function which is connected to (method, path)
-            func = self._routes.get((request.method, request.path))
-            if func:
-                await func(reader, writer, request)
-            else:  # no function found for (method, path) combination
-                response = HTTPResponse(404)
-                await response.send(writer)
+                    request.keep_alive = connection == b"keep-alive"
+                if request.get_header(b"content-length", b"0") != b"0" or served >= self.max_requests:
+                    request.keep_alive = False
+
+                # An EventSource which reconnects sends the id of the last event it received, so the stream can
+                # be resumed from there
+                last_event_id = request.get_header(b"last-event-id")
+                if last_event_id is not None:
+                    request.last_event_id = last_event_id.decode("utf-8")
+
+                # search function which is connected to (method, path)
+                route = (request.method, request.path)
+                func = self._routes.get(route)
+                if func:
+                    try:
+                        await func(reader, writer, request)
+                    finally:
+                        if request.stream:
+                            self.streams -= 1
+                else:  # no function found for (method, path) combination
+                    route = None
+                    response = HTTPResponse(404, close=not request.keep_alive, length=0)
+                    await response.send(writer)
+
+                if self._observer is not None and request.observe:
+                    self._observer(route, ticks_diff(ticks_us(), started))
+
+                if not request.keep_alive:
+                    return
 
         except asyncio.TimeoutError:
             pass
         except Exception as e:
-            if e.args[0] == errno.ECONNRESET:  # connection reset by client
+            if e.args and e.args[0] == errno.ECONNRESET:  # connection reset by client
                 pass
             else:
-                # This used to raise the exception, instead we return a 500 and print the exception details to the console
-                print(f"Exception in _handle_request: {e}")
+                # This used to raise the exception, instead we return a 500 and log the exception details
+                self._logger.error("Exception in _handle_request: %s", e)
                 response = HTTPResponse(500)
                 await response.send(writer)
         finally:
-            await writer.drain()
+            self.connections -= 1
+            try:
+                await writer.drain()
+            except Exception:
+                pass  # the client has gone or stopped reading, close regardless
             writer.close()
-            await writer.wait_closed()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass  # the client has gone
+
+    async def _refuse(self, writer):
+        try:
+            writer.write(_BUSY_RESPONSE)
+            await asyncio.wait_for(writer.drain(), self.drain_timeout)
+        except Exception:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass  # the client has gone
 
     async def start(self):
-        print(f'HTTP server started on {self.host}:{self.port}')
+        self._logger.info("HTTP server started on %s:%s", self.host, self.port)
         self._server = await asyncio.start_server(self._handle_request, self.host, self.port, self.backlog)
 
     async def stop(self):
@@ -128,6 +299,6 @@ class HTTPServer:
             self._server.close()
             await self._server.wait_closed()
             self._server = None
-            print("HTTP server stopped")
+            self._logger.info("HTTP server stopped")
         else:
-            print("HTTP server was not started")
+            self._logger.info("HTTP server was not started")
@@ -57,3 +57,13 @@ class EventSource:
             writer.write(f"retry: {retry}\n")
         writer.write(f"data: {data}\n\n")
         await writer.drain()
+
+    async def write(self, event):
+        """ Send an event which has already been encoded in the event stream format
+
+        Lets a single encoded event be shared by many clients.
+
+        :param bytes event: one or more complete events, including the terminating blank line
+        """
+        self.writer.write(event)
+        await self.writer.drain()
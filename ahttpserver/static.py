@@ -0,0 +1,174 @@
+# Static files with validators and precompressed variants
+#
+# Usage:
+#
+#   from ahttpserver import HTTPServer, StaticFiles
+#
+#   app = HTTPServer()
+#   StaticFiles("/www").register(app)
+#
+# All files below the directory are indexed once, when register() is called:
+# their size is taken and an ETag computed from their content, and a route is
+# registered for each, so serving a request never lists the directory or reads
+# a file only to answer it. A request with an If-None-Match header holding
+# the current ETag gets a 304 without a body. When a file has a .gz next to it,
+# e.g. app.js and app.js.gz, clients which accept gzip get the .gz as app.js
+# with Content-Encoding: gzip. Files are streamed by sendfile, imported with
+# the first request, with a Content-Length so the connection can be kept alive.
+#
+# Files added or changed after register() is called are not picked up.
+
+import os
+import binascii
+import hashlib
+
+from .response import HTTPResponse
+from .server import HTTPServerError
+
+mimetypes = {
+    "html": "text/html",
+    "css": "text/css",
+    "js": "text/javascript",
+    "json": "application/json",
+    "txt": "text/plain",
+    "csv": "text/csv",
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "ico": "image/x-icon",
+    "woff2": "font/woff2",
+}
+
+_DIRECTORY = 0x4000
+_HASH_CHUNK = 512
+
+
+class _File:
+
+    def __init__(self, filename, mimetype, size, etag):
+        self.filename = filename
+        self.mimetype = mimetype
+        self.size = size
+        self.etag = etag
+        self.gz = None  # the _File of the .gz variant, if there is one
+
+
+def _etag(filename):
+    """ Return a strong ETag for a file, from a hash of its content """
+    h = hashlib.sha256()
+    buffer = bytearray(_HASH_CHUNK)
+    view = memoryview(buffer)
+    with open(filename, "rb") as fp:
+        while True:
+            n = fp.readinto(buffer)
+            if n == 0:
+                break
+            h.update(view[:n])
+    return '"' + binascii.hexlify(h.digest()[:8]).decode() + '"'
+
+
+def _accepts_gzip(accept_encoding):
+    """ Return True if an Accept-Encoding header value lists gzip, and not with q=0 """
+    for coding in accept_encoding.split(b","):
+        parameters = coding.split(b";")
+        if parameters[0].strip().lower() != b"gzip":
+            continue
+        for parameter in parameters[1:]:
+            name, _, value = parameter.strip().partition(b"=")
+            if name.lower() == b"q":
+                try:
+                    return float(value.decode()) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+class StaticFiles:
+
+    def __init__(self, directory, prefix="", index="index.html", max_age=0):
+        """ Create a set of static files
+
+        :param str directory: directory holding the files
+        :param str prefix: path the files are served under, e.g. "/static", or "" for the root
+        :param str index: name of the file also served for a directory's own path
+        :param int max_age: seconds a client may use a file without revalidating it, sent in Cache-Control
+        """
+        self.directory = directory.rstrip("/")
+        self.prefix = prefix.rstrip("/")
+        self.index = index
+        self.max_age = max_age
+        self.files = dict()  # path: _File
+
+    def scan(self):
+        """ Index the files below the directory, returns the number found """
+        self.files = dict()
+        self._scan(self.directory, self.prefix)
+        return len(self.files)
+
+    def _scan(self, directory, path):
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            return  # no such directory
+        for name in names:
+            filename = directory + "/" + name
+            stat = os.stat(filename)
+            if stat[0] & _DIRECTORY:
+                self._scan(filename, path + "/" + name)
+                continue
+            if name.endswith(".gz") and name[:-3] in names:
+                continue  # a variant, indexed with the file it compresses
+            file = _File(filename, mimetypes.get(name.rsplit(".", 1)[-1], "application/octet-stream"),
+                         stat[6], _etag(filename))
+            if name + ".gz" in names:
+                gz = filename + ".gz"
+                file.gz = _File(gz, file.mimetype, os.stat(gz)[6], _etag(gz))
+            self.files[path + "/" + name] = file
+            if name == self.index:
+                self.files[path + "/"] = file
+
+    def register(self, server):
+        """ Index the files and register a GET route with the server for each
+
+        Paths which already have a route keep it.
+
+        :param HTTPServer server: the server to register the routes with
+        :return int: the number of routes registered
+        """
+        self.scan()
+        count = 0
+        for path, file in self.files.items():
+            try:
+                server.route("GET", path)(self._handler(file))
+                count += 1
+            except HTTPServerError:
+                pass  # already taken
+        return count
+
+    def _handler(self, file):
+        max_age = self.max_age
+
+        async def handler(reader, writer, request):
+            variant = file
+            header = {"Cache-Control": f"max-age={max_age}"}
+            if file.gz is not None:
+                header["Vary"] = "Accept-Encoding"
+                if _accepts_gzip(request.get_header(b"accept-encoding", b"")):
+                    variant = file.gz
+                    header["Content-Encoding"] = "gzip"
+            header["ETag"] = variant.etag
+            match = request.get_header(b"if-none-match")
+            if match is not None and (match == b"*" or variant.etag.encode() in match):
+                header.pop("Content-Encoding", None)
+                response = HTTPResponse(304, close=not request.keep_alive, header=header)
+                await response.send(writer)
+                return
+            response = HTTPResponse(200, file.mimetype, close=not request.keep_alive, header=header,
+                                    length=variant.size)
+            await response.send(writer)
+            from .sendfile import sendfile
+
+            await sendfile(writer, variant.filename)
+
+        return handler
@@ -1,4 +1,4 @@
-# Routines for decoding an HTTP request line.
+# Routines for decoding an HTTP request line and looking up header fields.
 #
 # HTTP request line as understood by this package:
 #
@@ -27,45 +27,122 @@ class InvalidRequest(Exception):
     pass
 
 
+# IETF standardized methods, mapped to the str used as key in the route table
+METHODS = {b"GET": "GET", b"HEAD": "HEAD", b"POST": "POST", b"PUT": "PUT", b"DELETE": "DELETE",
+           b"CONNECT": "CONNECT", b"OPTIONS": "OPTIONS", b"TRACE": "TRACE"}
+
+VERSIONS = {b"HTTP/1.1": "1.1", b"HTTP/1.0": "1.0"}
+
+_COLON = 58
+
+
 class HTTPRequest:
 
-    def __init__(self, request_line) -> None:
+    def __init__(self, request_line, head=None) -> None:
         """ Separate an HTTP request line in its elements.
 
+            Only the path and query string are decoded, the method and the
+            usual versions are mapped to constant strings. Header fields are
+            not parsed until they are asked for.
+
             :param bytes request_line: the complete HTTP request line
+            :param RequestReader head: the reader holding the request head this
+                    line was taken from, used to look up header fields. These are
+                    only available until the next request head is read from the
+                    connection, so until the handler returns.
             :return Request: instance containing
                     method      the request method ("GET", "PUT", ...)
                     url         the request URL, including the query string (if any)
                     path        the request path from the URL
                     query       the query string from the URL (if any, else "")
                     version     the HTTP version
-                    parameters  dictionary with key-value pairs from the query string
-                    header      empty dict, placeholder for key-value pairs from request header fields
+                    parameters  dictionary with key-value pairs from the query string, parsed on first use
+                    header      dictionary with key-value pairs from request header fields, parsed on first use
+                    keep_alive  False, set by the server when the connection may be reused for another request
+                    last_event_id  None, set by the server to the Last-Event-ID header field of a reconnecting
+                                event stream client
             :raises InvalidRequest: if line does not contain exactly 3 components separated by spaces
                                     if method is not in IETF standardized set
                                     aside from these no other checks done here
         """
-        try:
-            self.method, self.url, self.version = request_line.decode("utf-8").split()
-            # note that method, url and version are str, not bytes
-        except ValueError:
+        end = len(request_line)
+        while end > 0 and (request_line[end - 1] == 10 or request_line[end - 1] == 13):  # LF, CR
+            end -= 1
+        sp1 = request_line.find(b" ")
+        sp2 = request_line.find(b" ", sp1 + 1)
+        if sp1 <= 0 or sp2 <= sp1 + 1 or sp2 >= end - 1 or request_line.find(b" ", sp2 + 1, end) != -1:
             raise InvalidRequest(f"Expected 3 elements in {request_line}")
 
-        if self.version.find("/") != -1:
-            self.version = self.version.split("/", 1)[1]
+        self.method = METHODS.get(request_line[:sp1])
+        if self.method is None:
+            raise InvalidRequest(f"Invalid method {request_line[:sp1]} in {request_line}")
 
-        if self.method not in ["GET", "HEAD", "POST", "PUT", "DELETE", "CONNECT", "OPTIONS", "TRACE"]:
-            raise InvalidRequest(f"Invalid method {self.method} in {request_line}")
+        self.version = VERSIONS.get(request_line[sp2 + 1:end])
+        if self.version is None:
+            self.version = request_line[sp2 + 1:end].decode("utf-8")
+            if self.version.find("/") != -1:
+                self.version = self.version.split("/", 1)[1]
 
-        if self.url.find("?") != -1:
-            self.path, self.query = self.url.split("?", 1)
-            self.parameters = query(self.query)
+        q = request_line.find(b"?", sp1 + 1, sp2)
+        if q != -1:
+            self.path = request_line[sp1 + 1:q].decode("utf-8")
+            self.query = request_line[q + 1:sp2].decode("utf-8")
         else:
-            self.path = self.url
+            self.path = request_line[sp1 + 1:sp2].decode("utf-8")
             self.query = ""
-            self.parameters = dict()
 
-        self.header = dict()
+        self.keep_alive = False
+        self.last_event_id = None
+        self.stream = False  # set by HTTPServer.begin_stream()
+        self.observe = True  # set to False by a handler whose duration shouldn't be observed, e.g. a stream
+        self._head = head
+        self._parameters = None
+        self._header = None
+
+    @property
+    def url(self):
+        if self.query:
+            return self.path + "?" + self.query
+        return self.path
+
+    @property
+    def parameters(self):
+        if self._parameters is None:
+            self._parameters = query(self.query)
+        return self._parameters
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = dict()
+            head = self._head
+            if head is not None:
+                for i in range(1, head.count):
+                    line = bytes(head.view[head.starts[i]:head.ends[i]])
+                    if line.find(b":") != -1:
+                        name, value = line.split(b":", 1)
+                        self._header[name] = value.strip()
+        return self._header
+
+    def get_header(self, name, default=None):
+        """ Return the value of a single header field, without parsing the others
+
+        :param bytes name: field name in lower case, e.g. b"connection"
+        :param default: value to return if the field is not present
+        :return bytes: the field value with surrounding whitespace removed
+        """
+        head = self._head
+        if head is None:
+            return default
+        n = len(name)
+        buffer = head.buffer
+        for i in range(1, head.count):
+            start = head.starts[i]
+            # only lines with a colon right after a name of the right length need a closer look
+            if head.ends[i] > start + n and buffer[start + n] == _COLON:
+                if bytes(head.view[start:start + n]).lower() == name:
+                    return bytes(head.view[start + n + 1:head.ends[i]]).strip()
+        return default
 
 
 def query(query):
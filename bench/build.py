@@ -0,0 +1,116 @@
+# Builds a deploy bundle of precompiled modules, run off-device under CPython.
+#
+# Usage, from the repository root:
+#
+#   python3 bench/build.py [--out <dir>] [--mpy-cross <path>] [--march <arch>] [--freeze]
+#
+# Every module is compiled to .mpy with mpy-cross, which has to come from the
+# same MicroPython release as the firmware, so the Pico loads bytecode
+# instead of compiling the source on every boot. main.py is compiled as
+# app.mpy, and the bundle's main.py only imports it and calls app.main(),
+# since the firmware only runs main.py as source. --march is passed on to
+# mpy-cross, armv6m for the RP2040, which only matters for @native code.
+# The bundle is written to --out, build by default, and copied to the Pico
+# with e.g.
+#
+#   mpremote fs cp -r build/* :
+#
+# With --freeze, instead of compiling, a manifest.py is written to --out
+# which freezes the same modules into a firmware image, built with e.g.
+#
+#   make -C ports/rp2 BOARD=RPI_PICO_W FROZEN_MANIFEST=<out>/manifest.py
+#
+# Frozen modules run from flash, so their bytecode doesn't take any heap
+# either. Only the bundle's main.py is then copied to the Pico.
+#
+# Prints the size of each module as source and as .mpy.
+
+import os
+import subprocess
+import sys
+
+_bench = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(_bench)
+
+PACKAGES = ("ahttpserver",)
+# Left out of the listing of modules, main.py because it is compiled last, as the app module
+EXCLUDE = ("main.py",)
+APP = "app"
+BUNDLE_MAIN = f"import {APP}\n\n{APP}.main()\n"
+
+
+def modules(root=ROOT) -> list:
+    """Return the paths of the modules to bundle, relative to root, main.py last"""
+    paths = sorted(name for name in os.listdir(root) if name.endswith(".py") and name not in EXCLUDE)
+    for package in PACKAGES:
+        paths += sorted(
+            f"{package}/{name}" for name in os.listdir(os.path.join(root, package)) if name.endswith(".py")
+        )
+    return paths + ["main.py"]
+
+
+def _target(path) -> str:
+    # The module name in the bundle, main.py becomes the app module
+    return APP + ".py" if path == "main.py" else path
+
+
+def compile_modules(out, mpy_cross="mpy-cross", march=None, root=ROOT) -> dict:
+    """Compile every module to .mpy in out, and write the bundle's main.py
+
+    Returns: dict: the source and .mpy size in bytes of each module, by its path in the bundle
+    """
+    sizes = {}
+    for path in modules(root):
+        target = os.path.join(out, _target(path)[:-3] + ".mpy")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        command = [mpy_cross, "-o", target, "-s", _target(path)]
+        if march is not None:
+            command.append(f"-march={march}")
+        subprocess.run(command + [os.path.join(root, path)], check=True)
+        sizes[_target(path)[:-3] + ".mpy"] = {
+            "source": os.path.getsize(os.path.join(root, path)),
+            "mpy": os.path.getsize(target),
+        }
+    with open(os.path.join(out, "main.py"), "w") as f:
+        f.write(BUNDLE_MAIN)
+    return sizes
+
+
+def write_manifest(out, root=ROOT) -> str:
+    """Write a manifest.py freezing every module, and the bundle's main.py, to out, returning the manifest's path"""
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(root, "main.py")) as f:
+        app = f.read()
+    with open(os.path.join(out, APP + ".py"), "w") as f:
+        f.write(app)
+    lines = ['include("$(PORT_DIR)/boards/manifest.py")']
+    for path in modules(root)[:-1]:
+        if "/" not in path:
+            lines.append(f'module("{path}", base_path="{root}")')
+    for package in PACKAGES:
+        lines.append(f'package("{package}", base_path="{root}")')
+    lines.append(f'module("{APP}.py", base_path="{os.path.abspath(out)}")')
+    manifest = os.path.join(out, "manifest.py")
+    with open(manifest, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(os.path.join(out, "main.py"), "w") as f:
+        f.write(BUNDLE_MAIN)
+    return manifest
+
+
+def main(argv):
+    def option(name, default):
+        return argv[argv.index(name) + 1] if name in argv else default
+
+    out = option("--out", os.path.join(ROOT, "build"))
+    if "--freeze" in argv:
+        print(write_manifest(out))
+        return
+    sizes = compile_modules(out, option("--mpy-cross", "mpy-cross"), option("--march", None))
+    for path, size in sizes.items():
+        print(f"{path:32} {size['source']:7} {size['mpy']:7}")
+    print(f"{'total':32} {sum(s['source'] for s in sizes.values()):7} {sum(s['mpy'] for s in sizes.values()):7}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
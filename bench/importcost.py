@@ -0,0 +1,192 @@
+# Measures what importing each module costs at boot, before and after a change, run off-device.
+#
+# Usage, from the repository root:
+#
+#   python3 bench/importcost.py [--before <git revision>] [--micropython <path>] [--mpy-cross <path>]
+#                               [--out <file.json>]
+#
+# Runs the MicroPython unix port on two trees and reports, for each module,
+# the time its import took and the heap it still holds afterwards. The
+# "before" tree is the source at --before, HEAD by default, exported with git
+# archive; the "after" tree is the working tree compiled to .mpy by
+# build.py. Each module is imported in a fresh interpreter after the
+# modules it depends on, so its row is its own cost. The "main" row is
+# main.py's own import, again in a fresh interpreter, with the modules it
+# pulled in, which shows what lazy imports have left out of booting.
+#
+# The stub machine and network modules in bench/stubs stand in for the
+# Pico's, and they, uasyncio and the other built in modules are imported
+# before anything is measured, so they aren't counted. Times on the host are
+# far shorter than on a Pico, but compare with each other.
+#
+# The probe, which runs in the interpreter, is this same file:
+#
+#   micropython bench/importcost.py --probe <dir> <module>...
+#
+# and prints a JSON object of {module: {"us": ..., "bytes": ..., "loaded": [...]}}.
+# Under CPython, for trying it out, heap is as traced by tracemalloc.
+
+import sys
+
+_bench = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+
+# In dependency order, so each module's dependencies have been imported before it
+MODULES = (
+    "logs",
+    "metrics",
+    "luxresponse",
+    "readcache",
+    "history",
+    "persist",
+    "filters",
+    "sampler",
+    "hardware",
+    "core1",
+    "wifi",
+    "ntp",
+    "udppush",
+    "ahttpserver",
+    "ahttpserver.sse",
+    "ahttpserver.sendfile",
+    "ahttpserver.static",
+    "webserver",
+)
+# Imported before measuring, as part of the interpreter rather than this repository
+PRELOAD = (
+    "array",
+    "binascii",
+    "errno",
+    "hashlib",
+    "os",
+    "random",
+    "socket",
+    "struct",
+    "_thread",
+    "utime",
+    "ujson",
+    "uasyncio",
+    "machine",
+    "network",
+)
+
+
+def probe(directory, names) -> dict:
+    """Import each module in turn from directory, returning its time and the heap it holds"""
+    import gc
+
+    sys.path.insert(0, _bench + "/stubs")
+    if sys.implementation.name != "micropython":
+        sys.path.insert(0, _bench + "/stubs/cpython")
+    sys.path.insert(0, directory)
+    for name in PRELOAD:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    import utime as time
+
+    try:
+        import tracemalloc
+
+        tracemalloc.start()
+
+        def heap():
+            gc.collect()
+            return tracemalloc.get_traced_memory()[0]
+
+    except ImportError:
+
+        def heap():
+            gc.collect()
+            return gc.mem_alloc()
+
+    results = {}
+    for name in names:
+        before = set(sys.modules)
+        used = heap()
+        start = time.ticks_us()
+        try:
+            __import__(name)
+        except ImportError as e:
+            results[name] = {"error": str(e)}
+            continue
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        results[name] = {
+            "us": elapsed,
+            "bytes": heap() - used,
+            "loaded": sorted(m for m in sys.modules if m not in before),
+        }
+    return results
+
+
+def _probe(interpreter, directory, names) -> dict:
+    import json
+    import subprocess
+
+    command = [interpreter, __file__, "--probe", directory] + list(names)
+    return json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout)
+
+
+def _run(interpreter, directory, main) -> dict:
+    # A fresh interpreter for each module, with the modules before it imported first, and for main on its own
+    results = {}
+    for i, name in enumerate(MODULES):
+        results[name] = _probe(interpreter, directory, MODULES[: i + 1])[name]
+    results["main"] = _probe(interpreter, directory, (main,))[main]
+    return results
+
+
+def compare(before_rev="HEAD", interpreter="micropython", mpy_cross="mpy-cross") -> dict:
+    """Measure the source at before_rev and the working tree as .mpy, returning both sets of results"""
+    import subprocess
+    import tempfile
+
+    sys.path.insert(0, _bench)
+    import build
+
+    with tempfile.TemporaryDirectory() as before, tempfile.TemporaryDirectory() as after:
+        archive = subprocess.run(["git", "-C", build.ROOT, "archive", before_rev], check=True, capture_output=True)
+        subprocess.run(["tar", "-x", "-C", before], input=archive.stdout, check=True)
+        build.compile_modules(after, mpy_cross)
+        return {
+            "before": {"revision": before_rev, "modules": _run(interpreter, before, "main")},
+            "after": {"revision": "working tree as .mpy", "modules": _run(interpreter, after, build.APP)},
+        }
+
+
+def _table(results) -> str:
+    before, after = results["before"]["modules"], results["after"]["modules"]
+    rows = [f"{'':22} {'before us':>10} {'bytes':>8} {'after us':>10} {'bytes':>8}"]
+    for name in MODULES + ("main",):
+        b, a = before[name], after[name]
+        cells = (b.get("us", "-"), b.get("bytes", "-"), a.get("us", "-"), a.get("bytes", "-"))
+        rows.append(f"{name:22} {cells[0]:>10} {cells[1]:>8} {cells[2]:>10} {cells[3]:>8}")
+    for label, modules in (("before", before), ("after", after)):
+        rows.append(f"main imported {label}: {' '.join(modules['main'].get('loaded', ()))}")
+    return "\n".join(rows)
+
+
+def main(argv):
+    def option(name, default):
+        return argv[argv.index(name) + 1] if name in argv else default
+
+    if "--probe" in argv:
+        import json
+
+        i = argv.index("--probe")
+        print(json.dumps(probe(argv[i + 1], argv[i + 2 :])))
+        return
+    import json
+
+    results = compare(
+        option("--before", "HEAD"), option("--micropython", "micropython"), option("--mpy-cross", "mpy-cross")
+    )
+    print(_table(results))
+    out = option("--out", None)
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump(results, f)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+# A local stand-in for an NTP server, for trying out ntp.NTPClient off-device.
+#
+# Usage:
+#
+#   python3 bench/ntp_server.py [--port <port>] [--offset-ms <ms>] [--delay-ms <ms>]
+#
+# Replies to every request with the host's clock plus offset_ms, after
+# delaying the request and the reply by half of delay_ms each to simulate the
+# network, so a client should measure an offset of about offset_ms (plus its
+# own clock's error) and a round trip delay of about delay_ms. It can also be
+# started from Python with NTPServer(...).start(), which serves from a thread.
+
+import socket
+import struct
+import sys
+import threading
+import time
+
+NTP_DELTA = 2208988800
+
+
+def _timestamp(ms):
+    # UNIX epoch milliseconds as NTP seconds and fraction
+    return ms // 1000 + NTP_DELTA, ((ms % 1000) << 32) // 1000
+
+
+class NTPServer:
+    def __init__(self, host="127.0.0.1", port=12300, offset_ms=0, delay_ms=0, stratum=2, leap=0):
+        self.offset_ms = offset_ms
+        self.delay_ms = delay_ms
+        self.stratum = stratum
+        self.leap = leap
+        self.requests = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, port))
+        self._socket.settimeout(0.1)
+        self._running = False
+        self._thread = None
+
+    def _now_ms(self):
+        return int(time.time() * 1000) + self.offset_ms
+
+    def serve(self):
+        self._running = True
+        while self._running:
+            try:
+                request, addr = self._socket.recvfrom(48)
+            except socket.timeout:
+                continue
+            if len(request) < 48:
+                continue
+            time.sleep(self.delay_ms / 2000)
+            received = _timestamp(self._now_ms())
+            reply = bytearray(48)
+            reply[0] = self.leap << 6 | 4 << 3 | 4  # version 4, server mode
+            reply[1] = self.stratum
+            reply[24:32] = request[40:48]  # origin timestamp is the request's transmit timestamp
+            struct.pack_into("!II", reply, 32, *received)
+            struct.pack_into("!II", reply, 40, *_timestamp(self._now_ms()))
+            time.sleep(self.delay_ms / 2000)
+            self._socket.sendto(reply, addr)
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self._socket.close()
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    port = int(argv[argv.index("--port") + 1]) if "--port" in argv else 12300
+    offset_ms = int(argv[argv.index("--offset-ms") + 1]) if "--offset-ms" in argv else 0
+    delay_ms = int(argv[argv.index("--delay-ms") + 1]) if "--delay-ms" in argv else 0
+    print(f"NTP stand-in on 127.0.0.1:{port}, offset {offset_ms} ms, delay {delay_ms} ms")
+    NTPServer(port=port, offset_ms=offset_ms, delay_ms=delay_ms).serve()
@@ -0,0 +1,146 @@
+# Checks persist.SegmentLog against a temporary directory, run off-device.
+#
+# Usage, from the repository root:
+#
+#   python3 bench/persist_check.py
+#
+# Writes minutes of history through small segments and reads them back into a
+# fresh History, covering: a round trip of what was written, rotation past
+# the number of segments (only the newest segments' minutes survive), a
+# truncated last record after a power cut (the complete records still load
+# and writing carries on in a fresh segment), and LXS1 segments from before
+# the change to History codes (skipped, and the first to be reused). Prints
+# each check as it passes, and stops with an AssertionError on the first
+# that fails.
+
+import sys
+
+_bench = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+_root = _bench.rsplit("/", 1)[0] if "/" in _bench else "."
+sys.path.insert(0, _root)
+if sys.implementation.name != "micropython":
+    sys.path.insert(0, _bench + "/stubs/cpython")
+
+import struct
+import tempfile
+
+import logs
+from history import EMPTY, History
+from persist import SegmentLog
+
+RESOLUTION = 0.0036
+T0 = 1700000040  # the start of a minute
+# Small, so a few dozen minutes rotate through every segment: a segment takes 2 batches of 2 records
+SEGMENTS = 3
+SEGMENT_RECORDS = 5
+BATCH_RECORDS = 2
+
+
+def _log(directory) -> SegmentLog:
+    return SegmentLog(directory, SEGMENTS, SEGMENT_RECORDS, BATCH_RECORDS)
+
+
+def _write(log, history, first, count) -> None:
+    # Add samples for count minutes from minute first, recording each as it completes, then flush
+    tier = history.tiers["1m"]
+    for m in range(first, first + count + 1):  # the last minute is only started, completing the one before
+        for s in range(0, 60, 20):
+            history.add(T0 + m * 60 + s, 10 + m * 3 + s / 10)
+        log.record(tier)
+    log.flush()
+
+
+def _minutes(history) -> list:
+    # (start, min, mean, max) of every minute held, oldest first
+    tier = history.tiers["1m"]
+    if tier.head is None:
+        return []
+    rows = []
+    for p in range(max(tier.oldest, tier.head - tier.slots + 1), tier.head + 1):
+        i = p % tier.slots
+        if tier.means[i] != EMPTY:
+            rows.append((p * tier.period, tier.mins[i], tier.means[i], tier.maxs[i]))
+    return rows
+
+
+def _load(directory) -> tuple:
+    restored = History(RESOLUTION)
+    loaded = _log(directory).load(restored)
+    return loaded, _minutes(restored)
+
+
+def check_round_trip(directory) -> None:
+    history = History(RESOLUTION)
+    _write(_log(directory), history, 0, 3)
+    written = _minutes(history)[:-1]  # the minute in progress is not recorded
+    loaded, minutes = _load(directory)
+    assert loaded == 3 and minutes == written, (loaded, minutes, written)
+    # Appending after a restart carries on in the same log
+    log = _log(directory)
+    log.load(History(RESOLUTION))
+    _write(log, history, 3, 2)
+    loaded, minutes = _load(directory)
+    assert loaded == 5 and minutes == _minutes(history)[:-1], (loaded, minutes)
+
+
+def check_rotation(directory) -> None:
+    history = History(RESOLUTION)
+    log = _log(directory)
+    _write(log, history, 0, 40)
+    written = _minutes(history)[:-1]
+    loaded, minutes = _load(directory)
+    assert loaded == sum(log._records) <= SEGMENTS * SEGMENT_RECORDS, (loaded, log._records)
+    assert loaded < len(written) and minutes == written[-loaded:], (minutes, written[-loaded:])
+    generations = sorted(log._generations)
+    assert generations == list(range(generations[0], generations[0] + SEGMENTS)), generations
+
+
+def check_truncated(directory) -> None:
+    history = History(RESOLUTION)
+    log = _log(directory)
+    _write(log, history, 0, 6)
+    written = _minutes(history)[:-1]
+    with open(log._path(log._current), "ab") as f:
+        f.write(b"\x01\x02\x03")  # part of a record, as if the power was cut while writing it
+    loaded, minutes = _load(directory)
+    assert loaded == 6 and minutes == written, (loaded, minutes)
+    # The next write starts a fresh segment rather than appending out of alignment
+    log = _log(directory)
+    log.load(History(RESOLUTION))
+    assert log._current is None
+    _write(log, history, 6, 2)
+    loaded, minutes = _load(directory)
+    assert loaded == 8 and minutes == _minutes(history)[:-1], (loaded, minutes)
+
+
+def check_lxs1_skipped(directory) -> None:
+    history = History(RESOLUTION)
+    _write(_log(directory), history, 0, 2)
+    # An LXS1 segment with a higher generation than the LXS2 one, holding a record that must not be loaded
+    with open(f"{directory}/seg1.bin", "wb") as f:
+        f.write(struct.pack("<4sI", b"LXS1", 99) + struct.pack("<IHHH", T0 + 3600, 1, 2, 3))
+    loaded, minutes = _load(directory)
+    assert loaded == 2 and minutes == _minutes(history)[:-1], (loaded, minutes)
+    # Its generation is ignored, and it is overwritten when the next segment is started
+    log = _log(directory)
+    log.load(History(RESOLUTION))
+    assert log._current == 0 and log._generations[1] == -1, (log._current, log._generations)
+    _write(log, history, 2, 4)
+    assert log._current == 1 and log._generations[1] == 1, (log._current, log._generations)
+    loaded, minutes = _load(directory)
+    assert loaded == 6 and minutes == _minutes(history)[:-1], (loaded, minutes)
+
+
+CHECKS = (check_round_trip, check_rotation, check_truncated, check_lxs1_skipped)
+
+
+def main() -> None:
+    logs.set_echo(False)
+    for check in CHECKS:
+        with tempfile.TemporaryDirectory() as directory:
+            check(directory)
+        print(check.__name__, "ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+# Load and latency benchmarks for the sensor's web server, run off-device.
+#
+# Usage, from the repository root:
+#
+#   python3 bench/run.py [--quick] [--interrupts | --core1] [--sensors] [--port <port>] [--out <file.json>]
+#   micropython bench/run.py ...
+#
+# The server is built with webserver.make_webserver exactly as main.py does,
+# on top of the stub machine and network modules in bench/stubs and a
+# simulated VEML6030 (see veml6030.py). Under CPython, stand-ins for utime,
+# uasyncio and ujson are used too. A load generator in the same process then
+# measures:
+#
+#   sensor:      requests/s and latency percentiles for /sensor/ambient_light,
+#                over keep-alive connections and with a connection per request
+#   events:      delivery latency from a sample being published to each of 1
+#                to 50 /events clients receiving it
+#   logs:        requests/s and lines/s for a full /logs buffer
+#   udp:         samples received, lost and their latency for a UDP push
+#                subscriber (see udp_receiver.py) at a 100 ms interval
+#   allocations: memory allocated per request for each route, measured by
+#                feeding requests straight to the server through in-memory
+#                streams so that the load generator's own allocations don't
+#                count. On MicroPython this is the total allocated (from
+#                gc.mem_alloc, with the collector off), on CPython it is the
+#                peak traced by tracemalloc.
+#
+# With --interrupts the sensor runs in interrupt mode, converting on its own
+# and signalling changes on a stub INT pin, instead of being polled. With
+# --core1 the sensor is read and filtered in a second thread, as on the
+# RP2040's second core. With --sensors there are four sensors, at both
+# addresses on both buses, one of which is never connected so keeps failing
+# and being retried, and the results include each sensor's stats.
+#
+# The results are printed as JSON, and also written to --out if given, so
+# runs can be compared with each other. Latencies are in milliseconds.
+
+import sys
+
+_bench = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+_root = _bench.rsplit("/", 1)[0] if "/" in _bench else "."
+sys.path.insert(0, _root)
+sys.path.insert(0, _bench + "/stubs")
+sys.path.insert(0, _bench)
+if sys.implementation.name != "micropython":
+    sys.path.insert(0, _bench + "/stubs/cpython")
+
+import gc
+
+import ujson as json
+import utime as time
+import uasyncio as asyncio
+
+import machine
+
+import hardware
+import logs
+import webserver
+from core1 import Core1Pipeline
+from filters import FilterPipeline, Mean, Median
+from history import History
+from readcache import ReadCache
+from sampler import Sampler
+from udp_receiver import Receiver, epoch_ms
+from udppush import UDPPublisher
+from veml6030 import SimulatedVEML6030
+
+DEFAULT_LUX = 300
+SENSOR_CACHE_TTL_MS = 100
+EVENTS_INTERVAL_MS = 100
+EVENTS_CLIENTS = (1, 5, 10, 25, 50)
+SENSOR_CONCURRENCY = (1, 4, 8)
+UDP_INTERVAL_MS = 100
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers, None if it is empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))]
+
+
+def summary(latencies_us, elapsed_us, count):
+    return {
+        "requests": count,
+        "req_per_s": round(count * 1000000 / elapsed_us, 1) if elapsed_us else None,
+        "p50_ms": round(percentile(latencies_us, 50) / 1000, 3) if latencies_us else None,
+        "p99_ms": round(percentile(latencies_us, 99) / 1000, 3) if latencies_us else None,
+        "max_ms": round(max(latencies_us) / 1000, 3) if latencies_us else None,
+    }
+
+
+async def read_response(reader):
+    # Read one response, return its status, body and whether the server is closing the connection.  Bodies without a
+    # Content-Length run to the end of the stream.
+    status = int((await reader.readline()).split()[1])
+    length = None
+    close = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+        elif name.strip().lower() == b"connection":
+            close = value.strip().lower() == b"close"
+    body = await reader.readexactly(length) if length is not None else await reader.read(-1)
+    return status, body, close or length is None
+
+
+async def sensor_client(port, requests, keep_alive, latencies):
+    path = b"GET /sensor/ambient_light HTTP/1.1\r\nHost: bench\r\n\r\n"
+    reader = writer = None
+    for _ in range(requests):
+        start = time.ticks_us()
+        if writer is None:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(path if keep_alive else path[:-2] + b"Connection: close\r\n\r\n")
+        await writer.drain()
+        status, _, close = await read_response(reader)
+        if close:  # as asked for, or the connection has served max_requests
+            writer.close()
+            await writer.wait_closed()
+            writer = None
+        latencies.append(time.ticks_diff(time.ticks_us(), start))
+        if status != 200:
+            raise RuntimeError(f"/sensor/ambient_light returned {status}")
+    if writer is not None:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def bench_sensor(port, requests):
+    results = []
+    for keep_alive in (True, False):
+        for concurrency in SENSOR_CONCURRENCY:
+            latencies = []
+            start = time.ticks_us()
+            await asyncio.gather(
+                *[sensor_client(port, requests // concurrency, keep_alive, latencies) for _ in range(concurrency)]
+            )
+            result = {"keep_alive": keep_alive, "concurrency": concurrency}
+            result.update(summary(latencies, time.ticks_diff(time.ticks_us(), start), len(latencies)))
+            results.append(result)
+    return results
+
+
+async def events_client(port, published, latencies, events):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /events HTTP/1.1\r\nHost: bench\r\n\r\n")
+    await writer.drain()
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    try:
+        # The first event is the latest sample, sent as soon as the client connects, so it isn't timed
+        for n in range(events + 1):
+            while (await reader.readline()) not in (b"\n", b""):
+                pass
+            if n:
+                latencies.append(time.ticks_diff(time.ticks_us(), published[0]))
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def bench_events(port, sampler, events):
+    # Record when each sample is published, by wrapping the sampler's publish step
+    published = [time.ticks_us()]
+    publish = sampler._publish
+
+    def timed_publish():
+        published[0] = time.ticks_us()
+        publish()
+
+    sampler._publish = timed_publish
+    results = []
+    try:
+        for clients in EVENTS_CLIENTS:
+            latencies = []
+            skipped = sampler.skipped
+            await asyncio.gather(*[events_client(port, published, latencies, events) for _ in range(clients)])
+            results.append(
+                {
+                    "clients": clients,
+                    "events": len(latencies),
+                    "p50_ms": round(percentile(latencies, 50) / 1000, 3),
+                    "p99_ms": round(percentile(latencies, 99) / 1000, 3),
+                    "max_ms": round(max(latencies) / 1000, 3),
+                    "skipped": sampler.skipped - skipped,
+                }
+            )
+    finally:
+        sampler._publish = publish
+    return results
+
+
+async def bench_logs(port, requests):
+    for i in range(logs._logbuffer_max):
+        logs.info("Benchmark log line %s with a value of %s lx", i, i * 0.0576)
+    latencies = []
+    lines = size = 0
+    start = time.ticks_us()
+    for _ in range(requests):
+        t = time.ticks_us()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /logs HTTP/1.1\r\nHost: bench\r\n\r\n")
+        await writer.drain()
+        status, body, _ = await read_response(reader)
+        writer.close()
+        await writer.wait_closed()
+        latencies.append(time.ticks_diff(time.ticks_us(), t))
+        lines += body.count(b"\n")
+        size += len(body)
+    elapsed = time.ticks_diff(time.ticks_us(), start)
+    result = summary(latencies, elapsed, requests)
+    result["lines_per_s"] = round(lines * 1000000 / elapsed, 1)
+    result["bytes_per_request"] = size // requests
+    return result
+
+
+async def bench_udp(port, sensor_cache, duration_ms):
+    publisher = UDPPublisher(sensor_cache.read, epoch_ms, port)
+    task = asyncio.create_task(publisher.run())
+    try:
+        await asyncio.sleep_ms(10)  # let it bind
+        result = await Receiver("127.0.0.1", port, UDP_INTERVAL_MS).run(duration_ms)
+    finally:
+        task.cancel()
+    result["publisher"] = publisher.stats()
+    return result
+
+
+class _MemoryReader:
+    # A stream reader holding a single request
+    def __init__(self, data):
+        self._data = data
+
+    async def read(self, n):
+        data, self._data = self._data[:n], self._data[n:]
+        return data
+
+
+class _NullWriter:
+    # A stream writer which discards everything
+    async def drain(self):
+        pass
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 0)
+
+
+async def bench_allocations(server, requests, paths):
+    results = {}
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    for path in paths:
+        request = f"GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n".encode()
+        await server._handle_request(_MemoryReader(request), _NullWriter())  # warm up
+        if tracemalloc is None:
+            gc.collect()
+            gc.disable()
+            before = gc.mem_alloc()
+            for _ in range(requests):
+                await server._handle_request(_MemoryReader(request), _NullWriter())
+            allocated = gc.mem_alloc() - before
+            gc.enable()
+            results[path] = {"allocated_bytes": allocated // requests}
+        else:
+            peaks = []
+            tracemalloc.start()
+            for _ in range(requests):
+                reader = _MemoryReader(request)
+                writer = _NullWriter()
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                await server._handle_request(reader, writer)
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            tracemalloc.stop()
+            results[path] = {"peak_bytes": percentile(peaks, 50)}
+    return results
+
+
+async def run(port, quick, interrupts, core1, sensors):
+    logs.set_echo(False)
+    logs.set_level(logs.INFO)
+    sensor = SimulatedVEML6030(lux=250.0)
+    allocation_paths = ["/sensor/ambient_light", "/stats", "/logs", "/history?res=raw", "/metrics"]
+    if sensors:
+        low, high = hardware.VEML6030_ADDRESS, hardware.VEML6030_ADDRESS_HIGH
+        hardware.I2C_PINS = {0: (machine.Pin(4), machine.Pin(5)), 1: (machine.Pin(26), machine.Pin(27))}
+        hardware.SENSORS = (("east", 1, low, 1), ("west", 1, high, 1), ("up", 0, low, 2), ("down", 0, high, 1))
+        machine.devices[(1, low)] = sensor
+        machine.devices[(1, high)] = SimulatedVEML6030(lux=80.0)
+        machine.devices[(0, low)] = SimulatedVEML6030(lux=5000.0)
+        allocation_paths.append("/sensor/east")
+    else:
+        machine.devices[hardware.VEML6030_ADDRESS] = sensor
+    registry = hardware.add_sensors()
+    sensor_tasks = []
+    if interrupts:
+        sensor.interrupt_pin = hardware.SENSOR_INT = machine.Pin(22)
+        sensor_tasks.append(asyncio.create_task(sensor.run()))
+    await hardware.setup_i2c()
+    if core1:
+        pipeline = Core1Pipeline(hardware.ready_sensor, (Median(5), Mean(8)))
+    else:
+        sensor_tasks.append(asyncio.create_task(hardware.watch_sensor()))
+        pipeline = FilterPipeline(hardware.read_conversion, (Median(5), Mean(8)))
+    sensor_tasks.append(asyncio.create_task(pipeline.run()))
+    sensor_cache = ReadCache(pipeline.read, SENSOR_CACHE_TTL_MS)
+    history = History(hardware.VEML6030_RESOLUTION_MIN)
+    sampler = Sampler(
+        sensor_cache.read,
+        DEFAULT_LUX,
+        interval_ms=EVENTS_INTERVAL_MS,
+        history=history,
+        sensor_values=registry.values if sensors else None,
+    )
+    server = webserver.make_webserver(
+        sensor_cache, DEFAULT_LUX, sampler, history, pipeline=pipeline, sensors=registry
+    )
+    server.host = "127.0.0.1"
+    server.port = port
+    server.max_streams = max(EVENTS_CLIENTS)  # room for the largest fan-out test
+    sampler_task = asyncio.create_task(sampler.run())
+    await server.start()
+
+    scale = 10 if quick else 1
+    results = {
+        "implementation": sys.implementation.name,
+        "version": ".".join(str(v) for v in sys.implementation.version[:3]),
+        "quick": quick,
+        "interrupts": interrupts,
+        "core1": core1,
+        "sensors": sensors,
+        "sensor": await bench_sensor(port, 2000 // scale),
+        "events": await bench_events(port, sampler, 50 // scale),
+        "logs": await bench_logs(port, 500 // scale),
+        "udp": await bench_udp(port + 1, sensor_cache, 20000 // scale),
+        "allocations": await bench_allocations(server, 200 // scale, allocation_paths),
+        "sensor_reads": sensor.reads,
+        "pipeline": pipeline.stats(),
+    }
+    if sensors:
+        results["registry"] = registry.stats()
+    sampler_task.cancel()
+    for task in sensor_tasks:
+        task.cancel()
+    await server.stop()
+    return results
+
+
+def main(argv):
+    quick = "--quick" in argv
+    interrupts = "--interrupts" in argv
+    core1 = "--core1" in argv
+    sensors = "--sensors" in argv
+    port = int(argv[argv.index("--port") + 1]) if "--port" in argv else 8080
+    out = argv[argv.index("--out") + 1] if "--out" in argv else None
+    results = asyncio.run(run(port, quick, interrupts, core1, sensors))
+    text = json.dumps(results)
+    print(text)
+    if out is not None:
+        with open(out, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
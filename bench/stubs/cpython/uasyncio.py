@@ -0,0 +1,73 @@
+# MicroPython's uasyncio on top of CPython's asyncio, for running the server off-device
+
+from asyncio import *
+import asyncio as _asyncio
+
+
+async def sleep_ms(ms):
+    await _asyncio.sleep(ms / 1000)
+
+
+async def wait_for_ms(awaitable, timeout):
+    return await _asyncio.wait_for(awaitable, timeout / 1000)
+
+
+class ThreadSafeFlag:
+    # Set from an interrupt handler, which the stub machine.Pin calls on the event loop's thread, or from another thread
+    def __init__(self):
+        self._event = _asyncio.Event()
+        self._loop = None  # the loop of the task waiting, once there is one
+
+    def set(self):
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        self._loop = _asyncio.get_running_loop()
+        await self._event.wait()
+        self._event.clear()
+
+
+async def start_server(callback, host, port, backlog=5):
+    # MicroPython takes the backlog as a positional argument
+    return await _asyncio.start_server(callback, host, port, backlog=backlog)
+
+
+# MicroPython streams accept str as well as bytes
+_write = _asyncio.StreamWriter.write
+
+
+def _write_str(self, data):
+    if isinstance(data, str):
+        data = data.encode()
+    _write(self, data)
+
+
+_asyncio.StreamWriter.write = _write_str
+
+
+class StreamReader(_asyncio.StreamReader):
+    # MicroPython wraps any socket, e.g. a UDP one, to wait until it is readable; CPython only makes these for streams
+    def __init__(self, s=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._socket = s
+
+    async def read(self, n=-1):
+        if self._socket is None:
+            return await super().read(n)
+        loop = _asyncio.get_running_loop()
+        if n == 0:
+            # MicroPython waits until the socket is readable, then reads nothing, leaving the data for the caller
+            readable = loop.create_future()
+            loop.add_reader(self._socket, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(self._socket)
+            return b""
+        return await loop.sock_recv(self._socket, n)
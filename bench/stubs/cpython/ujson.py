@@ -0,0 +1,3 @@
+# MicroPython's ujson is CPython's json
+
+from json import *
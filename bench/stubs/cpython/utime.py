@@ -0,0 +1,38 @@
+# MicroPython's utime on top of CPython's time, for running the server off-device
+
+from time import *
+import time as _time
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000) & _TICKS_MAX
+
+
+def ticks_us():
+    return int(_time.monotonic() * 1000000) & _TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    diff = (ticks1 - ticks2) & _TICKS_MAX
+    return diff - _TICKS_PERIOD if diff >= _TICKS_HALFPERIOD else diff
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
+
+
+def time():
+    # MicroPython returns whole seconds
+    return int(_time.time())
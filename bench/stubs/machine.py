@@ -0,0 +1,88 @@
+# Stand-in for MicroPython's machine module, for running the server off-device.
+#
+# I2C transfers go to the simulated devices registered in `devices` by their
+# address, e.g. devices[0x10] = SimulatedVEML6030(), or by bus and address for
+# a device on one bus only, e.g. devices[(0, 0x48)]. A device has
+# readfrom_mem(reg, n) and writeto_mem(reg, data) methods.
+
+import errno
+
+devices = {}
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._value = 1 if value is None else value
+        self._handler = None
+        self._trigger = 0
+
+    def value(self, *args):
+        if args:
+            self._value = args[0]
+            return None
+        return self._value
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self._handler = handler
+        self._trigger = trigger
+
+    def drive(self, value):
+        """Set the level on the pin from outside, calling the IRQ handler on a matching edge"""
+        edge = Pin.IRQ_RISING if value and not self._value else Pin.IRQ_FALLING if self._value and not value else 0
+        self._value = value
+        if edge & self._trigger and self._handler is not None:
+            self._handler(self)
+
+    def __repr__(self):
+        return f"Pin({self.id})"
+
+
+class I2C:
+    def __init__(self, id, sda=None, scl=None, freq=400000):
+        self.id = id
+
+    def _device(self, addr):
+        device = devices.get((self.id, addr), devices.get(addr))
+        if device is None:
+            raise OSError(errno.ENODEV)
+        return device
+
+    def readfrom_mem(self, addr, memaddr, nbytes):
+        return self._device(addr).readfrom_mem(memaddr, nbytes)
+
+    def readfrom_mem_into(self, addr, memaddr, buf):
+        buf[:] = self._device(addr).readfrom_mem(memaddr, len(buf))
+
+    def writeto_mem(self, addr, memaddr, buf):
+        self._device(addr).writeto_mem(memaddr, bytes(buf))
+
+    def scan(self):
+        return sorted(set(key[1] if isinstance(key, tuple) else key for key in devices
+                          if not isinstance(key, tuple) or key[0] == self.id))
+
+
+class RTC:
+    def __init__(self):
+        self._datetime = (2000, 1, 1, 5, 0, 0, 0, 0)
+
+    def datetime(self, datetimetuple=None):
+        if datetimetuple is None:
+            return self._datetime
+        self._datetime = tuple(datetimetuple)
+
+
+def unique_id():
+    return b"\x00\x01\x02\x03\x04\x05\x06\x07"
+
+
+def reset():
+    raise SystemExit("machine.reset()")
@@ -0,0 +1,57 @@
+# Stand-in for MicroPython's network module, for running the server off-device.
+#
+# A WLAN connects immediately, or after `connect_delay` calls to status(), and
+# reports the loopback address as its IP.
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+connect_delay = 0
+ip = "127.0.0.1"
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._active = False
+        self._status = STAT_IDLE
+        self._polls = 0
+
+    def active(self, *args):
+        if args:
+            self._active = bool(args[0])
+            return None
+        return self._active
+
+    def connect(self, ssid=None, key=None):
+        self._status = STAT_CONNECTING
+        self._polls = 0
+
+    def disconnect(self):
+        self._status = STAT_IDLE
+
+    def status(self, *args):
+        if self._status == STAT_CONNECTING:
+            self._polls += 1
+            if self._polls > connect_delay:
+                self._status = STAT_GOT_IP
+        return self._status
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self):
+        if self._status == STAT_GOT_IP:
+            return (ip, "255.255.255.0", "127.0.0.1", "127.0.0.1")
+        return ("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0")
+
+    def config(self, name):
+        if name == "mac":
+            return b"\x28\xcd\xc1\x00\x00\x01"
+        raise ValueError(name)
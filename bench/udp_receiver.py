@@ -0,0 +1,216 @@
+# Reference receiver for the sensor's UDP push mode (see udppush.py), run off-device.
+#
+# Usage, from the repository root:
+#
+#   python3 bench/udp_receiver.py <sensor host> [--port <port>] [--interval <ms>] [--lease <s>]
+#                                 [--group <address>:<port>] [--duration <s>]
+#
+# Subscribes to the sensor, renewing the lease at half its length, receives
+# samples for --duration seconds, unsubscribes, and prints a JSON summary:
+# samples received, lost (gaps in the sequence numbers), duplicated or out of
+# order, and latency percentiles from each sample's timestamp to its arrival,
+# in milliseconds. Latency is only meaningful when the two clocks agree, as
+# they do over loopback, or when both are synced with NTP. With --group the
+# samples are sent to that multicast group, which the receiver joins.
+
+import sys
+
+_bench = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+_root = _bench.rsplit("/", 1)[0] if "/" in _bench else "."
+sys.path.insert(0, _root)
+if sys.implementation.name != "micropython":
+    sys.path.insert(0, _bench + "/stubs/cpython")
+
+import socket
+import struct
+
+import ujson as json
+import utime as time
+import uasyncio as asyncio
+
+from udppush import (
+    ACK,
+    ACK_FORMAT,
+    MAGIC,
+    SAMPLE,
+    SAMPLE_FORMAT,
+    SUBSCRIBE,
+    SUBSCRIBE_FORMAT,
+    UDP_PORT,
+    UNSUBSCRIBE,
+    UNSUBSCRIBE_FORMAT,
+    VERSION,
+)
+
+POLL_MS = 1
+ACK_TIMEOUT_MS = 500
+ACK_ATTEMPTS = 5
+
+
+def epoch_ms():
+    return time.time_ns() // 1000000
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers, None if it is empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))]
+
+
+class Receiver:
+    def __init__(self, host, port=UDP_PORT, interval_ms=0, lease_s=10, group=None):
+        """
+        Args:
+            host (str): the sensor's address
+            port (int): the sensor's UDP push port
+            interval_ms (int): the interval between samples to ask for, 0 for the sensor's default
+            lease_s (int): the lease to ask for
+            group (tuple): the multicast (address, port) to have samples sent to, None for this receiver's own address
+        """
+        self.sensor = socket.getaddrinfo(host, port)[0][-1]
+        self.interval_ms = interval_ms
+        self.lease_s = lease_s
+        self.group = group
+        self.granted_interval_ms = None
+        self.granted_lease_s = None
+        self.received = 0
+        self.lost = 0
+        self.out_of_order = 0
+        self.renewals = 0
+        self.latencies = []
+        self._next_seq = None
+        self._ack = False
+        self._refused = False
+        self._sockets = []
+
+    def _group_fields(self):
+        if self.group is None:
+            return b"\x00\x00\x00\x00", 0
+        return bytes(int(part) for part in self.group[0].split(".")), self.group[1]
+
+    def _open(self):
+        # Requests go out, and ACKs and unicast samples come back, on one socket.  Multicast samples arrive on a
+        # second socket bound to the group's port.
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(socket.getaddrinfo("0.0.0.0", 0)[0][-1])
+        s.setblocking(False)
+        self._sockets.append(s)
+        if self.group is not None:
+            m = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            m.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            m.bind(socket.getaddrinfo("0.0.0.0", self.group[1])[0][-1])
+            mreq = self._group_fields()[0] + b"\x00\x00\x00\x00"
+            m.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            m.setblocking(False)
+            self._sockets.append(m)
+
+    def _request(self, kind):
+        group, port = self._group_fields()
+        if kind == SUBSCRIBE:
+            data = struct.pack(SUBSCRIBE_FORMAT, MAGIC, VERSION, SUBSCRIBE, self.interval_ms, self.lease_s, group, port)
+        else:
+            data = struct.pack(UNSUBSCRIBE_FORMAT, MAGIC, VERSION, UNSUBSCRIBE, group, port)
+        self._ack = False
+        self._sockets[0].sendto(data, self.sensor)
+
+    def _poll(self):
+        # Handle every datagram waiting on the sockets
+        for s in self._sockets:
+            while True:
+                try:
+                    data = s.recv(64)
+                except OSError:
+                    break
+                if data[:2] != MAGIC or data[2] != VERSION:
+                    continue
+                if data[3] == ACK:
+                    _, _, _, interval_ms, lease_s = struct.unpack(ACK_FORMAT, data)
+                    self._ack = True
+                    self._refused = not lease_s  # as is the ACK for an UNSUBSCRIBE
+                    if lease_s:
+                        self.granted_interval_ms, self.granted_lease_s = interval_ms, lease_s
+                elif data[3] == SAMPLE:
+                    self._sample(data)
+
+    def _sample(self, data):
+        _, _, _, seq, t, lux = struct.unpack(SAMPLE_FORMAT, data)
+        self.latencies.append(epoch_ms() - t)
+        self.received += 1
+        if self._next_seq is not None:
+            if seq < self._next_seq:
+                self.out_of_order += 1
+                return
+            self.lost += seq - self._next_seq
+        self._next_seq = seq + 1
+
+    async def _exchange(self, kind) -> bool:
+        # Send a request until it is acknowledged
+        for _ in range(ACK_ATTEMPTS):
+            self._request(kind)
+            start = time.ticks_ms()
+            while time.ticks_diff(time.ticks_ms(), start) < ACK_TIMEOUT_MS:
+                self._poll()
+                if self._ack:
+                    return True
+                await asyncio.sleep_ms(POLL_MS)
+        return False
+
+    async def run(self, duration_ms) -> dict:
+        """Subscribe, receive samples for duration_ms, unsubscribe, and return the summary"""
+        self._open()
+        try:
+            if not await self._exchange(SUBSCRIBE) or self._refused:
+                raise RuntimeError("subscription refused or not acknowledged")
+            start = renewed = time.ticks_ms()
+            while time.ticks_diff(time.ticks_ms(), start) < duration_ms:
+                if time.ticks_diff(time.ticks_ms(), renewed) >= self.granted_lease_s * 500:
+                    self._request(SUBSCRIBE)  # the ACK is picked up by _poll
+                    self.renewals += 1
+                    renewed = time.ticks_ms()
+                self._poll()
+                await asyncio.sleep_ms(POLL_MS)
+            await self._exchange(UNSUBSCRIBE)
+        finally:
+            for s in self._sockets:
+                s.close()
+            self._sockets = []
+        return self.summary()
+
+    def summary(self) -> dict:
+        expected = self.received + self.lost
+        return {
+            "interval_ms": self.granted_interval_ms,
+            "lease_s": self.granted_lease_s,
+            "received": self.received,
+            "lost": self.lost,
+            "loss_pct": round(self.lost * 100 / expected, 2) if expected else None,
+            "out_of_order": self.out_of_order,
+            "renewals": self.renewals,
+            "p50_ms": percentile(self.latencies, 50),
+            "p99_ms": percentile(self.latencies, 99),
+            "max_ms": max(self.latencies) if self.latencies else None,
+        }
+
+
+def main(argv):
+    def option(name, default):
+        return argv[argv.index(name) + 1] if name in argv else default
+
+    group = option("--group", None)
+    if group is not None:
+        address, _, port = group.partition(":")
+        group = (address, int(port))
+    receiver = Receiver(
+        argv[0],
+        int(option("--port", UDP_PORT)),
+        int(option("--interval", 0)),
+        int(option("--lease", 10)),
+        group,
+    )
+    print(json.dumps(asyncio.run(receiver.run(int(option("--duration", 10)) * 1000))))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
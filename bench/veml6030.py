@@ -0,0 +1,133 @@
+# A simulated VEML6030 ambient light sensor, for running the server off-device.
+#
+# Implements the sensor's register map as the datasheet describes it, see
+# https://www.vishay.com/docs/84366/veml6030.pdf: the ALS register holds the
+# light level of the scene in counts of the resolution set by the gain and
+# integration time in ALS_CONF, saturating at 0xFFFF, and the interrupt flags
+# in ALS_INT are set when a reading leaves the ALS_WL to ALS_WH window for
+# the configured number of readings in a row, and cleared when ALS_INT is read.
+# Conversions happen when ALS is read, or every integration period while run()
+# is running, as on the real sensor.
+# Above 1000 lx the sensor reads low, as the inverse of the application note's
+# correction polynomial (see https://www.vishay.com/docs/84305/designingveml6030.pdf).
+
+import uasyncio as asyncio
+
+ALS_CONF = 0x00
+ALS_WH = 0x01
+ALS_WL = 0x02
+PSM = 0x03
+ALS = 0x04
+WHITE = 0x05
+ALS_INT = 0x06
+ID = 0x07
+
+# ALS_CONF fields
+_GAINS = {0b00: 1, 0b01: 2, 0b10: 0.125, 0b11: 0.25}  # bits 12:11
+_INTEGRATION_MS = {0b1100: 25, 0b1000: 50, 0b0000: 100, 0b0001: 200, 0b0010: 400, 0b0011: 800}  # bits 9:6
+_PERSISTENCE = {0b00: 1, 0b01: 2, 0b10: 4, 0b11: 8}  # bits 5:4
+_INT_EN = 0x0002
+_SD = 0x0001  # shut down
+
+# ALS_INT flags
+INT_TH_LOW = 0x8000
+INT_TH_HIGH = 0x4000
+
+
+def _correct(lux):
+    # The application note's correction, from what the sensor reads to the light level
+    return ((6.0135e-13 * lux - 9.3924e-9) * lux + 8.1488e-5) * lux * lux + 1.0023 * lux
+
+
+def _nonlinear(lux):
+    # What the sensor reads for a light level, found by bisection as the correction is monotonic
+    if lux <= 1000:
+        return lux
+    lo, hi = 1000.0, lux
+    for _ in range(40):
+        mid = (lo + hi) / 2
+        if _correct(mid) < lux:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class SimulatedVEML6030:
+    def __init__(self, lux=100.0, fail_every=0, interrupt_pin=None):
+        """
+        Args:
+            lux (float or function): the light level of the scene, or a function returning it
+            fail_every (int): if not 0, every fail_every'th register access raises OSError, as a bus error would
+            interrupt_pin (machine.Pin): if given, driven low while an interrupt flag is set, as the INT pin is
+        """
+        self.lux = lux
+        self.fail_every = fail_every
+        self.interrupt_pin = interrupt_pin
+        self.registers = {ALS_CONF: _SD, ALS_WH: 0, ALS_WL: 0, PSM: 0, ALS: 0, WHITE: 0, ALS_INT: 0, ID: 0xD481}
+        self.reads = 0
+        self.writes = 0
+        self._accesses = 0
+        self._outside = 0  # readings in a row outside the threshold window
+        self._running = False
+
+    def integration_ms(self) -> int:
+        return _INTEGRATION_MS.get((self.registers[ALS_CONF] >> 6) & 0b1111, 100)
+
+    def resolution(self) -> float:
+        """Lux per count at the current gain and integration time"""
+        gain = _GAINS[(self.registers[ALS_CONF] >> 11) & 0b11]
+        return 0.0036 * (2 / gain) * (800 / self.integration_ms())
+
+    async def run(self) -> None:
+        """Convert every integration period, instead of when ALS is read, forever"""
+        self._running = True
+        try:
+            while True:
+                await asyncio.sleep_ms(self.integration_ms())
+                self.convert()
+        finally:
+            self._running = False
+
+    def convert(self) -> None:
+        """Finish a conversion: update ALS and WHITE from the scene, and the interrupt flags from the thresholds"""
+        conf = self.registers[ALS_CONF]
+        if conf & _SD:
+            return
+        lux = self.lux() if callable(self.lux) else self.lux
+        counts = min(int(_nonlinear(lux) / self.resolution()), 0xFFFF)
+        self.registers[ALS] = counts
+        self.registers[WHITE] = min(counts + counts // 8, 0xFFFF)
+        if conf & _INT_EN:
+            if counts > self.registers[ALS_WH] or counts < self.registers[ALS_WL]:
+                self._outside += 1
+            else:
+                self._outside = 0
+            if self._outside >= _PERSISTENCE[(conf >> 4) & 0b11]:
+                self.registers[ALS_INT] |= INT_TH_HIGH if counts > self.registers[ALS_WH] else INT_TH_LOW
+                if self.interrupt_pin is not None:
+                    self.interrupt_pin.drive(0)
+
+    def _access(self):
+        self._accesses += 1
+        if self.fail_every and self._accesses % self.fail_every == 0:
+            raise OSError(5)  # EIO
+
+    def readfrom_mem(self, reg, nbytes) -> bytes:
+        self._access()
+        self.reads += 1
+        if reg == ALS and not self._running:
+            self.convert()
+        value = self.registers.get(reg, 0)
+        if reg == ALS_INT:
+            self.registers[ALS_INT] = 0
+            if self.interrupt_pin is not None:
+                self.interrupt_pin.drive(1)
+        return value.to_bytes(2, "little")[:nbytes]
+
+    def writeto_mem(self, reg, data) -> None:
+        self._access()
+        self.writes += 1
+        if reg in (ALS, WHITE, ALS_INT, ID):
+            return  # read only
+        self.registers[reg] = int.from_bytes(data[:2], "little")
@@ -0,0 +1,164 @@
+from array import array
+import _thread
+
+import utime as time
+import uasyncio as asyncio
+
+import metrics
+from filters import FilterPipeline, RETRY_MS
+from logs import debug, warning
+
+# Conversions the ring holds until the network loop collects them.  At the fastest integration time of 25ms that is
+# 800ms of conversions, far longer than the loop is ever held up.
+RING_SLOTS = 32
+
+
+class SampleRing:
+    """A single producer, single consumer ring of filtered conversions, passed from core 1 to core 0 without a lock
+
+    Core1Pipeline also passes the worker's I2C read timings back in one, with the microseconds taken as raw.
+
+    All storage is allocated up front.  The producer only writes the slots and the head index, and the consumer only
+    the tail index, each as a single word store in an array, and a slot is written before the head moves past it, so
+    neither side ever sees a slot the other is using.  The indices count modulo twice the number of slots, so a full
+    ring can be told apart from an empty one.  When the ring is full the newest conversion is dropped, the producer
+    never waits.
+    """
+
+    def __init__(self, slots=RING_SLOTS):
+        self.slots = slots
+        self.ticks = array("L", [0] * slots)  # ticks_us when the conversion was read
+        self.raw = array("f", [0] * slots)
+        self.filtered = array("f", [0] * slots)
+        self.ok = bytearray(slots)  # 0 for a failed read
+        self.indices = array("L", [0, 0])  # head, tail
+        self.dropped = 0  # written by the producer only
+
+    def push(self, ticks, raw, filtered, ok) -> bool:
+        """Add a conversion, from the producer, returning False if the ring was full"""
+        head = self.indices[0]
+        if (head - self.indices[1]) % (2 * self.slots) == self.slots:
+            self.dropped += 1
+            return False
+        i = head % self.slots
+        self.ticks[i] = ticks
+        self.raw[i] = raw
+        self.filtered[i] = filtered
+        self.ok[i] = ok
+        self.indices[0] = (head + 1) % (2 * self.slots)
+        return True
+
+    def peek(self) -> int:
+        """Return the slot of the oldest conversion, from the consumer, or -1 if the ring is empty"""
+        tail = self.indices[1]
+        return -1 if tail == self.indices[0] else tail % self.slots
+
+    def advance(self) -> None:
+        """Release the slot returned by peek(), from the consumer"""
+        self.indices[1] = (self.indices[1] + 1) % (2 * self.slots)
+
+
+class Core1Pipeline(FilterPipeline):
+    """A FilterPipeline whose reading and filtering run in a thread on the RP2040's second core
+
+    The worker thread owns the sensor: it waits for each conversion, reads it over I2C, filters it and pushes it into
+    a SampleRing, so a slow I2C transaction never holds up the network loop on core 0, and nothing on core 0 touches
+    the bus.  The worker sets a ThreadSafeFlag after each push, and run() on core 0 wakes to move the conversions
+    from the ring into raw and value, where read() finds them as before.  Failed reads are passed through the ring
+    too, and logged on core 0.  The sensor is detached first, so neither it nor the worker logs or touches the metrics
+    from core 1: the time of each I2C read comes back through a second ring, for core 0 to record, and core 0 logs
+    range changes when it sees a sensor's range_changes move.  The same code runs under CPython's threads.
+    """
+
+    def __init__(self, sensor, stages=(), slots=RING_SLOTS):
+        """
+        Args:
+            sensor (function): a coroutine function returning the sensor once it is ready, whose read() and
+                next_conversion_ms() the worker uses, and detach() sends its I2C timings to the worker
+            stages (tuple): the filters to apply, in order
+            slots (int): size of the ring
+        """
+        super().__init__(None, stages)
+        self._sensor = sensor
+        self.ring = SampleRing(slots)
+        self.timings = SampleRing(slots)  # the worker's I2C reads
+        self.handoff_max_us = 0  # longest time from a conversion being read to it reaching core 0
+        self._flag = asyncio.ThreadSafeFlag()
+        self._running = False
+        self._worker_error = None  # the exception from the worker's latest failed read
+        self._detached = []  # the sensors read by the worker, whose range changes are logged here
+        self._range_changes = []
+
+    def _observe(self, us, ok) -> None:
+        # Runs on core 1, as the sensor's observer of its I2C reads
+        self.timings.push(time.ticks_us(), us, 0, ok)
+
+    def _worker(self, sensor) -> None:
+        # Runs on core 1.  No asyncio, logging or metrics here: all belong to core 0.
+        while self._running:
+            time.sleep_ms(sensor.next_conversion_ms())
+            try:
+                x = sensor.read()
+            except Exception as e:
+                self._worker_error = e
+                self.ring.push(time.ticks_us(), 0, 0, 0)
+                self._flag.set()
+                time.sleep_ms(RETRY_MS)
+                continue
+            raw = x
+            for stage in self.stages:
+                x = stage.update(x)
+            self.ring.push(time.ticks_us(), raw, x, 1)
+            self._flag.set()
+
+    async def run(self) -> None:
+        """Start the worker once the sensor is ready, then collect its conversions forever"""
+        sensor = await self._sensor()
+        self._detached = sensor.detach(self._observe)
+        self._range_changes = [s.range_changes for s in self._detached]
+        self._running = True
+        _thread.start_new_thread(self._worker, (sensor,))
+        ring = self.ring
+        try:
+            while True:
+                await self._flag.wait()
+                while True:
+                    i = ring.peek()
+                    if i < 0:
+                        break
+                    self.handoff_max_us = max(self.handoff_max_us, time.ticks_diff(time.ticks_us(), ring.ticks[i]))
+                    if ring.ok[i]:
+                        self.error = None
+                        self.raw = ring.raw[i]
+                        self.value = ring.filtered[i]
+                        self.samples += 1
+                    else:
+                        self.error = self._worker_error
+                        self.errors += 1
+                        warning("Filter pipeline read failed: %s", self.error)
+                    ring.advance()
+                    self._first.set()
+                self._record()
+        finally:
+            self._running = False
+
+    def _record(self) -> None:
+        # Record the worker's I2C reads and log its sensors' range changes, on core 0
+        timings = self.timings
+        while True:
+            i = timings.peek()
+            if i < 0:
+                break
+            metrics.observe_i2c(int(timings.raw[i]), timings.ok[i] == 1)
+            timings.advance()
+        for i, s in enumerate(self._detached):
+            if s.range_changes != self._range_changes[i]:
+                self._range_changes[i] = s.range_changes
+                debug("VEML6030 range %s, %s lx per count", s.range, s.resolution())
+
+    def stats(self) -> dict:
+        """Return the FilterPipeline stats, and the ring's dropped conversions and longest handoff"""
+        stats = super().stats()
+        stats["dropped"] = self.ring.dropped
+        stats["handoff_max_us"] = self.handoff_max_us
+        return stats
@@ -0,0 +1,152 @@
+from array import array
+
+import uasyncio as asyncio
+
+from logs import warning
+
+# How long the pipeline waits after a failed read before trying again
+RETRY_MS = 1000
+
+
+class Median:
+    """Rolling median of the last `size` samples, which removes single spikes without smoothing steps
+
+    The window is also kept sorted, in an array allocated up front, so each sample costs a shift of at most `size`
+    entries however long the stream.
+    """
+
+    def __init__(self, size=5):
+        self.ring = array("f", [0] * size)  # samples in arrival order
+        self.sorted = array("f", [0] * size)
+        self.index = 0  # where the next sample goes in the ring
+        self.count = 0  # samples in the window
+
+    def update(self, x) -> float:
+        size = len(self.ring)
+        s = self.sorted
+        n = self.count
+        if n == size:
+            # Remove the oldest sample, closing the gap
+            old = self.ring[self.index]
+            i = 0
+            while i < n - 1 and s[i] != old:
+                i += 1
+            while i < n - 1:
+                s[i] = s[i + 1]
+                i += 1
+            n -= 1
+        self.ring[self.index] = x
+        self.index = (self.index + 1) % size
+        # Insert the new one, shifting larger samples up
+        i = n
+        while i > 0 and s[i - 1] > x:
+            s[i] = s[i - 1]
+            i -= 1
+        s[i] = x
+        n += 1
+        self.count = n
+        return s[n // 2] if n % 2 else (s[n // 2 - 1] + s[n // 2]) / 2
+
+
+class Mean:
+    """Moving average of the last `size` samples, which rejects flicker
+
+    Lights dimmed by PWM, or driven from the mains, beat against the sensor's integration time, so successive
+    conversions swing around the true level.  Averaging over a window longer than the beat removes the swing.  A
+    running sum makes each sample O(1), and it is recomputed once per window so rounding errors don't build up.
+    """
+
+    def __init__(self, size=8):
+        self.ring = array("f", [0] * size)
+        self.index = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def update(self, x) -> float:
+        size = len(self.ring)
+        i = self.index
+        if self.count == size:
+            self.sum -= self.ring[i]
+        else:
+            self.count += 1
+        self.ring[i] = x
+        self.index = (i + 1) % size
+        if self.index == 0:
+            self.sum = sum(self.ring)
+        else:
+            self.sum += x
+        return self.sum / self.count
+
+
+class EMA:
+    """Exponential moving average, which smooths with a weight of alpha on each new sample"""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x) -> float:
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class FilterPipeline:
+    """Reads every sensor conversion and passes it through a chain of filters
+
+    Each stage has an update(x) method taking a sample and returning the filtered one, and the output of each stage
+    feeds the next.  Both the latest raw conversion and the filtered value are kept, so the filters can be tuned by
+    comparing the two.
+    """
+
+    def __init__(self, sample, stages=()):
+        """
+        Args:
+            sample (function): a coroutine function that waits for the sensor's next conversion and returns it
+            stages (tuple): the filters to apply, in order
+        """
+        self._sample = sample
+        self.stages = stages
+        self.raw = None  # the latest conversion, None until the first one
+        self.value = None  # the latest filtered value
+        self.error = None  # the exception from the latest read, None if it succeeded
+        self.samples = 0
+        self.errors = 0
+        self._first = asyncio.Event()  # set once there is a value, or an error to report
+
+    async def run(self) -> None:
+        """Filter every conversion, forever"""
+        while True:
+            try:
+                x = await self._sample()
+            except Exception as e:
+                self.error = e
+                self.errors += 1
+                self._first.set()
+                warning("Filter pipeline read failed: %s", e)
+                await asyncio.sleep_ms(RETRY_MS)
+                continue
+            self.error = None
+            self.raw = x
+            for stage in self.stages:
+                x = stage.update(x)
+            self.value = x
+            self.samples += 1
+            self._first.set()
+
+    async def read(self) -> float:
+        """Return the filtered value, waiting for the first conversion
+
+        Raises: Exception: the exception from the latest read, if it failed
+        """
+        if not self._first.is_set():
+            await self._first.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def stats(self) -> dict:
+        """Return the raw and filtered values, and the sample and error counters"""
+        return {"raw": self.raw, "filtered": self.value, "samples": self.samples, "errors": self.errors}
@@ -1,17 +1,55 @@
-import time
+import uasyncio as asyncio
+from utime import ticks_add, ticks_diff, ticks_ms, ticks_us
 from machine import Pin, I2C
-from logs import log
+from logs import log, debug, warning
+import metrics
 
 # VEML6030 constants - see https://www.vishay.com/docs/84305/designingveml6030.pdf
-# We set the sensor to 1x gain, 100ms integration time, 1x persistence, and disable interrupt
-# Global variables are used as they are needed in multiple functions
-VEML6030_ADDRESS = 0x10
+VEML6030_ADDRESS = 0x10  # with ADDR low, the other address is VEML6030_ADDRESS_HIGH
+VEML6030_ADDRESS_HIGH = 0x48
 VEML6030_ALS_CONF = 0x00
+VEML6030_ALS_WH = 0x01
+VEML6030_ALS_WL = 0x02
 VEML6030_ALS_REG = 0x04
-VEML6030_DEFAULT_SETTINGS = (
-    b"\x00"  # gain:1x, integration 100ms, persistence 1, disable interrupt
+VEML6030_ALS_INT = 0x06
+VEML6030_INT_EN = 0x0002  # ALS_CONF bit enabling the threshold interrupt
+VEML6030_STARTUP_MS = 5  # the sensor needs 2.5ms from power on before it accepts commands
+
+# The ranges the sensor is switched between, from the least to the most sensitive, as (ALS_CONF gain bits 12:11,
+# integration time bits 9:6, gain, integration time in ms).  Persistence is 1.
+# Sensitivity is raised with the gain first, since a longer integration time makes readings slower, and lowered with
+# the integration time first, as the application note recommends.
+VEML6030_RANGES = (
+    (0b10, 0b1100, 0.125, 25),
+    (0b10, 0b1000, 0.125, 50),
+    (0b10, 0b0000, 0.125, 100),
+    (0b11, 0b0000, 0.25, 100),
+    (0b00, 0b0000, 1, 100),
+    (0b01, 0b0000, 2, 100),
+    (0b01, 0b0001, 2, 200),
+    (0b01, 0b0010, 2, 400),
+    (0b01, 0b0011, 2, 800),
 )
-VEML6030_CONVERSION_FACTOR = 0.0576
+VEML6030_DEFAULT_RANGE = 4  # 1x gain, 100ms
+# A reading above VEML6030_RANGE_HIGH or below VEML6030_RANGE_LOW counts switches to the most sensitive range in which
+# the same light would read at most VEML6030_RANGE_TARGET counts.  Neighbouring ranges differ by at most 4x, so that
+# reading is at least VEML6030_RANGE_TARGET / 4 counts, and the gap to both thresholds keeps the next reading from
+# switching back.  A saturated reading says nothing about how much light there is, and switches to the least sensitive
+# range, which also has the shortest integration time.
+VEML6030_RANGE_HIGH = 50000
+VEML6030_RANGE_LOW = 1000
+VEML6030_RANGE_TARGET = 25000
+VEML6030_SATURATED = 0xFFFF
+# Lux per count at 2x gain and 800ms, the finest resolution
+VEML6030_RESOLUTION_MIN = 0.0036
+# In interrupt mode the sensor interrupts when a reading leaves a window of VEML6030_WINDOW (a fraction of the last
+# reading) either side of the last reading, but at least VEML6030_WINDOW_MIN_COUNTS wide
+VEML6030_WINDOW = 0.02
+VEML6030_WINDOW_MIN_COUNTS = 2
+# Without an interrupt the sensor is read anyway this often, which catches a stuck INT line
+VEML6030_REFRESH_MS = 10000
+# How long to poll for after interrupt mode fails, before trying it again
+VEML6030_RETRY_MS = 5000
 
 # I2C constants.  This implementation connects to a sensor on pins 26 and 27 of a Pi Pico.
 # Adjust the connection details to match your specific hardware
@@ -19,27 +57,436 @@ I2C_BUS = 1
 I2C_SDA = Pin(26)
 I2C_SCL = Pin(27)
 I2C_FREQ = 100000
+# The SDA and SCL pins of each bus sensors are on, e.g. add 0: (Pin(4), Pin(5)) for sensors on I2C0 too
+I2C_PINS = {I2C_BUS: (I2C_SDA, I2C_SCL)}
+# The sensors, as (name, bus, address, weight).  Each bus takes two, one at VEML6030_ADDRESS and one at
+# VEML6030_ADDRESS_HIGH, so sensors can face different ways.  Each is served at /sensor/<name>, and their readings
+# are combined into the one served at /sensor/ambient_light, see SensorRegistry.
+SENSORS = (("ambient_light", I2C_BUS, VEML6030_ADDRESS, 1),)
+# e.g. (("east", 1, VEML6030_ADDRESS, 1), ("west", 1, VEML6030_ADDRESS_HIGH, 1), ("up", 0, VEML6030_ADDRESS, 2))
+# How the readings of several sensors are combined: "mean", "max", or "weighted" for a mean by the sensors' weights
+SENSOR_AGGREGATE = "mean"
+# A sensor whose read fails is left out until it is retried SENSOR_RETRY_MS later, doubling with each failure in a
+# row up to SENSOR_RETRY_MAX_MS
+SENSOR_RETRY_MS = 1000
+SENSOR_RETRY_MAX_MS = 60000
+# The pin wired to the first sensor's INT output, for interrupt mode, or None to poll the sensor
+SENSOR_INT = None  # e.g. Pin(22, Pin.IN, Pin.PULL_UP)
+
+
+def correct_nonlinearity(lux) -> float:
+    """Return lux corrected for the sensor's non-linearity above 1000 lx, using the application note's polynomial"""
+    if lux <= 1000:
+        return lux
+    return ((6.0135e-13 * lux - 9.3924e-9) * lux + 8.1488e-5) * lux * lux + 1.0023 * lux
+
+
+class VEML6030:
+    """A VEML6030 which picks its own gain and integration time
+
+    Each reading is checked against the range thresholds, so a dark room is measured at 2x gain and 800ms (0.0036 lx
+    per count, up to 236 lx) and direct sunlight at 1/8 gain and 25ms (1.8432 lx per count, up to 120796 lx).  A
+    conversion started before a range change is scaled for the old range, so after a change the sensor is not read
+    again until a whole conversion at the new range has completed, and between conversions the last reading is
+    returned without using the bus.
+
+    In interrupt mode, see watch(), the sensor is only read when the light leaves a window around the last reading,
+    and reads return that reading.
+    """
+
+    def __init__(self, i2c, address=VEML6030_ADDRESS, range=VEML6030_DEFAULT_RANGE, auto_range=True):
+        """
+        Args:
+            i2c (I2C): the bus the sensor is on
+            address (int): the sensor's I2C address
+            range (int): index in VEML6030_RANGES of the range to start in
+            auto_range (bool): False to stay in the starting range
+        """
+        self.i2c = i2c
+        self.address = address
+        self.range = range
+        self.auto_range = auto_range
+        self.counts = None  # the latest reading, None until the first one
+        self.lux = None
+        self.saturated = False  # the latest reading was at full scale, so lux is a lower bound
+        self.range_changes = 0
+        self.watching = False  # True while in interrupt mode
+        self.interrupts = 0
+        self.refreshes = 0  # reads in interrupt mode because there was no interrupt for VEML6030_REFRESH_MS
+        self.missed = 0  # refreshes which found the light outside the window, so the interrupt was missed
+        self._int_en = 0
+        self._window = (0, 0xFFFF)  # the ALS_WL and ALS_WH thresholds in interrupt mode
+        self._due = ticks_ms()  # ticks_ms when the next conversion is complete
+        self._observer = metrics.observe_i2c  # called with the time and success of every I2C read of a conversion
+        self._logging = True
+
+    def resolution(self) -> float:
+        """Lux per count in the current range"""
+        _, _, gain, integration_ms = VEML6030_RANGES[self.range]
+        return VEML6030_RESOLUTION_MIN * (2 / gain) * (800 / integration_ms)
+
+    def integration_ms(self) -> int:
+        return VEML6030_RANGES[self.range][3]
+
+    def next_conversion_ms(self) -> int:
+        """Return how long until read() has a new value, one integration period in interrupt mode"""
+        if self.watching:
+            return self.integration_ms()
+        return max(0, ticks_diff(self._due, ticks_ms()))
+
+    def _write_conf(self, previous_ms) -> None:
+        gain_bits, it_bits, _, integration_ms = VEML6030_RANGES[self.range]
+        conf = gain_bits << 11 | it_bits << 6 | self._int_en
+        self.i2c.writeto_mem(self.address, VEML6030_ALS_CONF, conf.to_bytes(2, "little"))
+        # The conversion in progress when the settings changed finishes at the old range, the next one is the first
+        # at the new range
+        self._due = ticks_add(ticks_ms(), previous_ms + integration_ms)
+
+    def start(self) -> None:
+        """Write the settings for the current range, discarding the latest reading"""
+        self.lux = None
+        self._write_conf(self.integration_ms())
+
+    async def configure(self) -> None:
+        """Write the settings for the current range, and wait for the first whole conversion at it"""
+        self.start()
+        await asyncio.sleep_ms(ticks_diff(self._due, ticks_ms()))
+
+    def detach(self, observer) -> list:
+        """Prepare for reads from a thread on another core, which mustn't log or update the metrics
+
+        Args: observer (function): called instead of metrics.observe_i2c with the time and success of every I2C read
+
+        Returns: list: the sensors detached, whose range_changes the caller watches to log range changes instead
+        """
+        self._observer = observer
+        self._logging = False
+        return [self]
+
+    def _read_counts(self) -> int:
+        start = ticks_us()
+        try:
+            data = self.i2c.readfrom_mem(self.address, VEML6030_ALS_REG, 2)
+        except Exception:
+            self._observer(ticks_diff(ticks_us(), start), False)
+            raise
+        self._observer(ticks_diff(ticks_us(), start), True)
+        return int.from_bytes(data, "little")
+
+    def read(self) -> float:
+        """Return the light level in lux, from a new conversion if one has completed since the last read"""
+        if self.lux is not None and (self.watching or ticks_diff(self._due, ticks_ms()) > 0):
+            return self.lux
+        return self._read()
+
+    def _read(self) -> float:
+        now = ticks_ms()
+        counts = self._read_counts()
+        self.counts = counts
+        self.saturated = counts >= VEML6030_SATURATED
+        self.lux = correct_nonlinearity(counts * self.resolution())
+        self._due = ticks_add(now, self.integration_ms())
+        if self.auto_range:
+            self._adjust_range(counts)
+        return self.lux
+
+    def _adjust_range(self, counts) -> None:
+        if VEML6030_RANGE_LOW <= counts <= VEML6030_RANGE_HIGH:
+            return
+        target = 0
+        if counts < VEML6030_SATURATED:
+            lux = counts * self.resolution()
+            for i in range(len(VEML6030_RANGES)):
+                _, _, gain, integration_ms = VEML6030_RANGES[i]
+                if lux <= VEML6030_RANGE_TARGET * VEML6030_RESOLUTION_MIN * (2 / gain) * (800 / integration_ms):
+                    target = i
+        if target == self.range:
+            return
+        previous_ms = self.integration_ms()
+        self.range = target
+        self.range_changes += 1
+        if self._logging:
+            debug("VEML6030 range %s, %s lx per count", self.range, self.resolution())
+        self._write_conf(previous_ms)
+
+    async def watch(self, pin) -> None:
+        """Read the sensor when the light changes, instead of when asked, forever
+
+        The ALS_WL and ALS_WH thresholds are set to a window around the latest reading, and the sensor pulls INT low
+        when a conversion falls outside it.  The pin's IRQ wakes this task, which reads the sensor, moves the window
+        to the new reading and clears the interrupt.  If anything fails the sensor is polled until interrupt mode
+        is tried again VEML6030_RETRY_MS later.
+
+        Args: pin (Pin): the input wired to the sensor's INT output, which is open drain so needs a pull up
+        """
+        flag = asyncio.ThreadSafeFlag()
+        pin.irq(lambda _: flag.set(), Pin.IRQ_FALLING)
+        while True:
+            try:
+                await self._centre_window()
+                self.watching = True
+                try:
+                    await asyncio.wait_for_ms(flag.wait(), VEML6030_REFRESH_MS)
+                    self.interrupts += 1
+                except asyncio.TimeoutError:
+                    self.refreshes += 1
+                    self._read()
+                    if not self._window[0] <= self.counts <= self._window[1]:
+                        self.missed += 1
+            except Exception as e:
+                self.watching = False
+                warning("VEML6030 interrupt mode failed, polling for %sms: %s", VEML6030_RETRY_MS, e)
+                await asyncio.sleep_ms(VEML6030_RETRY_MS)
+
+    async def _centre_window(self) -> None:
+        # Take a reading at a range which suits it, then set the thresholds around it and clear the interrupt
+        if not self._int_en:
+            self._write_window()  # the power on thresholds of 0 would interrupt straight away
+            self._int_en = VEML6030_INT_EN
+            self._write_conf(self.integration_ms())
+        while True:
+            await asyncio.sleep_ms(max(0, ticks_diff(self._due, ticks_ms())))
+            changes = self.range_changes
+            self._read()
+            if self.range_changes == changes:
+                break
+        margin = max(int(self.counts * VEML6030_WINDOW), VEML6030_WINDOW_MIN_COUNTS)
+        self._window = (max(self.counts - margin, 0), min(self.counts + margin, 0xFFFF))
+        self._write_window()
+        self.i2c.readfrom_mem(self.address, VEML6030_ALS_INT, 2)  # reading clears the flags and releases INT
+
+    def _write_window(self) -> None:
+        self.i2c.writeto_mem(self.address, VEML6030_ALS_WL, self._window[0].to_bytes(2, "little"))
+        self.i2c.writeto_mem(self.address, VEML6030_ALS_WH, self._window[1].to_bytes(2, "little"))
+
+    def stats(self) -> dict:
+        """Return the current range and the latest reading"""
+        _, _, gain, integration_ms = VEML6030_RANGES[self.range]
+        return {
+            "gain": gain,
+            "integration_ms": integration_ms,
+            "resolution": self.resolution(),
+            "counts": self.counts,
+            "saturated": self.saturated,
+            "range_changes": self.range_changes,
+            "interrupt_mode": self.watching,
+            "interrupts": self.interrupts,
+            "refreshes": self.refreshes,
+            "missed_interrupts": self.missed,
+        }
+
+
+class _Member:
+    def __init__(self, name, sensor, weight):
+        self.name = name
+        self.sensor = sensor
+        self.weight = weight
+        self.error = None  # the exception from the latest failed read, None while the sensor is healthy
+        self.failures = 0  # failures in a row
+        self.errors = 0
+        self.restarted = False  # the settings have been written again since the latest failure
+        self.retry = 0  # ticks_ms when a failed sensor is next tried
+
+
+class SensorRegistry:
+    """Several VEML6030s, at either address on either bus, read as one sensor
+
+    Every sensor converts continuously in its own range, so conversions on different sensors overlap instead of
+    waiting for each other, and read() reads each sensor that has completed a conversion since it was last read and
+    combines the latest reading of every healthy sensor into one value.  The registry has the same read() and
+    next_conversion_ms() as a single VEML6030, so the filter pipelines take one sensor or several alike, and get a new
+    value whenever any sensor has one.
+
+    A sensor whose read fails is left out of the combined value, and the others carry on without it.  It is retried
+    SENSOR_RETRY_MS later, doubling with each failure in a row: its settings are written again, in case it lost power,
+    and it is read after a whole conversion.  read() only raises when no sensor has a reading.  Nothing here logs or
+    waits, since read() runs on core 1 in that mode, failures are counted in stats() instead, and detach() stops the
+    sensors' own logging and metrics.
+    """
+
+    def __init__(self, aggregate=SENSOR_AGGREGATE):
+        """
+        Args: aggregate (str): how the readings are combined, "mean", "max" or "weighted"
+        """
+        if aggregate not in ("mean", "max", "weighted"):
+            raise ValueError(f"Unknown aggregate {aggregate}")
+        self.aggregate = aggregate
+        self.members = []  # _Member, in the order added
+        self.lux = None  # the latest combined value
+
+    def add(self, name, sensor, weight=1) -> None:
+        """Add a sensor, which is then started by configure()"""
+        self.members.append(_Member(name, sensor, weight))
+
+    def detach(self, observer) -> list:
+        """Detach every sensor, as VEML6030.detach"""
+        detached = []
+        for member in self.members:
+            detached += member.sensor.detach(observer)
+        return detached
+
+    def get(self, name) -> VEML6030:
+        """Return the sensor added under a name, or None"""
+        for member in self.members:
+            if member.name == name:
+                return member.sensor
+        return None
+
+    async def configure(self) -> None:
+        """Start every sensor at once, and wait until their first conversions have completed
+
+        Raises: Exception: the first sensor's error, if none of them could be started
+        """
+        await asyncio.gather(*(self._configure(member) for member in self.members))
+        healthy = False
+        for member in self.members:
+            if member.error is None:
+                healthy = True
+            else:
+                warning("Sensor %s failed, retrying in %sms: %s", member.name, SENSOR_RETRY_MS, member.error)
+        if not healthy:
+            raise self.members[0].error
+
+    async def _configure(self, member) -> None:
+        try:
+            await member.sensor.configure()
+        except Exception as e:
+            self._failed(member, e, ticks_ms())
+
+    def _failed(self, member, e, now) -> None:
+        member.error = e
+        member.errors += 1
+        member.restarted = False
+        member.retry = ticks_add(now, min(SENSOR_RETRY_MS << min(member.failures, 16), SENSOR_RETRY_MAX_MS))
+        member.failures += 1
+
+    def read(self) -> float:
+        """Return the combined light level in lux, reading every sensor with a new conversion
+
+        Raises: Exception: the first failed sensor's error, if no sensor has a reading
+        """
+        now = ticks_ms()
+        for member in self.members:
+            if member.error is not None:
+                if ticks_diff(member.retry, now) > 0:
+                    continue
+                if not member.restarted:
+                    try:
+                        member.sensor.start()
+                    except Exception as e:
+                        self._failed(member, e, now)
+                        continue
+                    member.restarted = True
+                    member.retry = ticks_add(now, member.sensor.next_conversion_ms())
+                    continue
+            try:
+                member.sensor.read()
+            except Exception as e:
+                self._failed(member, e, now)
+                continue
+            member.error = None
+            member.failures = 0
+        self.lux = self._combine()
+        return self.lux
+
+    def _combine(self) -> float:
+        total = weighted = weights = count = 0
+        highest = 0
+        for member in self.members:
+            lux = member.sensor.lux
+            if member.error is not None or lux is None:
+                continue
+            count += 1
+            total += lux
+            weighted += lux * member.weight
+            weights += member.weight
+            highest = max(highest, lux)
+        if not count:
+            for member in self.members:
+                if member.error is not None:
+                    raise member.error
+            raise OSError("no sensors")
+        if self.aggregate == "max":
+            return highest
+        if self.aggregate == "weighted":
+            return weighted / weights
+        return total / count
+
+    def next_conversion_ms(self) -> int:
+        """Return how long until read() has a new value from any sensor, or a failed sensor is due to be retried"""
+        now = ticks_ms()
+        wait = SENSOR_RETRY_MAX_MS
+        for member in self.members:
+            if member.error is None:
+                wait = min(wait, member.sensor.next_conversion_ms())
+            else:
+                wait = min(wait, max(0, ticks_diff(member.retry, now)))
+        return wait
+
+    def values(self) -> dict:
+        """Return each sensor's latest reading by name, None for a sensor which is failing"""
+        return {m.name: (None if m.error is not None else m.sensor.lux) for m in self.members}
+
+    def stats(self) -> dict:
+        """Return the combined value, and each sensor's latest reading, range and failures"""
+        sensors = {}
+        for member in self.members:
+            stats = member.sensor.stats()
+            stats["lux"] = None if member.error is not None else member.sensor.lux
+            stats["error"] = None if member.error is None else str(member.error)
+            stats["errors"] = member.errors
+            sensors[member.name] = stats
+        return {"aggregate": self.aggregate, "lux": self.lux, "sensors": sensors}
+
+
+sensors = SensorRegistry()  # every sensor in SENSORS, once add_sensors has added them
+sensor = None  # the first sensor in SENSORS, which is the one run in interrupt mode
+_ready = asyncio.Event()  # set once the sensors have completed their first conversions
+
+
+async def ready_sensor() -> SensorRegistry:
+    # Returns the sensors once setup has completed their first conversions
+    if not _ready.is_set():
+        await _ready.wait()
+    return sensors
+
+
+async def read_conversion() -> float:
+    # Waits for the next conversion of any sensor and returns the combined value in lux, for consumers which want
+    # every conversion
+    if not _ready.is_set():
+        await _ready.wait()
+    await asyncio.sleep_ms(sensors.next_conversion_ms())
+    return sensors.read()
+
+
+def add_sensors() -> SensorRegistry:
+    """Create the buses and sensors in SENSORS and add them to the registry, without using the bus"""
+    global sensor
+    if sensor is None:
+        buses = {}
+        for name, bus, address, weight in SENSORS:
+            if bus not in buses:
+                sda, scl = I2C_PINS[bus]
+                log("Setting up I2C connection, Bus: %s, SDA: %s, SCL: %s, Freq: %s", bus, sda, scl, I2C_FREQ)
+                buses[bus] = I2C(bus, sda=sda, scl=scl, freq=I2C_FREQ)
+            sensors.add(name, VEML6030(buses[bus], address), weight)
+        sensor = sensors.members[0].sensor
+    return sensors
+
+
+async def setup_i2c() -> None:
+    add_sensors()
+    await asyncio.sleep_ms(VEML6030_STARTUP_MS)
+    # Other tasks run while the first conversions complete, and reads wait for _ready
+    log("I2C config done, waiting %sms for the first conversions", 2 * sensor.integration_ms())
+    await sensors.configure()
+    _ready.set()
+
 
-_i2c_instance: I2C
-
-
-async def read_sensor() -> float:
-    # Reads the sensor and converts the output to lux
-    global _i2c_instance
-    data = _i2c_instance.readfrom_mem(VEML6030_ADDRESS, VEML6030_ALS_REG, 2)
-    return int.from_bytes(data, "little") * VEML6030_CONVERSION_FACTOR
-
-
-def setup_i2c() -> None:
-    global _i2c_instance
-    log(
-        f"Setting up I2C connection, Bus: {I2C_BUS}, SDA: {I2C_SDA}, SCL: {I2C_SCL}, Freq: {I2C_FREQ}"
-    )
-    _i2c_instance = I2C(I2C_BUS, sda=I2C_SDA, scl=I2C_SCL, freq=I2C_FREQ)
-    time.sleep(1)
-    _i2c_instance.writeto_mem(
-        VEML6030_ADDRESS, VEML6030_ALS_CONF, VEML6030_DEFAULT_SETTINGS
-    )
-    # Give the sensor time to process the settings before allowing the caller to use it
-    log("I2C config done, pausing for 1s for device to settle")
-    time.sleep(1)
+async def watch_sensor() -> None:
+    """Run the sensor in interrupt mode if SENSOR_INT is set, forever, otherwise return straight away"""
+    await _ready.wait()
+    if SENSOR_INT is not None:
+        log("Sensor interrupt mode on %s", SENSOR_INT)
+        await sensor.watch(SENSOR_INT)
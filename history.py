@@ -0,0 +1,257 @@
+import struct
+from array import array
+
+# Memory use is fixed when the History is created.  With the default sizes:
+#   raw samples, 150 x (4 byte time + 2 byte value)       =  900 bytes (5 minutes at the sampler's 2 s interval)
+#   1 minute tier, 360 x (2 byte min + mean + max)        = 2160 bytes (6 hours)
+#   1 hour tier, 168 x (2 byte min + mean + max)          = 1008 bytes (7 days)
+# for a total of about 4 KB plus a few hundred bytes of object overhead.
+RAW_SLOTS = 150
+MINUTE_SLOTS = 360
+HOUR_SLOTS = 168
+
+# Values are stored as unsigned 16 bit codes for a number of counts of `resolution` lux, in a floating point format
+# with a 4 bit exponent and 12 bit mantissa: codes below 8192 are the count itself, and each further 4096 codes cover
+# twice the range of the ones before at half the resolution.  That keeps a precision of better than 1 part in 4096 from
+# `resolution` lux up to 2^27 times it (0.0036 lx to over 480,000 lx at the VEML6030's finest resolution), and the
+# codes sort in the same order as the values, so min and max can be kept without decoding.  EMPTY marks a period with
+# no samples.
+EMPTY = 0xFFFF
+_MAX_CODE = 0xFFFE
+_MAX_COUNT = (0x0FFE + 4096) << 14
+
+# Binary format: a little-endian header followed by the arrays, column by column:
+#   raw: count x uint32 time, count x uint16 value
+#   tier: count x uint16 min, count x uint16 mean, count x uint16 max
+_BINARY_HEADER = "<4sHHIIf"  # magic, count, reserved, time of the first row, period (0 for raw), resolution
+_BINARY_MAGIC = b"LXH2"
+
+# A sample whose time is at most this many seconds before the previous one's, as after a small clock correction, is
+# treated as coming at the same time as it.  Larger steps back start the history again.
+_MAX_STEP_BACK = 60
+
+# Rows of CSV written between drains
+_CSV_CHUNK_ROWS = 20
+
+
+def encode(count) -> int:
+    """Return the code for a count, rounded to the nearest value the code can hold"""
+    if count < 8192:
+        return count if count > 0 else 0
+    if count >= _MAX_COUNT:
+        return _MAX_CODE
+    shift = 1
+    while count >> shift >= 8192:
+        shift += 1
+    mantissa = (count + (1 << (shift - 1))) >> shift
+    if mantissa == 8192:  # rounded up into the next exponent
+        shift += 1
+        mantissa = 4096
+    return (shift + 1) << 12 | (mantissa - 4096)
+
+
+def decode(code) -> int:
+    """Return the count for a code"""
+    exponent = code >> 12
+    if exponent < 2:
+        return code
+    return ((code & 0x0FFF) + 4096) << (exponent - 1)
+
+
+class _Tier:
+    """Min, mean and max of the samples in consecutive periods of a fixed length
+
+    Period p, which covers the times p * period to (p + 1) * period - 1, is held in slot p % slots.  The slot for the
+    current period is updated with every sample, so it always holds the aggregate of the samples so far.  The mean is
+    taken over the counts, not their codes.
+    """
+
+    def __init__(self, period, slots):
+        self.period = period
+        self.slots = slots
+        self.mins = array("H", [EMPTY] * slots)
+        self.means = array("H", [EMPTY] * slots)
+        self.maxs = array("H", [EMPTY] * slots)
+        self.head = None  # the current period, None until the first sample
+        self.oldest = None  # the period of the first sample
+        self._count = 0
+        self._sum = 0
+
+    def add(self, t, mean, lo, hi):
+        # Add a sample (mean == lo == hi), or the aggregate of several samples from a shorter period.  The mean is a
+        # count, lo and hi are codes.
+        p = t // self.period
+        if self.head is None or p < self.head:  # first sample, or the clock has gone backwards
+            self._clear(self.slots)
+            self.oldest = p
+        elif p > self.head:
+            self._clear(min(p - self.head, self.slots))
+        self.head = p
+        i = p % self.slots
+        if self._count == 0:
+            self.mins[i] = lo
+            self.maxs[i] = hi
+        else:
+            if lo < self.mins[i]:
+                self.mins[i] = lo
+            if hi > self.maxs[i]:
+                self.maxs[i] = hi
+        self._count += 1
+        self._sum += mean
+        self.means[i] = encode(self._sum // self._count)
+
+    def _clear(self, n):
+        # Empty the n slots after the current one, ready for a new period
+        i = 0 if self.head is None else self.head
+        for _ in range(n):
+            i += 1
+            j = i % self.slots
+            self.mins[j] = self.means[j] = self.maxs[j] = EMPTY
+        self._count = 0
+        self._sum = 0
+
+    def span(self, start, end):
+        """Return the first period and number of periods held that overlap the times start to end inclusive"""
+        if self.head is None:
+            return 0, 0
+        first = max(start // self.period, self.head - self.slots + 1, self.oldest)
+        last = min(end // self.period, self.head)
+        return first, max(last - first + 1, 0)
+
+
+class History:
+    """A fixed size, in-memory time series of lux readings
+
+    Raw samples are kept at the rate they are added for the last few minutes, along with min/mean/max tiers at 1
+    minute and 1 hour resolution covering hours and days.  Times are UTC epoch seconds, as kept by the NTP client,
+    not time.time(), which is local time.
+    """
+
+    def __init__(self, resolution, raw_slots=RAW_SLOTS, minute_slots=MINUTE_SLOTS, hour_slots=HOUR_SLOTS):
+        """
+        Args:
+            resolution (float): lux per stored count, values above resolution * 2^27 lux are stored as the maximum
+            raw_slots (int): number of raw samples kept
+            minute_slots (int): number of 1 minute periods kept
+            hour_slots (int): number of 1 hour periods kept
+        """
+        self.resolution = resolution
+        self.raw_times = array("I", [0] * raw_slots)
+        self.raw_values = array("H", [EMPTY] * raw_slots)
+        self.raw_count = 0  # total number of raw samples added, the next goes in slot raw_count % raw_slots
+        self.tiers = {"1m": _Tier(60, minute_slots), "1h": _Tier(3600, hour_slots)}
+
+    def add(self, t, lux) -> None:
+        """Add a sample
+
+        Args:
+            t (int): the time of the sample, in epoch seconds
+            lux (float): the sample value
+        """
+        if self.raw_count:
+            last = self.raw_times[(self.raw_count - 1) % len(self.raw_times)]
+            if last - _MAX_STEP_BACK <= t < last:
+                t = last
+        count = min(int(lux / self.resolution + 0.5), _MAX_COUNT)
+        code = encode(count)
+        i = self.raw_count % len(self.raw_values)
+        self.raw_times[i] = t
+        self.raw_values[i] = code
+        self.raw_count += 1
+        for tier in self.tiers.values():
+            tier.add(t, count, code, code)
+
+    def restore(self, t, lo, mean, hi) -> None:
+        """Add a 1 minute aggregate read back from persistent storage to the 1 minute and coarser tiers
+
+        Args:
+            t (int): the start of the minute, in epoch seconds
+            lo (int): the code for the minimum for the minute
+            mean (int): the code for the mean for the minute
+            hi (int): the code for the maximum for the minute
+        """
+        count = decode(mean)
+        for tier in self.tiers.values():
+            tier.add(t, count, lo, hi)
+
+    def _raw_span(self, start, end):
+        # Return the first sample number and number of samples held with times from start to end inclusive
+        slots = len(self.raw_values)
+        first = max(self.raw_count - slots, 0)
+        while first < self.raw_count and self.raw_times[first % slots] < start:
+            first += 1
+        last = first
+        while last < self.raw_count and self.raw_times[last % slots] <= end:
+            last += 1
+        return first, last - first
+
+    def _lux(self, value):
+        return "" if value == EMPTY else "%.3f" % (decode(value) * self.resolution)
+
+    async def write_csv(self, writer, res, start, end) -> None:
+        """Write the samples from start to end inclusive as CSV, draining every few rows
+
+        Args:
+            writer (StreamWriter): the stream to write to
+            res (str): "raw", "1m" or "1h"
+            start (int): time of the first sample wanted, epoch seconds
+            end (int): time of the last sample wanted, epoch seconds
+        """
+        if res == "raw":
+            writer.write("time,lux\n")
+            first, count = self._raw_span(start, end)
+            slots = len(self.raw_values)
+            for n in range(first, first + count):
+                i = n % slots
+                writer.write(f"{self.raw_times[i]},{self._lux(self.raw_values[i])}\n")
+                if n % _CSV_CHUNK_ROWS == 0:
+                    await writer.drain()
+        else:
+            writer.write("time,min,mean,max\n")
+            tier = self.tiers[res]
+            first, count = tier.span(start, end)
+            for p in range(first, first + count):
+                i = p % tier.slots
+                if tier.means[i] != EMPTY:
+                    writer.write(
+                        f"{p * tier.period},{self._lux(tier.mins[i])},{self._lux(tier.means[i])},{self._lux(tier.maxs[i])}\n"
+                    )
+                if p % _CSV_CHUNK_ROWS == 0:
+                    await writer.drain()
+        await writer.drain()
+
+    def binary_length(self, res, start, end) -> int:
+        """Return the number of bytes write_binary will write for the same arguments"""
+        if res == "raw":
+            return struct.calcsize(_BINARY_HEADER) + 6 * self._raw_span(start, end)[1]
+        return struct.calcsize(_BINARY_HEADER) + 6 * self.tiers[res].span(start, end)[1]
+
+    async def write_binary(self, writer, res, start, end) -> None:
+        """Write the samples from start to end inclusive in the packed binary format, straight from the arrays
+
+        Values are codes, see encode() and decode(), and periods without samples have EMPTY as their min, mean and
+        max.  Args are as for write_csv.
+        """
+        if res == "raw":
+            first, count = self._raw_span(start, end)
+            slots = len(self.raw_values)
+            t0 = self.raw_times[first % slots] if count else 0
+            writer.write(struct.pack(_BINARY_HEADER, _BINARY_MAGIC, count, 0, t0, 0, self.resolution))
+            columns = (self.raw_times, self.raw_values)
+        else:
+            tier = self.tiers[res]
+            first, count = tier.span(start, end)
+            slots = tier.slots
+            writer.write(
+                struct.pack(_BINARY_HEADER, _BINARY_MAGIC, count, 0, first * tier.period, tier.period, self.resolution)
+            )
+            columns = (tier.mins, tier.means, tier.maxs)
+        for column in columns:
+            view = memoryview(column)
+            # the rows wanted may wrap around the end of the ring
+            i = first % slots
+            n = min(count, slots - i)
+            writer.write(view[i:i + n])
+            if n < count:
+                writer.write(view[:count - n])
+            await writer.drain()
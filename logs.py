@@ -1,28 +1,133 @@
+from array import array
+
 import utime as time
 
-_logbuffer: list = []
+# Log levels, as in CPython's logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_level_names = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+_level = INFO  # messages below this level are discarded without any formatting
+_echo = True  # whether messages are also printed to the console as they are logged
+
+# The log buffer is a ring of the last _logbuffer_max messages, held unformatted: the time, level, message and its
+# arguments are stored as given, and only turned into a log line when the line is read.
 _logbuffer_max = 100
+_times = array("L", [0] * _logbuffer_max)
+_levels = bytearray(_logbuffer_max)
+_messages: list = [None] * _logbuffer_max
+_args: list = [None] * _logbuffer_max
+_next_seq = 0  # sequence number of the next message, which goes in slot _next_seq % _logbuffer_max
 
 
-def logbuffer() -> list:
-    return _logbuffer
+def set_level(level: int) -> None:
+    """Set the lowest level of message that is logged
 
+    Args: level (int): one of DEBUG, INFO, WARNING or ERROR
 
-def log(log_message: str) -> None:
-    """Log a message to the console and the log buffer with the local time added, and restrict the log buffer to the last _logbuffer_max messages.
+    Returns: None
+    """
+    global _level
+    _level = level
 
-    Args: log_message (str): the message to log
+
+def set_echo(echo: bool) -> None:
+    """Turn printing of log messages to the console on or off.  Messages are always kept in the log buffer.
+
+    Args: echo (bool): True to print messages as they are logged
 
     Returns: None
     """
-    global _logbuffer
-    if len(_logbuffer) > _logbuffer_max:
-        _logbuffer.pop(0)
-    now = time.gmtime()
+    global _echo
+    _echo = echo
+
+
+def log_window(since: int = 0, limit: int = _logbuffer_max) -> tuple:
+    """Work out which buffered log lines to return to a caller that has seen everything before since
+
+    Lines that have already dropped out of the buffer are skipped, so a caller that polls less often than the
+    buffer turns over sees a gap in the sequence numbers.
+
+    Args:
+        since (int): sequence number of the first line wanted
+        limit (int): maximum number of lines wanted
+
+    Returns: tuple: the sequence number of the first line to return, and one past the last
+    """
+    first = max(since, _next_seq - _logbuffer_max, 0)
+    return first, min(_next_seq, first + limit)
+
+
+def log_line(seq: int):
+    """Format the log line with the given sequence number
+
+    Args: seq (int): the sequence number of the line
+
+    Returns: str: the log line, or None if it has dropped out of the buffer or hasn't been logged yet
+    """
+    if _next_seq - _logbuffer_max <= seq < _next_seq:
+        i = seq % _logbuffer_max
+        return _format(_times[i], _levels[i], _messages[i], _args[i])
+    return None
+
+
+def _format(secs: int, level: int, message: str, args: tuple) -> str:
+    now = time.gmtime(secs)
     # convert datetime tuple to iso 8601 string
     date_str = (
         f"{now[0]}-{now[1]:02d}-{now[2]:02d}T{now[3]:02d}:{now[4]:02d}:{now[5]:02d}Z"
     )
-    log_line = f"{date_str}: {log_message}"
-    print(log_line)
-    _logbuffer.append(log_line)
+    if args:
+        try:
+            message = message % args
+        except Exception:
+            message = f"{message} {args}"
+    return f"{date_str}: {_level_names.get(level, level)}: {message}"
+
+
+def log(log_message: str, *args, level: int = INFO) -> None:
+    """Log a message to the log buffer with the local time added, and to the console if echo is on.  The log buffer is a fixed size ring, so the oldest message is overwritten once it holds _logbuffer_max messages.
+
+    Formatting is deferred until the message is read, so pass any values as arguments rather than formatting them
+    into the message, e.g. log("Read %s lx", lux).  A message below the current level costs only the call.
+
+    Args:
+        log_message (str): the message to log, a %-format string if there are args
+        args: values to format into the message
+        level (int): one of DEBUG, INFO, WARNING or ERROR
+
+    Returns: None
+    """
+    global _next_seq
+    if level < _level:
+        return
+    i = _next_seq % _logbuffer_max
+    _times[i] = time.time()
+    _levels[i] = level
+    _messages[i] = log_message
+    _args[i] = args
+    _next_seq += 1
+    if _echo:
+        print(_format(_times[i], level, log_message, args))
+
+
+def debug(log_message: str, *args) -> None:
+    if DEBUG >= _level:
+        log(log_message, *args, level=DEBUG)
+
+
+def info(log_message: str, *args) -> None:
+    if INFO >= _level:
+        log(log_message, *args, level=INFO)
+
+
+def warning(log_message: str, *args) -> None:
+    if WARNING >= _level:
+        log(log_message, *args, level=WARNING)
+
+
+def error(log_message: str, *args) -> None:
+    if ERROR >= _level:
+        log(log_message, *args, level=ERROR)
@@ -0,0 +1,108 @@
+# Largest value that fits the numeric fields, in thousandths of a lux.  The VEML6030 tops out at around 120k lux.
+_MAX_MILLI_LUX = 9999999999
+_NUMBER_WIDTH = len("9999999.999")
+
+_ID_HEAD = b'{"id": "sensor-'
+_ID_TAIL = b'", "state": "'
+_STATE_TAIL = b' lx"'
+_VALUE_HEAD = b', "value": '
+_BODY_TAIL = b"}"
+# JSON allows whitespace after the state string and before the value, which is what lets both fields have a fixed
+# width: the state field is padded after its closing quote, the value field before the number
+_STATE_WIDTH = _NUMBER_WIDTH + len(_STATE_TAIL)
+
+_SPACE = 0x20
+_ZERO = 0x30
+_POINT = 0x2E
+
+
+class LuxResponse:
+    """A complete HTTP response for the lux endpoint, pre-encoded into a single buffer
+
+    The status line, headers and every constant part of the JSON body are written once, when the object is created.
+    Because the numeric fields have a fixed width the Content-Length never changes, so rendering a new value only
+    patches the digits in place and the caller can send the whole response with a single write, without building
+    any dicts or strings on the heap.
+
+    The body is equivalent to the JSON lunar expects, e.g.
+        {"id": "sensor-ambient_light", "state": "57.600 lx"     , "value":      57.600}
+    """
+
+    def __init__(self, keep_alive=False, name="ambient_light"):
+        """
+        Args:
+            keep_alive (bool): whether the response tells the client the connection stays open
+            name (str): the sensor's name, in its id
+        """
+        body_head = _ID_HEAD + name.encode() + _ID_TAIL
+        body_length = len(body_head) + _STATE_WIDTH + len(_VALUE_HEAD) + _NUMBER_WIDTH + len(_BODY_TAIL)
+        head = (
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/json\r\n"
+            + (b"Connection: keep-alive\r\n" if keep_alive else b"Connection: close\r\n")
+            + b"Content-Length: " + str(body_length).encode() + b"\r\n"
+            b"\r\n"
+        )
+        self._buffer = bytearray(
+            head
+            + body_head
+            + b" " * _STATE_WIDTH
+            + _VALUE_HEAD
+            + b" " * _NUMBER_WIDTH
+            + _BODY_TAIL
+        )
+        self._view = memoryview(self._buffer)
+        self._state_start = len(head) + len(body_head)
+        self._value_end = len(self._buffer) - len(_BODY_TAIL)
+
+    def render(self, lux) -> memoryview:
+        """Patch a lux value into the response
+
+        Args: lux (float): the lux value to send, rounded to three decimal places
+
+        Returns: memoryview: the complete response, valid until the next call to render
+        """
+        milli = int(lux * 1000 + 0.5)
+        if milli < 0:
+            milli = 0
+        elif milli > _MAX_MILLI_LUX:
+            milli = _MAX_MILLI_LUX
+        buf = self._buffer
+
+        # Write the value field right to left, three decimals then at least one whole digit, padded with spaces
+        end = self._value_end
+        start = end - _NUMBER_WIDTH
+        i = end - 1
+        n = milli
+        while i > end - 4:
+            buf[i] = _ZERO + n % 10
+            n //= 10
+            i -= 1
+        buf[i] = _POINT
+        i -= 1
+        while True:
+            buf[i] = _ZERO + n % 10
+            n //= 10
+            i -= 1
+            if n == 0:
+                break
+        first = i + 1
+        while i >= start:
+            buf[i] = _SPACE
+            i -= 1
+
+        # Copy the same digits to the front of the state field, followed by the unit and closing quote
+        j = self._state_start
+        i = first
+        while i < end:
+            buf[j] = buf[i]
+            i += 1
+            j += 1
+        for c in _STATE_TAIL:
+            buf[j] = c
+            j += 1
+        while j < self._state_start + _STATE_WIDTH:
+            buf[j] = _SPACE
+            j += 1
+
+        return self._view
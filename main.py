@@ -3,42 +3,203 @@ import uasyncio as asyncio
 import ujson as json
 import machine
 
+import logs
 from logs import log
 
 import webserver
+import filters
 import wifi
-import ntp
 import hardware
+import metrics
+from history import History
+from persist import SegmentLog
+from readcache import ReadCache
+from sampler import Sampler
 
 # Timezone offset in hours from UTC (used for logging)
 TZ_OFFSET = 8
 
+# NTP servers as (host, port), and seconds between syncs
+NTP_SERVERS = (("pool.ntp.org", 123), ("time.cloudflare.com", 123), ("time.google.com", 123))
+NTP_SYNC_INTERVAL_S = 3600
+
+# Lowest level of log message kept, and whether log messages are also printed to the console
+LOG_LEVEL = logs.INFO
+LOG_ECHO = True
+
 # Default lux value to use if the sensor_reader fails on the first call.  On subsequent calls the last value will be used.
 DEFAULT_LUX = 300
 
-if __name__ == "__main__":
+# How long a sensor reading is reused for other requests.  The sensor itself only uses the bus once per conversion.
+SENSOR_CACHE_TTL_MS = 100
+
+# Filters applied in order to every sensor conversion before it is served, see filters.py.  The median removes spikes,
+# and the mean flicker from PWM-dimmed and mains lighting.  An empty tuple serves the raw conversions.
+SENSOR_FILTERS = (filters.Median(5), filters.Mean(8))
+
+# Read and filter the sensor in a thread on the second core, so I2C never holds up the network loop, see core1.py.
+# Interrupt mode is not used on the second core.
+SENSOR_CORE1 = False
+
+# Port to push samples to UDP subscribers from, see udppush.py, or None to turn UDP push off
+UDP_PUSH_PORT = None  # e.g. 5765, udppush.UDP_PORT
+
+# Directory on the flash filesystem whose files are served from /, e.g. a dashboard, see README.md, or None
+STATIC_DIR = "/www"
+
+# Directory on the flash filesystem where the 1 minute history is kept across resets
+HISTORY_DIR = "/history"
+
+# Set when the history is persisted, so batched minutes can be saved before a reset
+history_log = None
+
+
+class BootTimeline:
+    """Logs when each stage of the boot sequence finished, and how long it took"""
+
+    def __init__(self):
+        self.started = time.ticks_ms()
+
+    def done(self, name, stage_started) -> None:
+        now = time.ticks_ms()
+        log(
+            "Boot: %s done in %s ms, at %s ms",
+            name,
+            time.ticks_diff(now, stage_started),
+            time.ticks_diff(now, self.started),
+        )
+
+    async def stage(self, name, coroutine):
+        """Run a stage and log its timing, returning its result"""
+        stage_started = time.ticks_ms()
+        result = await coroutine
+        self.done(name, stage_started)
+        return result
+
+
+async def boot(wifi_ssid, wifi_password) -> None:
+    """Start everything, then run until a task fails
+
+    The sensors are configured while WiFi associates, and the server starts as soon as there is an IP address.  WiFi is
+    supervised from then on, and reconnected in place if it drops, restarting the server if the IP address changes.  Until
+    the sensors' first conversions are ready, sensor reads wait for them.  History is only recorded once the clock has
+    been set by the first successful NTP sync, so samples are not stored under the wrong time.
+    """
+    timeline = BootTimeline()
+    if SENSOR_CORE1:
+        import core1
+
+        pipeline = core1.Core1Pipeline(hardware.ready_sensor, SENSOR_FILTERS)
+    else:
+        pipeline = filters.FilterPipeline(hardware.read_conversion, SENSOR_FILTERS)
+    sensor_cache = ReadCache(pipeline.read, SENSOR_CACHE_TTL_MS)
+    history = History(hardware.VEML6030_RESOLUTION_MIN)
+    sensors = hardware.add_sensors()
+    link = wifi.WifiSupervisor(wifi_ssid, wifi_password)
+    ntp_client = None  # created once the server is up
+
+    def epoch_ms():
+        return ntp_client.now_ms()
+
+    def epoch_s():
+        # UTC, unlike time.time(), as the RTC holds local time.  Nothing is recorded before NTP has synced.
+        return ntp_client.now_ms() // 1000 if ntp_client is not None else time.time() - TZ_OFFSET * 3600
+
+    # With several sensors, every event also carries each one's own reading
+    sensor_values = sensors.values if len(sensors.members) > 1 else None
+    sampler = Sampler(sensor_cache.read, DEFAULT_LUX, sensor_values=sensor_values, clock=epoch_s)
+    publisher = None
+    if UDP_PUSH_PORT is not None:
+        # Modules only some configurations use, like this one and core1, and ntp and static, which aren't needed until
+        # the server is up, are imported where they are first used, so booting doesn't spend time and heap compiling
+        # them before anything is served.  See README.md.
+        import udppush
+
+        publisher = udppush.UDPPublisher(sensor_cache.read, epoch_ms, UDP_PUSH_PORT)
+    server = webserver.make_webserver(sensor_cache, DEFAULT_LUX, sampler, history, link, pipeline, publisher, sensors)
+
+    async def restart_server(ip):
+        log("Restarting server for new IP address %s", ip)
+        await server.stop()
+        await server.start()
+
+    link.on_ip_change = restart_server
+
+    async def serve_static():
+        # Listing and hashing the files takes a while, so it is done once the server is already answering
+        stage_started = time.ticks_ms()
+        from ahttpserver.static import StaticFiles
+
+        log("Static files: %s routes for %s", StaticFiles(STATIC_DIR).register(server), STATIC_DIR)
+        timeline.done("static", stage_started)
+
+    # always keep a reference to the tasks so they don't get garbage collected
+    sensor_task = asyncio.create_task(timeline.stage("sensor", hardware.setup_i2c()))
+    sensor_tasks = [asyncio.create_task(pipeline.run())]
+    if not SENSOR_CORE1:  # the worker on core 1 owns the sensor
+        sensor_tasks.append(asyncio.create_task(hardware.watch_sensor()))
+    sampler_task = asyncio.create_task(sampler.run())
+    metrics_task = asyncio.create_task(metrics.monitor())
+
+    wifi_task = asyncio.create_task(link.run())
+    await timeline.stage("wifi", link.connected.wait())
+    await timeline.stage("server", server.start())
+    import ntp
+
+    ntp_client = ntp.NTPClient(NTP_SERVERS, TZ_OFFSET, NTP_SYNC_INTERVAL_S)
+    server_tasks = []
+    if STATIC_DIR is not None:  # finishes once the routes are registered
+        server_tasks.append(asyncio.create_task(serve_static()))
+    if publisher is not None:  # bound to all interfaces, so it carries on across a change of IP address
+        server_tasks.append(asyncio.create_task(publisher.run()))
+    if not await timeline.stage("ntp", ntp_client.sync()):
+        log("Failed to set RTC, retrying in the background", level=logs.WARNING)
+    ntp_task = asyncio.create_task(ntp_client.run())
+
+    async def record_history():
+        # Wait for the clock, so neither the restored minutes nor new samples are stored under the wrong time
+        global history_log
+        await ntp_client.synced.wait()
+        stage_started = time.ticks_ms()
+        history_log = SegmentLog(HISTORY_DIR)
+        history_log.load(history)
+        timeline.done("history", stage_started)
+        sampler.history = history
+        await history_log.run(history.tiers["1m"])
+
+    history_task = asyncio.create_task(record_history())
+
+    await sensor_task  # raises if none of the sensors could be set up
+    log("Boot: complete at %s ms", time.ticks_diff(time.ticks_ms(), timeline.started))
+    # these run forever, so this only returns by raising the exception of the first one to fail
+    await asyncio.gather(sampler_task, metrics_task, wifi_task, ntp_task, history_task, *sensor_tasks, *server_tasks)
+
+
+def main() -> None:
+    """Run the sensor until something fails, then reset"""
+    logs.set_level(LOG_LEVEL)
+    logs.set_echo(LOG_ECHO)
+
     # See README.md for wifi credential file format and handling
     with open("wifi.json", "r") as f:
         wifi_config = json.load(f)
-        WIFI_SSID = wifi_config["ssid"]
-        WIFI_PASSWORD = wifi_config["password"]
+        wifi_ssid = wifi_config["ssid"]
+        wifi_password = wifi_config["password"]
 
     try:
-        hardware.setup_i2c()
-        wifi.setup_wifi(WIFI_SSID, WIFI_PASSWORD)
-        try:
-            ntp_time = ntp.get_ntp_time()
-            ntp.set_system_clock(ntp_time, TZ_OFFSET)
-        except Exception as e:
-            log(f"Failed to set RTC: {str(e)}")
-        server = webserver.make_webserver(hardware.read_sensor, DEFAULT_LUX)
-        loop = asyncio.get_event_loop()
-        task = loop.create_task(
-            server.start()
-        )  # always keep a reference to the task so it doesn't get garbage collected
-        loop.run_forever()  # this blocks until an exception is encountered
+        asyncio.run(boot(wifi_ssid, wifi_password))
     except Exception as e:
         # all sorts of things could have happened, best to log what we know, wait a bit, and reset the device
-        log(f"RESETTING: {str(e)}")
+        log("RESETTING: %s", e, level=logs.ERROR)
+        if history_log is not None:
+            try:
+                history_log.flush()  # keep the batched minutes
+            except Exception:
+                pass
         time.sleep(10)
         machine.reset()
+
+
+# Run as main.py, or imported as app by the main.py of a bundle built by bench/build.py, which then calls main()
+if __name__ == "__main__":
+    main()
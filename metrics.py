@@ -0,0 +1,160 @@
+import gc
+from array import array
+
+import utime as time
+import uasyncio as asyncio
+
+# Upper bounds of the latency histogram buckets, in microseconds.  Observations above the last bound go in +Inf.
+LATENCY_BUCKETS_US = (250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 1000000, 5000000)
+_BUCKET_LABELS = tuple("%g" % (bound / 1000000) for bound in LATENCY_BUCKETS_US) + ("+Inf",)
+
+# How often the event loop lag monitor wakes up
+LAG_INTERVAL_MS = 100
+
+_PREFIX = "lunarsensor_"
+
+
+class Histogram:
+    """A latency histogram with fixed buckets
+
+    All storage is allocated up front, so observe() allocates nothing: bucket counts live in an array, and the sum is
+    kept as whole seconds plus microseconds so it never grows beyond a small int.
+    """
+
+    def __init__(self):
+        self.counts = array("L", [0] * (len(LATENCY_BUCKETS_US) + 1))
+        self.sum_s = 0
+        self.sum_us = 0
+
+    def observe(self, us) -> None:
+        """Record one observation, in microseconds, ignoring a negative one from a ticks_diff across a wrap"""
+        if us < 0:
+            return
+        i = 0
+        for bound in LATENCY_BUCKETS_US:
+            if us <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum_us += us
+        if self.sum_us >= 1000000:
+            self.sum_s += self.sum_us // 1000000
+            self.sum_us %= 1000000
+
+    def write(self, writer, name, labels="") -> None:
+        """Write the histogram's samples in the Prometheus text format"""
+        sep = "," if labels else ""
+        total = 0
+        for i in range(len(self.counts)):
+            total += self.counts[i]
+            writer.write(f'{name}_bucket{{{labels}{sep}le="{_BUCKET_LABELS[i]}"}} {total}\n')
+        braces = f"{{{labels}}}" if labels else ""
+        writer.write(f"{name}_sum{braces} {self.sum_s}.{self.sum_us:06d}\n")
+        writer.write(f"{name}_count{braces} {total}\n")
+
+
+# Request latency per route, created the first time each route is requested.  Requests for unknown paths share one
+# histogram so that scanning clients can't create any more.
+_requests = {}
+_unrouted = Histogram()
+
+i2c_latency = Histogram()
+i2c_errors = 0
+loop_lag = Histogram()
+_uptime_s = 0
+_uptime_ms = 0
+
+
+def observe_request(route, us) -> None:
+    """Record the time taken to handle a request, used as the HTTPServer's request observer
+
+    Args:
+        route (tuple): the (method, path) of the route that handled the request, None if no route matched
+        us (int): time taken in microseconds
+    """
+    if route is None:
+        _unrouted.observe(us)
+        return
+    histogram = _requests.get(route)
+    if histogram is None:
+        histogram = _requests[route] = Histogram()
+    histogram.observe(us)
+
+
+def observe_i2c(us, ok) -> None:
+    """Record the time taken by an I2C sensor read, and whether it succeeded"""
+    global i2c_errors
+    i2c_latency.observe(us)
+    if not ok:
+        i2c_errors += 1
+
+
+async def monitor() -> None:
+    """Measure event loop lag, and keep count of uptime, forever
+
+    The lag is how much later than asked for a sleep wakes up, which is how long other tasks held on to the loop.
+    """
+    global _uptime_s, _uptime_ms
+    while True:
+        start = time.ticks_ms()
+        await asyncio.sleep_ms(LAG_INTERVAL_MS)
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        loop_lag.observe(max(elapsed - LAG_INTERVAL_MS, 0) * 1000)
+        _uptime_ms += elapsed
+        if _uptime_ms >= 1000:
+            _uptime_s += _uptime_ms // 1000
+            _uptime_ms %= 1000
+
+
+def label(name, value) -> str:
+    """Return name="value" as a label for a metric's sample, with the value escaped"""
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{name}="{value}"'
+
+
+def _write_metric(writer, name, kind, help, value, labels=""):
+    # A list of (labels, value) is written as one family, with a sample for each
+    writer.write(f"# HELP {_PREFIX}{name} {help}\n# TYPE {_PREFIX}{name} {kind}\n")
+    samples = value if isinstance(value, list) else [(labels, value)]
+    for labels, value in samples:
+        if labels:
+            writer.write(f"{_PREFIX}{name}{{{labels}}} {value}\n")
+        else:
+            writer.write(f"{_PREFIX}{name} {value}\n")
+
+
+async def write_metrics(writer, gauges=()) -> None:
+    """Write every metric in the Prometheus text format
+
+    Args:
+        writer (StreamWriter): the stream to write to
+        gauges (list): extra (name, type, help, value) metrics from other parts of the application.  A value may be a
+            list of (labels, value) samples instead, written as one family, with labels as made by label()
+    """
+    name = _PREFIX + "http_request_duration_seconds"
+    writer.write(f"# HELP {name} Time taken to handle HTTP requests, by route\n# TYPE {name} histogram\n")
+    for (method, path), histogram in _requests.items():
+        histogram.write(writer, name, f'method="{method}",path="{path}"')
+        await writer.drain()
+    _unrouted.write(writer, name, 'method="",path=""')
+    await writer.drain()
+
+    name = _PREFIX + "i2c_read_duration_seconds"
+    writer.write(f"# HELP {name} Time taken by I2C sensor reads\n# TYPE {name} histogram\n")
+    i2c_latency.write(writer, name)
+    _write_metric(writer, "i2c_read_errors_total", "counter", "Failed I2C sensor reads", i2c_errors)
+    await writer.drain()
+
+    name = _PREFIX + "event_loop_lag_seconds"
+    writer.write(f"# HELP {name} How late the event loop ran a task that was due\n# TYPE {name} histogram\n")
+    loop_lag.write(writer, name)
+    await writer.drain()
+
+    # mem_free and mem_alloc are MicroPython extensions
+    if hasattr(gc, "mem_free"):
+        _write_metric(writer, "heap_free_bytes", "gauge", "Free heap", gc.mem_free())
+        _write_metric(writer, "heap_allocated_bytes", "gauge", "Allocated heap", gc.mem_alloc())
+    _write_metric(writer, "uptime_seconds", "counter", "Time since the metrics monitor started", _uptime_s)
+    for gauge in gauges:
+        _write_metric(writer, *gauge)
+    await writer.drain()
@@ -1,42 +1,196 @@
-import socket, struct, time
+import socket, struct
+import utime as time
+import uasyncio as asyncio
 from machine import RTC
 
-from logs import log
+from logs import log, debug, info, warning
 
+# Servers to query, as (host, port)
+NTP_SERVERS = (("pool.ntp.org", 123),)
+# Time between syncs, and between attempts while syncs are failing
+NTP_SYNC_INTERVAL_S = 3600
+NTP_RETRY_INTERVAL_S = 60
 
-def get_ntp_time() -> int:
-    """Make 3 attempts to get the current time from pool.ntp.org and set the system clock if successful,
-    otherwise raise an exception
+NTP_DELTA = 2208988800  # seconds from the NTP epoch (1900) to the UNIX epoch (1970)
+_MODE_CLIENT = 3
+_MODE_SERVER = 4
+_VERSION = 4
+_LI_UNSYNCHRONIZED = 3
+# The offset from the local clock is only turned into a drift rate once this much time has passed since the last sync
+_MIN_DRIFT_INTERVAL_MS = 600000
+_MAX_DRIFT_PPM = 1000
+# The local clock is rebased this often, well within the half period of ticks_ms over which ticks_diff is valid
+_REBASE_MS = 86400000
 
-    Args: none
 
-    Returns: UNIX epoch seconds
+def _to_ms(seconds, fraction) -> int:
+    # An NTP timestamp, 32 bits of seconds since 1900 and 32 bits of fraction, as UNIX epoch milliseconds
+    return (seconds - NTP_DELTA) * 1000 + ((fraction * 1000) >> 32)
+
+
+class NTPClient:
+    """Keeps time in integer UNIX epoch milliseconds, synced to a set of NTP servers
+
+    Each sync queries every server and uses the reply with the shortest round trip, whose offset is least affected by
+    the network.  Offset and round trip delay come from the four timestamps of an exchange:
+        T1 request sent (local), T2 request received (server), T3 reply sent (server), T4 reply received (local)
+        offset = ((T2 - T1) + (T3 - T4)) / 2, delay = (T4 - T1) - (T3 - T2)
+    The local clock counts ticks_ms from the last sync, corrected by the drift measured between syncs, and the RTC
+    (which time.time() and the logs use) is set from it at every sync.
     """
-    NTP_DELTA = 2208988800  # first day of the year 1970
-    HOST = "pool.ntp.org"
-    NTP_QUERY = bytearray(48)
-    NTP_QUERY[0] = 0x1B
-    addr = socket.getaddrinfo(HOST, 123)[0][-1]
-    for attempt in range(3):
-        log("Requesting time from pool.ntp.org, attempt {attempt}")
+
+    def __init__(self, servers=NTP_SERVERS, tz_offset_hours=0, interval_s=NTP_SYNC_INTERVAL_S, timeout_ms=1000):
+        """
+        Args:
+            servers (tuple): (host, port) of each server to query
+            tz_offset_hours (int): timezone offset in hours from UTC, applied to the RTC only
+            interval_s (int): seconds between syncs
+            timeout_ms (int): how long to wait for each server's reply
+        """
+        self.servers = servers
+        self.tz_offset_hours = tz_offset_hours
+        self.interval_s = interval_s
+        self.timeout_ms = timeout_ms
+        self.offset_ms = None  # offset of the local clock found by the last sync, None until the first one
+        self.delay_ms = None  # round trip delay of the reply used by the last sync
+        self.drift_ppm = 0  # rate the local clock gains (-) or loses (+) against the servers, in parts per million
+        self.syncs = 0
+        self.failures = 0
+        self.synced = asyncio.Event()  # set once the first sync has set the clock
+        self._addresses = {}  # resolved address of each (host, port), dropped when a query to it fails
+        self._base_ms = time.time() * 1000
+        self._base_ticks = time.ticks_ms()
+        self._synced_ticks = None  # ticks_ms at the last sync
+
+    def now_ms(self) -> int:
+        """Return the current time in UNIX epoch milliseconds"""
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self._base_ticks)
+        ms = self._base_ms + elapsed + elapsed * self.drift_ppm // 1000000
+        if elapsed > _REBASE_MS:
+            self._base_ms = ms
+            self._base_ticks = now
+        return ms
+
+    async def query(self, host, port) -> tuple:
+        """Exchange one request and reply with a server
+
+        Args:
+            host (str): server name or address
+            port (int): server port
+
+        Returns: tuple: the offset of the local clock and the round trip delay, in milliseconds
+
+        Raises: OSError, RuntimeError: if there is no valid reply in time
+        """
+        # Resolving blocks the event loop, so only done the first time and after a failure, e.g. a pool server gone away
+        addr = self._addresses.get((host, port))
+        if addr is None:
+            addr = socket.getaddrinfo(host, port)[0][-1]
+            self._addresses[(host, port)] = addr
+        request = bytearray(48)
+        request[0] = _VERSION << 3 | _MODE_CLIENT
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        _ = s.sendto(NTP_QUERY, addr)
-        msg = s.recv(48)
-        s.close()
-        val = struct.unpack("!I", msg[40:44])[0]
-        return val - NTP_DELTA  # breaks out of the loop
-    raise RuntimeError("Failed to get time from pool.ntp.org")
+        s.setblocking(False)
+        try:
+            t1 = self.now_ms()
+            # The transmit timestamp comes back as the reply's origin timestamp, which ties the reply to this request
+            struct.pack_into("!I", request, 40, t1 // 1000 + NTP_DELTA)
+            struct.pack_into("!I", request, 44, ((t1 % 1000) << 32) // 1000)
+            s.sendto(request, addr)
+            reply = await self._recv(s)
+            t4 = self.now_ms()
+        finally:
+            s.close()
+        if reply is None:
+            raise RuntimeError(f"No reply from {host}")
+        if len(reply) < 48 or reply[24:32] != request[40:48]:
+            raise RuntimeError(f"Invalid reply from {host}")
+        mode = reply[0] & 0x07
+        stratum = reply[1]
+        if reply[0] >> 6 == _LI_UNSYNCHRONIZED or mode != _MODE_SERVER or not 1 <= stratum <= 15:
+            raise RuntimeError(f"{host} is not synchronized")
+        s2, f2, s3, f3 = struct.unpack("!IIII", reply[32:48])
+        t2 = _to_ms(s2, f2)
+        t3 = _to_ms(s3, f3)
+        return ((t2 - t1) + (t3 - t4)) // 2, (t4 - t1) - (t3 - t2)
+
+    async def _recv(self, s):
+        # Wait for a datagram on a non-blocking socket without blocking other tasks, None if none arrives in time.  The
+        # stream waits on the event loop's poll of the socket, so this task wakes as soon as the reply is readable.
+        try:
+            return await asyncio.wait_for_ms(asyncio.StreamReader(s).read(48), self.timeout_ms)
+        except asyncio.TimeoutError:
+            return None
+
+    async def sync(self) -> bool:
+        """Query every server, and correct the local clock and RTC using the reply with the shortest round trip
+
+        Returns: bool: True if any server replied
+        """
+        best = None
+        for host, port in self.servers:
+            try:
+                offset, delay = await self.query(host, port)
+            except Exception as e:
+                warning("NTP query to %s:%s failed: %s", host, port, e)
+                self._addresses.pop((host, port), None)  # resolve it again next time
+                continue
+            debug("NTP %s:%s offset %s ms, delay %s ms", host, port, offset, delay)
+            if best is None or delay < best[1]:
+                best = (offset, delay)
+        if best is None:
+            self.failures += 1
+            return False
+
+        offset, delay = best
+        corrected = self.now_ms() + offset
+        now = time.ticks_ms()
+        if self._synced_ticks is not None:
+            # Whatever offset is left after the drift correction is further drift since the last sync
+            elapsed = time.ticks_diff(now, self._synced_ticks)
+            if elapsed >= _MIN_DRIFT_INTERVAL_MS:
+                drift = self.drift_ppm + offset * 1000000 // elapsed
+                self.drift_ppm = max(-_MAX_DRIFT_PPM, min(_MAX_DRIFT_PPM, drift))
+        self._base_ms = corrected
+        self._base_ticks = now
+        self._synced_ticks = now
+        self.offset_ms = offset
+        self.delay_ms = delay
+        self.syncs += 1
+        info("NTP sync: offset %s ms, delay %s ms, drift %s ppm", offset, delay, self.drift_ppm)
+        await self._set_rtc()
+        self.synced.set()
+        return True
+
+    async def _set_rtc(self):
+        # The RTC only holds whole seconds, so wait for the start of the next second before setting it
+        ms = self.now_ms()
+        await asyncio.sleep_ms(1000 - ms % 1000)
+        set_system_clock((self.now_ms() + 500) // 1000, self.tz_offset_hours)
+
+    async def run(self) -> None:
+        """Sync every interval_s seconds forever, retrying every NTP_RETRY_INTERVAL_S while syncs fail"""
+        synced = self.offset_ms is not None
+        while True:
+            await asyncio.sleep(self.interval_s if synced else NTP_RETRY_INTERVAL_S)
+            try:
+                synced = await self.sync()
+            except Exception as e:
+                warning("NTP sync failed: %s", e)
+                synced = False
 
 
 def set_system_clock(ntp_time: int, tz_offset_hours: int) -> None:
-    """Attempts to set the system clock from pool.ntp.org
+    """Sets the system clock to the given time plus the timezone offset
 
-    Args: tz_offset (int): timezone offset in hours from UTC
+    Args:
+        ntp_time (int): UNIX epoch seconds
+        tz_offset_hours (int): timezone offset in hours from UTC
 
     Returns: None
     """
-    # this is speculative. Send a one-off request to pool.ntp.org, and it fails we move on
     secs = ntp_time + tz_offset_hours * 3600
     dt_tuple = time.gmtime(secs)
-    log(f"Got epoch seconds {secs}, datetime {dt_tuple}")
+    log("Got epoch seconds %s, datetime %s", secs, dt_tuple)
     RTC().datetime([dt_tuple[i] for i in (0, 1, 2, 6, 3, 4, 5)] + [0])
@@ -0,0 +1,191 @@
+import os
+import struct
+from array import array
+
+import uasyncio as asyncio
+
+from history import EMPTY
+from logs import info, warning
+
+# Flash budget: SEGMENTS files of up to SEGMENT_RECORDS records each.  With the defaults that is 4 x 4008 bytes, about
+# one 4 KB filesystem block per segment, holding 1600 minutes (a bit over 26 hours) of 1 minute aggregates.
+SEGMENTS = 4
+SEGMENT_RECORDS = 400
+# Records are collected in RAM and written in batches, so the filesystem rewrites a block every BATCH_RECORDS minutes
+# rather than every minute
+BATCH_RECORDS = 16
+
+# Each segment starts with a header holding a generation number, which increases every time a segment is started, so
+# the newest segment can be found from the headers alone.  The records that follow are fixed size, little-endian:
+#   uint32 start of the minute in epoch seconds, uint16 min, uint16 mean, uint16 max (as History codes)
+# which is also their layout in an array("H") of 5 words per record, so they can be read and written without
+# packing or unpacking.
+_HEADER = "<4sI"
+_HEADER_SIZE = 8
+_MAGIC = b"LXS2"  # LXS1 segments held linear counts, and are skipped
+_RECORD_SIZE = 10
+_RECORD_WORDS = 5
+_LOAD_CHUNK_RECORDS = 32
+
+
+class SegmentLog:
+    """An append-only log of 1 minute history aggregates, kept in a fixed number of rotating segment files
+
+    Works on any filesystem, so it can be tried out on Linux with an ordinary directory in place of the Pico's flash.
+    """
+
+    def __init__(self, directory, segments=SEGMENTS, segment_records=SEGMENT_RECORDS, batch_records=BATCH_RECORDS):
+        """
+        Args:
+            directory (str): directory holding the segment files, created if needed
+            segments (int): number of segment files to rotate through
+            segment_records (int): records per segment file
+            batch_records (int): records collected in RAM before they are written
+        """
+        self.directory = directory
+        self.segments = segments
+        self.segment_records = segment_records
+        self._batch = array("H", [0] * (batch_records * _RECORD_WORDS))
+        self._batched = 0
+        self.last_period = None  # the latest period written or batched
+        self.writes = 0  # number of batches written
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass  # already exists
+        self._generations = [-1] * segments  # -1 for a missing or unusable segment
+        self._records = [0] * segments
+        self._current = None  # the segment being appended to, None if a new one must be started
+        self._scan()
+
+    def _path(self, segment):
+        return f"{self.directory}/seg{segment}.bin"
+
+    def _scan(self):
+        # Read every segment's header and size, but none of its records
+        newest = None
+        aligned = False
+        for segment in range(self.segments):
+            path = self._path(segment)
+            try:
+                with open(path, "rb") as f:
+                    magic, generation = struct.unpack(_HEADER, f.read(_HEADER_SIZE))
+                size = os.stat(path)[6]
+            except Exception:
+                continue  # missing, or too short to hold a header
+            if magic != _MAGIC:
+                continue
+            self._generations[segment] = generation
+            self._records[segment] = (size - _HEADER_SIZE) // _RECORD_SIZE
+            if newest is None or generation > self._generations[newest]:
+                newest = segment
+                aligned = (size - _HEADER_SIZE) % _RECORD_SIZE == 0
+        # A partly written record at the end of the newest segment (e.g. after a power cut) leaves _current unset,
+        # so the next write starts a fresh segment rather than appending out of alignment
+        self._current = newest if aligned else None
+
+    def _oldest_first(self):
+        # Usable segments, in the order they were written
+        order = [s for s in range(self.segments) if self._generations[s] >= 0]
+        order.sort(key=lambda s: self._generations[s])
+        return order
+
+    def load(self, history) -> int:
+        """Read every stored record back into history, oldest first
+
+        Records are read in chunks straight into an array, without parsing.
+
+        Args: history (History): the history to restore the records into
+
+        Returns: int: the number of records loaded
+        """
+        chunk = array("H", [0] * (_LOAD_CHUNK_RECORDS * _RECORD_WORDS))
+        view = memoryview(chunk)
+        loaded = 0
+        for segment in self._oldest_first():
+            try:
+                with open(self._path(segment), "rb") as f:
+                    f.seek(_HEADER_SIZE)
+                    remaining = self._records[segment]
+                    while remaining:
+                        n = min(remaining, _LOAD_CHUNK_RECORDS)
+                        f.readinto(view[: n * _RECORD_WORDS])
+                        for r in range(0, n * _RECORD_WORDS, _RECORD_WORDS):
+                            t = chunk[r] | (chunk[r + 1] << 16)
+                            history.restore(t, chunk[r + 2], chunk[r + 3], chunk[r + 4])
+                        remaining -= n
+                        loaded += n
+            except OSError as e:
+                warning("Failed to load history segment %s: %s", segment, e)
+        if loaded:
+            self.last_period = history.tiers["1m"].head
+        info("Loaded %s history records from %s", loaded, self.directory)
+        return loaded
+
+    def record(self, tier) -> None:
+        """Batch the periods of the tier completed since the last call, writing the batch when it is full
+
+        Args: tier: the 1 minute tier of a History
+        """
+        if tier.head is None:
+            return
+        first = max(tier.head - tier.slots + 1, tier.oldest)
+        if self.last_period is not None:
+            first = max(first, self.last_period + 1)
+        for p in range(first, tier.head):  # the head period is still in progress
+            i = p % tier.slots
+            if tier.means[i] != EMPTY:
+                self._append(p * tier.period, tier.mins[i], tier.means[i], tier.maxs[i])
+            self.last_period = p
+
+    def _append(self, t, lo, mean, hi):
+        r = self._batched * _RECORD_WORDS
+        batch = self._batch
+        batch[r] = t & 0xFFFF
+        batch[r + 1] = t >> 16
+        batch[r + 2] = lo
+        batch[r + 3] = mean
+        batch[r + 4] = hi
+        self._batched += 1
+        if self._batched * _RECORD_WORDS == len(batch):
+            self.flush()
+
+    def flush(self) -> None:
+        """Write any batched records to the current segment, starting a new segment if they don't fit"""
+        if not self._batched:
+            return
+        if self._current is None or self._records[self._current] + self._batched > self.segment_records:
+            self._start_segment()
+        with open(self._path(self._current), "ab") as f:
+            f.write(memoryview(self._batch)[: self._batched * _RECORD_WORDS])
+        self._records[self._current] += self._batched
+        self._batched = 0
+        self.writes += 1
+
+    def _start_segment(self):
+        # Overwrite the oldest (or first unused) segment with an empty one carrying the next generation number
+        generation = max(self._generations) + 1
+        segment = 0 if self._current is None else (self._current + 1) % self.segments
+        if self._current is None:
+            for s in range(self.segments):
+                if self._generations[s] < self._generations[segment]:
+                    segment = s
+        with open(self._path(segment), "wb") as f:
+            f.write(struct.pack(_HEADER, _MAGIC, generation))
+        self._generations[segment] = generation
+        self._records[segment] = 0
+        self._current = segment
+
+    async def run(self, tier, interval=60) -> None:
+        """Record the tier's completed periods every interval seconds, forever
+
+        Args:
+            tier: the 1 minute tier of a History
+            interval (int): seconds between checks
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.record(tier)
+            except OSError as e:
+                warning("Failed to write history: %s", e)
@@ -0,0 +1,72 @@
+import utime as time
+import uasyncio as asyncio
+
+
+class _Flight:
+    # The outcome of a single read, shared by the caller that started it and every caller that waited for it
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.value = None
+        self.error = None
+
+
+class ReadCache:
+    """Coalesces concurrent sensor reads and serves recent values from a cache
+
+    A read that arrives while another is in flight waits for that read and shares its result instead of starting
+    a second I2C transaction.  A read that arrives within ttl_ms of the last successful read is answered from the
+    cache.  Errors are not cached: every caller waiting on a failed read gets the exception, and the next caller
+    starts a fresh read.  If the caller that started a read is cancelled, the callers waiting on it get a RuntimeError.
+    """
+
+    def __init__(self, sensor_reader, ttl_ms):
+        """
+        Args:
+            sensor_reader (function): a coroutine function that returns the current sensor reading
+            ttl_ms (int): how long a successful reading is served from the cache.  Keep this no longer than the
+                sensor's integration time, so a cached value is never older than the conversion a fresh read would return.
+        """
+        self._sensor_reader = sensor_reader
+        self.ttl_ms = ttl_ms
+        self.value = None
+        self._read_at = None  # ticks_ms of the last successful read, None until there is one
+        self._flight = None  # the read currently in progress, if any
+        self.hits = 0  # reads answered from the cache
+        self.misses = 0  # reads that went to the sensor
+        self.coalesced = 0  # reads that waited for a read already in progress
+
+    async def read(self) -> float:
+        """Return a reading no older than ttl_ms, reading the sensor only if needed
+
+        Raises: Exception: whatever the sensor reader raised, if the read this call depends on failed
+        """
+        flight = self._flight
+        if flight is not None:
+            self.coalesced += 1
+            await flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        if self._read_at is not None and time.ticks_diff(time.ticks_ms(), self._read_at) < self.ttl_ms:
+            self.hits += 1
+            return self.value
+
+        self.misses += 1
+        self._flight = flight = _Flight()
+        try:
+            flight.value = self.value = await self._sensor_reader()
+            self._read_at = time.ticks_ms()
+            return flight.value
+        except BaseException as e:
+            # A read cancelled under its waiters fails for them too, rather than handing them no value, but only
+            # cancels the task it was cancelled in
+            flight.error = e if isinstance(e, Exception) else RuntimeError("Sensor read cancelled")
+            raise
+        finally:
+            self._flight = None
+            flight.done.set()
+
+    def stats(self) -> dict:
+        """Return the hit, miss and coalesced read counters"""
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
@@ -0,0 +1,268 @@
+import ujson as json
+import utime as time
+import uasyncio as asyncio
+
+from logs import warning
+
+# Interval between sensor reads made by the sampler, and the shortest interval subscribers may ask for
+SAMPLE_INTERVAL_MS = 2000
+MIN_INTERVAL_MS = 100
+
+# A subscriber which has had nothing to send for this long is sent a comment line, to keep the connection open
+HEARTBEAT_MS = 15000
+HEARTBEAT = b": heartbeat\n\n"
+# Most samples a subscriber may ask to have batched into one event
+MAX_BATCH = 20
+# Number of recent events kept for subscribers which reconnect, a minute's worth at the default interval
+REPLAY_EVENTS = 30
+
+# What happens to a subscriber which is too slow to send every sample
+LAG_LATEST = "latest"  # skip the samples it missed and send the latest one
+LAG_DISCONNECT = "disconnect"  # disconnect it once it has missed more than max_lag samples in a row
+
+
+class SubscriberLagging(Exception):
+    pass
+
+
+def lux_json(lux, sensors=None) -> str:
+    """Encode a lux value in the format lunar expects from a sensor
+
+    Args:
+        lux (float): the lux value to encode
+        sensors (dict): if given, each sensor's own reading by name, added as "sensors"
+
+    Returns: str: JSON document with the sensor id, state and value, to three decimal places as /sensor/ambient_light
+    """
+    document = {
+        "id": "sensor-ambient_light",
+        "state": "%.3f lx" % lux,
+        "value": round(lux, 3),
+    }
+    if sensors is not None:
+        document["sensors"] = sensors
+    return json.dumps(document)
+
+
+class Sampler:
+    """Owns the sensor on behalf of all /events subscribers
+
+    A single task reads the sensor every interval_ms and encodes the result once as a complete server-sent event.
+    Subscribers wait for a sequence number newer than the last one they sent and write the shared bytes, so the
+    I2C traffic and encoding cost per tick don't depend on how many clients are connected.  A subscriber which is
+    slow to write never holds up the sampler or other subscribers, what happens to it is set by lag_policy.
+
+    While a Subscription asks for a shorter interval the sampler reads at that rate instead, down to MIN_INTERVAL_MS.
+    History is still only recorded every interval_ms.
+
+    Every event carries its sequence number as its id, and the last replay_events events are kept in a ring so a
+    subscriber which reconnects with the id of the last event it received can be sent the ones it missed.
+    """
+
+    def __init__(
+        self,
+        sensor_reader,
+        default_lux,
+        interval_ms=SAMPLE_INTERVAL_MS,
+        lag_policy=LAG_LATEST,
+        max_lag=0,
+        history=None,
+        replay_events=REPLAY_EVENTS,
+        sensor_values=None,
+        clock=time.time,
+    ):
+        """
+        Args:
+            sensor_reader (function): a coroutine function that returns the current sensor reading
+            default_lux (int): the lux value to publish if the first read fails.  On subsequent failures the last value will be used.
+            interval_ms (int): the time between sensor reads
+            lag_policy (str): LAG_LATEST or LAG_DISCONNECT, how to treat subscribers that miss samples
+            max_lag (int): for LAG_DISCONNECT, the number of samples in a row a subscriber may miss
+            history (History): if given, every successful reading is added to it
+            replay_events (int): number of recent events kept for replay
+            sensor_values (function): if given, returns each sensor's own reading by name, which is added to every
+                sample alongside the combined value
+            clock (function): returns the current time in UTC epoch seconds, which the history is kept in.  The RTC,
+                and so time.time(), holds local time once NTP has set it, so pass a UTC source such as the NTP client's
+        """
+        self._sensor_reader = sensor_reader
+        self._sensor_values = sensor_values
+        self.clock = clock
+        self.interval_ms = interval_ms
+        self.lux = default_lux
+        self.seq = 0  # sequence number of the latest sample, 0 until the first one is published
+        self.data = b""  # the latest sample, encoded as JSON
+        self.event = b""  # the latest sample, encoded as a server-sent event
+        self.lag_policy = lag_policy
+        self.max_lag = max_lag
+        self.history = history
+        self.subscribers = 0
+        self.skipped = 0  # samples not sent to a subscriber because it was still busy with an earlier one
+        self.disconnected = 0  # subscribers disconnected for lagging
+        self._published = asyncio.Event()
+        self._intervals = []  # the intervals asked for by current subscriptions
+        self._replay = [None] * replay_events  # event with sequence number seq is in slot seq % replay_events
+
+    def _sleep_ms(self) -> int:
+        # Read at the shortest interval anyone currently wants
+        if not self._intervals:
+            return self.interval_ms
+        return max(MIN_INTERVAL_MS, min(self.interval_ms, min(self._intervals)))
+
+    async def run(self) -> None:
+        """Read the sensor and publish the result forever"""
+        recorded = None  # ticks_ms when a sample was last added to the history
+        while True:
+            try:
+                self.lux = await self._sensor_reader()
+                now = time.ticks_ms()
+                if self.history is not None and (
+                    recorded is None or time.ticks_diff(now, recorded) >= self.interval_ms - MIN_INTERVAL_MS // 2
+                ):
+                    self.history.add(self.clock(), self.lux)
+                    recorded = now
+            except Exception as e:
+                # Ignore all read errors, just republish the last value
+                warning("Error reading sensor, reusing last read value: %s: %s", self.lux, e)
+            self._publish()
+            await asyncio.sleep_ms(self._sleep_ms())
+
+    def _publish(self) -> None:
+        self.seq += 1
+        sensors = None if self._sensor_values is None else self._sensor_values()
+        self.data = lux_json(self.lux, sensors).encode()
+        self.event = b"id: " + str(self.seq).encode() + b"\nevent: state\ndata: " + self.data + b"\n\n"
+        self._replay[self.seq % len(self._replay)] = self.event
+        # Waking every waiter and replacing the event avoids having to clear it while subscribers are still waking up
+        published, self._published = self._published, asyncio.Event()
+        published.set()
+
+    def replay(self, seq):
+        """Find the first event kept for replay with a sequence number of seq or more
+
+        Args: seq (int): the sequence number wanted
+
+        Returns: tuple: the sequence number and event found, None if there are none
+        """
+        seq = max(seq, self.seq - len(self._replay) + 1, 1)
+        if seq <= self.seq:
+            return seq, self._replay[seq % len(self._replay)]
+        return None
+
+    async def wait(self, seq, count_missed=True) -> tuple:
+        """Wait for a sample newer than seq
+
+        Args:
+            seq (int): the sequence number of the last sample the caller has seen, 0 if none
+            count_missed (bool): False if the caller skips samples on purpose, so they don't count as lagging
+
+        Returns: tuple: the sequence number and encoded event of the latest sample
+
+        Raises: SubscriberLagging: if the policy is LAG_DISCONNECT and the caller missed more than max_lag samples
+        """
+        while self.seq == seq:
+            await self._published.wait()
+        if seq and count_missed:
+            missed = self.seq - seq - 1
+            if missed:
+                self.skipped += missed
+                if self.lag_policy == LAG_DISCONNECT and missed > self.max_lag:
+                    self.disconnected += 1
+                    raise SubscriberLagging(f"Subscriber missed {missed} samples")
+        return self.seq, self.event
+
+
+class Subscription:
+    """One subscriber's choice of samples from a Sampler
+
+    Samples are taken at most every interval_ms, by default the sampler's own, whatever rate the sampler is reading at
+    for other subscribers; the samples published in between are dropped, and aren't counted as missed.  Samples which
+    differ from the last one sent by less than min_delta percent are dropped, and batch samples at a time are sent
+    together as one "states" event whose data is a JSON array.  When there has been nothing to send for HEARTBEAT_MS a partial batch, or else a heartbeat comment, is sent.
+    Single samples are sent as the sampler's shared event bytes, batches are joined from its shared JSON bytes.
+
+    A subscriber resuming from an earlier event is first sent the events after it that are still in the sampler's
+    replay ring, one by one as they were published, then carries on as above.  A batch's id is that of its last sample.
+    """
+
+    def __init__(self, sampler, interval_ms=0, min_delta=0, batch=1, last_event_id=None):
+        """
+        Args:
+            sampler (Sampler): the sampler to take samples from
+            interval_ms (int): shortest time between samples taken, 0 for the sampler's interval_ms
+            min_delta (float): smallest change in percent from the last sample sent worth sending, 0 to send all
+            batch (int): number of samples sent per event, 1 to MAX_BATCH
+            last_event_id (str): the id of the last event a reconnecting subscriber received, None for a new one
+        """
+        self.sampler = sampler
+        self.interval_ms = interval_ms or sampler.interval_ms
+        self.min_delta = min_delta
+        self.batch = batch
+        self._seq = 0
+        self._taken = None  # ticks_ms when the last sample was taken
+        self._sent = time.ticks_ms()  # ticks_ms when something was last sent
+        self._last_lux = None  # the last sample sent
+        self._batched = []
+        self._replaying = False
+        if last_event_id is not None:
+            try:
+                last = int(last_event_id)
+            except ValueError:
+                last = -1
+            # An id beyond the latest one is from before the device restarted, so there is nothing to resume.  A client
+            # which already has the latest one resumes after it, rather than being sent it again.
+            if 0 <= last <= sampler.seq:
+                self._seq = last
+                self._replaying = True
+        sampler.subscribers += 1
+        sampler._intervals.append(self.interval_ms)
+
+    def close(self) -> None:
+        """Stop subscribing"""
+        self.sampler.subscribers -= 1
+        self.sampler._intervals.remove(self.interval_ms)
+
+    async def next(self) -> bytes:
+        """Wait for the next event to send
+
+        Returns: bytes: one or more complete server-sent events, or a heartbeat comment
+
+        Raises: SubscriberLagging: as Sampler.wait
+        """
+        sampler = self.sampler
+        if self._replaying:
+            # Events which have already gone from the ring are skipped
+            replayed = sampler.replay(self._seq + 1)
+            if replayed is not None:
+                self._seq, event = replayed
+                self._sent = time.ticks_ms()
+                return event
+            self._replaying = False  # caught up
+        while True:
+            # Only a subscriber taking every sample the sampler publishes can fall behind it
+            self._seq, event = await sampler.wait(self._seq, count_missed=self.interval_ms <= sampler._sleep_ms())
+            now = time.ticks_ms()
+            # With the same tolerance as the history, so samples published a little early aren't dropped
+            if self._taken is not None and time.ticks_diff(now, self._taken) < self.interval_ms - MIN_INTERVAL_MS // 2:
+                continue
+            self._taken = now
+            lux = sampler.lux
+            last = self._last_lux
+            if self.min_delta and last is not None and abs(lux - last) * 100 < self.min_delta * abs(last):
+                if time.ticks_diff(now, self._sent) >= HEARTBEAT_MS:
+                    self._sent = now
+                    return self._flush() if self._batched else HEARTBEAT
+                continue
+            self._last_lux = lux
+            if self.batch == 1:
+                self._sent = now
+                return event
+            self._batched.append(sampler.data)
+            if len(self._batched) >= self.batch or time.ticks_diff(now, self._sent) >= HEARTBEAT_MS:
+                self._sent = now
+                return self._flush()
+
+    def _flush(self):
+        event = b"id: " + str(self._seq).encode() + b"\nevent: states\ndata: [" + b",".join(self._batched) + b"]\n\n"
+        self._batched.clear()
+        return event
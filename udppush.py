@@ -0,0 +1,218 @@
+import socket, struct
+import utime as time
+import uasyncio as asyncio
+
+from logs import debug, info, warning
+
+# The port the publisher listens for subscriptions on
+UDP_PORT = 5765
+# Shortest interval between samples a subscriber may ask for, and the interval used if it asks for 0
+UDP_MIN_INTERVAL_MS = 100
+UDP_DEFAULT_INTERVAL_MS = 1000
+# Longest lease granted, a subscriber has to renew before its lease runs out to keep receiving samples
+UDP_MAX_LEASE_S = 300
+UDP_MAX_SUBSCRIBERS = 8
+
+# Every datagram starts with the magic, the protocol version and its type, and all fields are in network byte order:
+#   SUBSCRIBE    to the sensor    interval ms (uint16), lease seconds (uint16), group address (4 bytes) and port
+#                                 (uint16) to send samples to, or 0.0.0.0 and 0 for the address the request came from.
+#                                 Any other address than a multicast group is refused.
+#   ACK          from the sensor  the granted interval ms and lease seconds, a lease of 0 if refused or unsubscribed
+#   UNSUBSCRIBE  to the sensor    group address and port, as subscribed
+#   SAMPLE       from the sensor  sequence number (uint32, per subscription), epoch ms (uint64), lux (float32)
+MAGIC = b"LX"
+VERSION = 1
+SUBSCRIBE = 1
+ACK = 2
+UNSUBSCRIBE = 3
+SAMPLE = 4
+SUBSCRIBE_FORMAT = "!2sBBHH4sH"
+ACK_FORMAT = "!2sBBHH"
+UNSUBSCRIBE_FORMAT = "!2sBB4sH"
+SAMPLE_FORMAT = "!2sBBIQf"
+_SAMPLE_SIZE = struct.calcsize(SAMPLE_FORMAT)
+_ANY = b"\x00\x00\x00\x00"
+
+
+class _Subscription:
+    def __init__(self, interval_ms, expires):
+        self.interval_ms = interval_ms
+        self.expires = expires  # ticks_ms when the lease runs out
+        self.due = time.ticks_ms()  # ticks_ms when the next sample is sent
+        self.seq = 0
+
+
+class UDPPublisher:
+    """Pushes samples to subscribers in UDP datagrams
+
+    A few bytes of lux don't need a TCP connection: a subscriber sends SUBSCRIBE with the interval it wants and how
+    long its lease should last, and is sent a SAMPLE datagram every interval until the lease runs out or it sends
+    UNSUBSCRIBE.  Subscribers renew by sending SUBSCRIBE again, usually at half the lease, so one that goes away
+    without unsubscribing stops being sent to.  Samples go to the address the SUBSCRIBE came from, or to a multicast
+    group named in it, which any number of receivers can join while one of them keeps the lease.  Each subscription
+    numbers its samples, so receivers can count the ones lost.
+    """
+
+    def __init__(self, sensor_reader, clock, port=UDP_PORT, max_subscribers=UDP_MAX_SUBSCRIBERS):
+        """
+        Args:
+            sensor_reader (function): a coroutine function that returns the current sensor reading
+            clock (function): returns the current time in UNIX epoch milliseconds
+            port (int): the port to listen for subscriptions on
+            max_subscribers (int): subscriptions beyond this many are refused
+        """
+        self._sensor_reader = sensor_reader
+        self._clock = clock
+        self.port = port
+        self.max_subscribers = max_subscribers
+        self.subscriptions = {}  # (address, port) to send samples to: _Subscription
+        self.sent = 0
+        self.send_errors = 0
+        self.read_errors = 0
+        self.refused = 0
+        self._socket = None
+        self._sample = bytearray(_SAMPLE_SIZE)
+        self._ack = bytearray(struct.calcsize(ACK_FORMAT))
+
+    async def run(self) -> None:
+        """Answer requests and send samples, forever
+
+        Between the two it sleeps until a request arrives or the next sample is due, so with no subscriptions it only
+        wakes for requests.
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(socket.getaddrinfo("0.0.0.0", self.port)[0][-1])
+        s.setblocking(False)
+        self._socket = s
+        info("UDP publisher listening on port %s", self.port)
+        # Reading nothing from the stream waits in the event loop's poll until a datagram is waiting, and leaves it for
+        # recvfrom(), which also gives the address it came from
+        reader = asyncio.StreamReader(s)
+        try:
+            while True:
+                self._receive()
+                await self._publish()
+                wait_ms = self._next_ms()
+                try:
+                    if wait_ms is None:
+                        await reader.read(0)
+                    elif wait_ms > 0:
+                        await asyncio.wait_for_ms(reader.read(0), wait_ms)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._socket = None
+            s.close()
+
+    def _next_ms(self):
+        # Milliseconds until the next sample is due or a lease runs out, None if there are no subscriptions
+        now = time.ticks_ms()
+        wait_ms = None
+        for subscription in self.subscriptions.values():
+            for t in (subscription.due, subscription.expires):
+                ms = time.ticks_diff(t, now)
+                if wait_ms is None or ms < wait_ms:
+                    wait_ms = ms
+        return None if wait_ms is None else max(wait_ms, 0)
+
+    def _receive(self):
+        # Handle every request waiting on the socket
+        while True:
+            try:
+                data, addr = self._socket.recvfrom(32)
+            except OSError:  # EAGAIN, nothing waiting
+                return
+            try:
+                self._handle(data, addr)
+            except Exception as e:
+                warning("Bad UDP request from %s: %s", addr, e)
+
+    def _handle(self, data, addr):
+        if data[:2] != MAGIC or data[2] != VERSION:
+            raise ValueError("unknown protocol")
+        if data[3] == SUBSCRIBE:
+            _, _, _, interval_ms, lease_s, group, port = struct.unpack(SUBSCRIBE_FORMAT, data)
+            target = self._target(addr, group, port)
+            subscription = self.subscriptions.get(target)
+            if target is None or (subscription is None and len(self.subscriptions) >= self.max_subscribers):
+                self.refused += 1
+                self._send_ack(addr, 0, 0)
+                return
+            interval_ms = max(interval_ms or UDP_DEFAULT_INTERVAL_MS, UDP_MIN_INTERVAL_MS)
+            lease_s = max(1, min(lease_s, UDP_MAX_LEASE_S))
+            expires = time.ticks_add(time.ticks_ms(), lease_s * 1000)
+            if subscription is None:
+                self.subscriptions[target] = _Subscription(interval_ms, expires)
+                debug("UDP subscription for %s, every %s ms", target, interval_ms)
+            else:
+                subscription.interval_ms = interval_ms
+                subscription.expires = expires
+            self._send_ack(addr, interval_ms, lease_s)
+        elif data[3] == UNSUBSCRIBE:
+            _, _, _, group, port = struct.unpack(UNSUBSCRIBE_FORMAT, data)
+            self.subscriptions.pop(self._target(addr, group, port), None)
+            self._send_ack(addr, 0, 0)
+        else:
+            raise ValueError("unknown type")
+
+    def _target(self, addr, group, port):
+        # The address samples go to, the sender's own unless the request names a group.  Only a multicast group
+        # (224.0.0.0/4) is accepted, so a request can't have samples sent to some other host.
+        if group == _ANY:
+            return addr
+        if not 224 <= group[0] <= 239:
+            return None
+        return socket.getaddrinfo("%d.%d.%d.%d" % tuple(group), port)[0][-1]
+
+    def _send_ack(self, addr, interval_ms, lease_s):
+        struct.pack_into(ACK_FORMAT, self._ack, 0, MAGIC, VERSION, ACK, interval_ms, lease_s)
+        self._send(self._ack, addr)
+
+    def _send(self, data, addr):
+        try:
+            self._socket.sendto(data, addr)
+            return True
+        except OSError as e:
+            self.send_errors += 1
+            debug("UDP send to %s failed: %s", addr, e)
+            return False
+
+    async def _publish(self):
+        # Send a sample to every subscription that is due, reading the sensor once for all of them
+        now = time.ticks_ms()
+        lux = None
+        for target in list(self.subscriptions):
+            subscription = self.subscriptions[target]
+            if time.ticks_diff(now, subscription.expires) >= 0:
+                del self.subscriptions[target]
+                debug("UDP subscription for %s expired", target)
+                continue
+            if time.ticks_diff(now, subscription.due) < 0:
+                continue
+            if lux is None:
+                try:
+                    lux = await self._sensor_reader()
+                except Exception as e:
+                    self.read_errors += 1
+                    warning("UDP publisher failed to read the sensor: %s", e)
+                    return
+                t = self._clock()
+            # Keep to the interval, unless the sample is so late that it would be followed by a burst
+            subscription.due = time.ticks_add(subscription.due, subscription.interval_ms)
+            if time.ticks_diff(now, subscription.due) >= 0:
+                subscription.due = time.ticks_add(now, subscription.interval_ms)
+            struct.pack_into(SAMPLE_FORMAT, self._sample, 0, MAGIC, VERSION, SAMPLE, subscription.seq, t, lux)
+            subscription.seq = (subscription.seq + 1) & 0xFFFFFFFF
+            if self._send(self._sample, target):
+                self.sent += 1
+
+    def stats(self) -> dict:
+        """Return the number of subscriptions and the datagram counters"""
+        return {
+            "subscriptions": len(self.subscriptions),
+            "sent": self.sent,
+            "send_errors": self.send_errors,
+            "read_errors": self.read_errors,
+            "refused": self.refused,
+        }
@@ -1,76 +1,256 @@
 import ujson as json
-import utime as time
-import uasyncio as asyncio
 from ahttpserver import HTTPResponse, HTTPServer
+from ahttpserver.server import HTTPServerError
 from ahttpserver.sse import EventSource
 
-from logs import log, logbuffer
+import logs
+import metrics
+from logs import debug, warning, log_line, log_window
+from luxresponse import LuxResponse
+from sampler import MAX_BATCH, Subscription
 
+# /logs returns at most this many lines per request, and drains the connection after every chunk of lines
+LOGS_MAX_LINES = 100
+LOGS_CHUNK_LINES = 10
 
-def make_webserver(sensor_reader, default_lux) -> HTTPServer:
+
+def make_webserver(
+    sensor_cache, default_lux, sampler, history, link=None, pipeline=None, publisher=None, sensors=None
+) -> HTTPServer:
     """Make a webserver that responds to requests for sensor data and logs
 
     The endpoints registered are:
         /sensor/ambient_light: responds to synchronous requests with the current lux value
-        /events: sends an update every 2 seconds
-        /logs: responds with the last 100 log messages
+        /sensor/<name>: responds with the latest reading of one of several sensors, or 503 while it is failing
+        /events?interval=<ms>&min_delta=<percent>&batch=<n>: sends the samples published by the sampler, at most one
+            every interval ms, only those differing by at least min_delta percent from the last one sent, n at a time
+            in a "states" event.  By default every sample is sent as a "state" event.  Events have ids, and a client
+            reconnecting with a Last-Event-ID header is first sent the recent events it missed.
+        /logs?since=<seq>&limit=<n>: responds with up to n buffered log messages starting at sequence number seq, each
+            prefixed with its sequence number.  The X-Log-Next-Seq header gives the since value for the next poll.
+        /history?from=<t>&to=<t>&res=<raw|1m|1h>&format=<csv|bin>: responds with the lux history between two times in
+            UTC epoch seconds, by default the whole 1 minute tier as CSV
+        /stats: responds with the sensor read cache, connection, event subscriber, WiFi link and UDP push counters,
+            the raw and filtered sensor values, and each sensor's reading, range and errors
+        /metrics: responds with request and I2C read latency histograms, event loop lag, heap use, uptime and the
+            /stats counters in the Prometheus text format
     The endpoint methods get registered with the server, and the server is returned to and started by the caller, so no references are lost.
 
     Args:
-        sensor_reader (function): a function that returns the current sensor reading
-        default_lux (int): the default lux value to use if the sensor_reader fails on the first call.  On subsequent calls the last value will be used.
+        sensor_cache (ReadCache): the cache through which the current sensor reading is read
+        default_lux (int): the default lux value to use if the sensor read fails on the first call.  On subsequent calls the last value will be used.
+        sampler (Sampler): the sampler whose samples are forwarded to /events subscribers
+        history (History): the history of samples served by /history
+        link (WifiSupervisor): if given, the WiFi link whose counters are included in /stats and /metrics
+        pipeline (FilterPipeline): if given, the filters whose raw and filtered values are included in /stats and
+            /metrics
+        publisher (UDPPublisher): if given, the UDP publisher whose counters are included in /stats and /metrics
+        sensors (SensorRegistry): if given, the sensors served at /sensor/<name> and included in /stats and /metrics
 
     Returns:
         HTTPServer: a webserver that responds to requests for sensor data and logs
     """
-    server = HTTPServer()
-    last_lux = default_lux  # We need a default so the first request to lux_json_response doesn't return an error
+    server = HTTPServer(logger=logs, observer=metrics.observe_request)
+    last_lux = default_lux  # We need a default so the first request to current_lux doesn't return an error
+    lux_responses = {True: LuxResponse(keep_alive=True), False: LuxResponse(keep_alive=False)}
 
-    async def lux_json_response() -> str:
-        # Returns a JSON string with the current lux value
+    async def current_lux() -> float:
+        # Returns the current lux value, or the last good one if the sensor can't be read
         nonlocal last_lux
         try:
-            last_lux = await sensor_reader()
+            last_lux = await sensor_cache.read()
         except Exception as e:
             # Ignore all read errors, just use the last value
-            log(f"Error reading sensor, reusing last read value: {last_lux}: {str(e)}")
-        response_json = {
-            "id": "sensor-ambient_light",
-            "state": f"{last_lux} lx",
-            "value": last_lux,
-        }
-        return json.dumps(response_json)
+            warning("Error reading sensor, reusing last read value: %s: %s", last_lux, e)
+        return last_lux
 
     @server.route("GET", "/sensor/ambient_light")
     async def sensor_ambient_light(reader, writer, request):
         # Respond to synchronous requests with the current lux value
-        log(f"GET /sensor/ambient_light")
-        response = HTTPResponse(200, "application/json", close=True)
-        await response.send(writer)
-        await writer.drain()
-        writer.write(await lux_json_response())
+        # The status line, headers and body all go out in a single write of a pre-encoded buffer
+        debug("GET /sensor/ambient_light")
+        writer.write(lux_responses[request.keep_alive].render(await current_lux()))
         await writer.drain()
 
+    def sensor_route(name):
+        responses = {True: LuxResponse(True, name), False: LuxResponse(False, name)}
+
+        async def sensor_reading(reader, writer, request):
+            # The sensor's own reading, unfiltered, and 503 instead of the last good value while it is failing
+            debug("GET /sensor/%s", name)
+            lux = sensors.values().get(name)
+            if lux is None:
+                response = HTTPResponse(503, close=not request.keep_alive, length=0)
+                await response.send(writer)
+                return
+            writer.write(responses[request.keep_alive].render(lux))
+            await writer.drain()
+
+        try:
+            server.route("GET", "/sensor/" + name)(sensor_reading)
+        except HTTPServerError:
+            pass  # a single sensor named ambient_light is served by sensor_ambient_light
+
+    if sensors is not None:
+        for member in sensors.members:
+            sensor_route(member.name)
+
     @server.route("GET", "/events")
     async def events(reader, writer, request):
-        # Send an update very 2 seconds
-        log(f"GET /events")
+        # Forward the sampler's shared, pre-encoded events.  A client that falls behind is handled by the sampler's lag
+        # policy, and one that stops reading altogether times out in drain() and is disconnected.
+        debug("GET /events")
+        parameters = request.parameters
+        try:
+            interval = int(parameters.get("interval", 0))
+            min_delta = float(parameters.get("min_delta", 0))
+            batch = int(parameters.get("batch", 1))
+        except ValueError:
+            interval = -1
+        if interval < 0 or min_delta < 0 or not 1 <= batch <= MAX_BATCH:
+            response = HTTPResponse(400, close=not request.keep_alive, length=0)
+            await response.send(writer)
+            return
+        request.keep_alive = False  # the event stream ends only when the connection does
+        request.observe = False  # and can last longer than request durations can be measured
+        if not server.begin_stream(request):
+            # Streams have their own limit, so they never use up the connections polling clients need
+            response = HTTPResponse(503, close=True, header={"Retry-After": 5}, length=0)
+            await response.send(writer)
+            return
         eventsource = await EventSource.init(reader, writer)
-        while True:
-            await asyncio.sleep(2)
-            t = time.localtime()
-            try:
-                await eventsource.send(event="state", data=await lux_json_response())
-            except Exception:
-                break  # close connection
+        subscription = Subscription(sampler, interval, min_delta, batch, request.last_event_id)
+        try:
+            while True:
+                await eventsource.write(await subscription.next())
+        except Exception:
+            pass  # close connection
+        finally:
+            subscription.close()
 
     @server.route("GET", "/logs")
-    async def logs(reader, writer, request):
-        log(f"GET /logs")
-        response = HTTPResponse(200, "text/plain", close=True)
+    async def log_lines(reader, writer, request):
+        # Stream the log lines a few at a time rather than joining them all into one large string
+        debug("GET /logs")
+        try:
+            since = int(request.parameters.get("since", 0))
+            limit = int(request.parameters.get("limit", LOGS_MAX_LINES))
+        except ValueError:
+            since = limit = -1
+        if since < 0 or limit < 0:
+            response = HTTPResponse(400, close=not request.keep_alive, length=0)
+            await response.send(writer)
+            return
+        first, end = log_window(since, limit)
+        request.keep_alive = False
+        response = HTTPResponse(200, "text/plain", close=True, header={"X-Log-Next-Seq": end})
         await response.send(writer)
+        for seq in range(first, end):
+            line = log_line(seq)
+            if line is not None:  # skip lines overwritten while we were waiting for the client
+                writer.write(f"{seq} {line}\n")
+            if seq % LOGS_CHUNK_LINES == LOGS_CHUNK_LINES - 1:
+                await writer.drain()
         await writer.drain()
-        writer.write("\n".join(logbuffer()))
+
+    @server.route("GET", "/history")
+    async def lux_history(reader, writer, request):
+        debug("GET /history")
+        parameters = request.parameters
+        res = parameters.get("res", "1m")
+        fmt = parameters.get("format", "csv")
+        try:
+            start = int(parameters.get("from", 0))
+            end = int(parameters.get("to", sampler.clock()))
+        except ValueError:
+            start = end = None
+        if start is None or (res != "raw" and res not in history.tiers) or fmt not in ("csv", "bin"):
+            response = HTTPResponse(400, close=not request.keep_alive, length=0)
+            await response.send(writer)
+            return
+        if fmt == "bin":
+            length = history.binary_length(res, start, end)
+            response = HTTPResponse(
+                200, "application/octet-stream", close=not request.keep_alive, length=length
+            )
+            await response.send(writer)
+            await history.write_binary(writer, res, start, end)
+        else:
+            request.keep_alive = False
+            response = HTTPResponse(200, "text/csv", close=True)
+            await response.send(writer)
+            await history.write_csv(writer, res, start, end)
+
+    @server.route("GET", "/stats")
+    async def stats(reader, writer, request):
+        debug("GET /stats")
+        stats = {
+            "sensor_cache": sensor_cache.stats(),
+            "connections": {
+                "current": server.connections,
+                "peak": server.peak_connections,
+                "rejected": server.rejected_connections,
+                "streams": server.streams,
+                "rejected_streams": server.rejected_streams,
+            },
+            "events": {
+                "subscribers": sampler.subscribers,
+                "skipped": sampler.skipped,
+                "disconnected": sampler.disconnected,
+            },
+        }
+        if link is not None:
+            stats["wifi"] = link.stats()
+        if pipeline is not None:
+            stats["filter"] = pipeline.stats()
+        if publisher is not None:
+            stats["udp"] = publisher.stats()
+        if sensors is not None:
+            stats["sensors"] = sensors.stats()
+        body = json.dumps(stats)
+        response = HTTPResponse(200, "application/json", close=not request.keep_alive, length=len(body))
+        await response.send(writer)
+        writer.write(body)
         await writer.drain()
 
+    @server.route("GET", "/metrics")
+    async def prometheus_metrics(reader, writer, request):
+        debug("GET /metrics")
+        request.keep_alive = False
+        response = HTTPResponse(200, "text/plain; version=0.0.4", close=True)
+        await response.send(writer)
+        cache = sensor_cache.stats()
+        gauges = [
+            ("sse_subscribers", "gauge", "Connected /events subscribers", sampler.subscribers),
+            ("sse_skipped_total", "counter", "Samples skipped by lagging subscribers", sampler.skipped),
+            ("sse_disconnected_total", "counter", "Subscribers disconnected for lagging", sampler.disconnected),
+            ("connections", "gauge", "HTTP connections being handled", server.connections),
+            ("connections_peak", "gauge", "Most HTTP connections handled at once", server.peak_connections),
+            ("connections_rejected_total", "counter", "HTTP connections refused", server.rejected_connections),
+            ("streams", "gauge", "HTTP connections streaming events", server.streams),
+            ("streams_rejected_total", "counter", "Event streams refused", server.rejected_streams),
+            ("sensor_cache_hits_total", "counter", "Sensor reads served from the cache", cache["hits"]),
+            ("sensor_cache_misses_total", "counter", "Sensor reads that went to the sensor", cache["misses"]),
+            ("sensor_cache_coalesced_total", "counter", "Sensor reads that joined one in flight", cache["coalesced"]),
+        ]
+        if link is not None:
+            gauges.append(("wifi_connected", "gauge", "Whether the WiFi link is up", int(link.connected.is_set())))
+            gauges.append(("wifi_disconnects_total", "counter", "Times the WiFi link dropped", link.disconnects))
+            gauges.append(
+                ("wifi_downtime_seconds_total", "counter", "Time the WiFi link was down", link.downtime_ms / 1000)
+            )
+        if pipeline is not None and pipeline.value is not None:
+            gauges.append(("lux_raw", "gauge", "Latest sensor conversion in lux", pipeline.raw))
+            gauges.append(("lux_filtered", "gauge", "Latest filtered sensor value in lux", pipeline.value))
+        if publisher is not None:
+            gauges.append(("udp_subscriptions", "gauge", "UDP push subscriptions", len(publisher.subscriptions)))
+            gauges.append(("udp_sent_total", "counter", "UDP push samples sent", publisher.sent))
+        if sensors is not None:
+            readings = [(metrics.label("sensor", name), lux) for name, lux in sensors.values().items() if lux is not None]
+            gauges.append(("sensor_lux", "gauge", "Latest reading of each sensor in lux", readings))
+            gauges.append(
+                ("sensor_errors_total", "counter", "Failed sensor reads", sum(m.errors for m in sensors.members))
+            )
+        await metrics.write_metrics(writer, gauges)
+
     return server
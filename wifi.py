@@ -1,34 +1,116 @@
-import network, time
+import network
+import random
+import utime as time
+import uasyncio as asyncio
 
-from logs import log
+from logs import log, warning
 
+# How often the connection status is checked while waiting to connect, and while connected
+WIFI_POLL_MS = 100
+WIFI_CHECK_MS = 1000
+# How long one connection attempt may take
+WIFI_CONNECT_TIMEOUT_MS = 20000
+# Failed attempts are retried after an exponentially increasing delay between these limits, randomised by up to half
+# so that devices which lost the same AP don't all retry together
+WIFI_BACKOFF_MIN_MS = 1000
+WIFI_BACKOFF_MAX_MS = 60000
 
-def setup_wifi(ssid, password) -> None:
-    """Attempt to connect to the given SSID/PWD for 20 seconds, and raise an exception on failure
 
-    Args:
-        ssid (str): SSID of the network to connect to
-        password (str): Password for the network to connect to
+class WifiSupervisor:
+    """Connects to WiFi and keeps the connection up
 
-    Returns: None
-
-    Raises:
-        RuntimeError: If the connection fails
+    The link is checked every WIFI_CHECK_MS, and reconnected in place whenever it drops, so an outage only interrupts
+    the network while sampling and history carry on.  Disconnects and how long they took to recover are counted.
     """
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    wlan.connect(ssid, password)
-    # Wait for a good connection status for 20 seconds, and return if successful, otherwise raise an exception
-    for attempt in range(1, 20):
-        log(
-            f"Waiting for connection: wlan.status == {wlan.status()}, attempt {attempt})"
-        )
-        time.sleep(1)
-        if wlan.status() == 3:
-            log("MAC = " + wlan.config("mac").hex())  # type: ignore
-            log("IP  = " + wlan.ifconfig()[0])
-            return
-    # Handle connection error
-    raise RuntimeError(f"Network connection failed, wlan.status == {wlan.status()}")
 
+    def __init__(self, ssid, password, on_ip_change=None):
+        """
+        Args:
+            ssid (str): SSID of the network to connect to
+            password (str): Password for the network to connect to
+            on_ip_change (function): a coroutine function called with the new IP address when a reconnect brings a
+                different one
+        """
+        self.ssid = ssid
+        self.password = password
+        self.on_ip_change = on_ip_change
+        self.wlan = network.WLAN(network.STA_IF)
+        self.ip = None  # the IP address of the interface, None until the first connection
+        self.connected = asyncio.Event()  # set while the link is up
+        self.disconnects = 0
+        self.failed_attempts = 0  # connection attempts which didn't get an IP address
+        self.last_recovery_ms = None  # time from the latest disconnect to being connected again
+        self.max_recovery_ms = 0
+        self.downtime_ms = 0  # total time spent disconnected, after the first connection
+
+    async def _connect(self) -> bool:
+        # Make one connection attempt, returning True once there is an IP address.  Negative statuses (wrong
+        # password, no AP found, connection failed) won't get better by waiting.
+        self.wlan.active(True)
+        self.wlan.connect(self.ssid, self.password)
+        start = time.ticks_ms()
+        status = None
+        while time.ticks_diff(time.ticks_ms(), start) < WIFI_CONNECT_TIMEOUT_MS:
+            if self.wlan.status() != status:
+                status = self.wlan.status()
+                log("Waiting for connection: wlan.status == %s", status)
+            if status == network.STAT_GOT_IP:
+                return True
+            if status < 0:
+                break
+            await asyncio.sleep_ms(WIFI_POLL_MS)
+        warning("Network connection failed, wlan.status == %s", self.wlan.status())
+        self.wlan.disconnect()
+        return False
+
+    async def run(self) -> None:
+        """Connect, then keep the connection up forever"""
+        backoff = WIFI_BACKOFF_MIN_MS
+        down_since = None  # ticks_ms when the link was found down, None before the first connection
+        while True:
+            if self.connected.is_set():
+                if self.wlan.status() == network.STAT_GOT_IP:
+                    await asyncio.sleep_ms(WIFI_CHECK_MS)
+                    continue
+                self.connected.clear()
+                self.disconnects += 1
+                down_since = time.ticks_ms()
+                warning("WiFi connection lost, wlan.status == %s, reconnecting", self.wlan.status())
+
+            if not await self._connect():
+                self.failed_attempts += 1
+                delay = backoff // 2 + random.randint(0, backoff // 2)
+                log("Retrying WiFi connection in %sms", delay)
+                await asyncio.sleep_ms(delay)
+                backoff = min(backoff * 2, WIFI_BACKOFF_MAX_MS)
+                continue
+
+            backoff = WIFI_BACKOFF_MIN_MS
+            ip = self.wlan.ifconfig()[0]
+            if down_since is None:
+                log("MAC = " + self.wlan.config("mac").hex())  # type: ignore
+            else:
+                self.last_recovery_ms = time.ticks_diff(time.ticks_ms(), down_since)
+                self.max_recovery_ms = max(self.max_recovery_ms, self.last_recovery_ms)
+                self.downtime_ms += self.last_recovery_ms
+                log("WiFi reconnected after %sms", self.last_recovery_ms)
+            log("IP  = " + ip)
+            previous, self.ip = self.ip, ip
+            self.connected.set()
+            if previous is not None and ip != previous and self.on_ip_change is not None:
+                try:
+                    await self.on_ip_change(ip)
+                except Exception as e:
+                    warning("Failed to handle IP address change to %s: %s", ip, e)
 
+    def stats(self) -> dict:
+        """Return the link state and disconnect counters"""
+        return {
+            "connected": self.connected.is_set(),
+            "ip": self.ip,
+            "disconnects": self.disconnects,
+            "failed_attempts": self.failed_attempts,
+            "last_recovery_ms": self.last_recovery_ms,
+            "max_recovery_ms": self.max_recovery_ms,
+            "downtime_ms": self.downtime_ms,
+        }